@@ -0,0 +1,115 @@
+"""
+Остановка посреди переписки: ничего не теряется и не дублируется.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.drain --dialogs 5 --delay 3 --drain 1
+
+1. Открываем диалоги; скачивание файлов в заглушке тормозит на --delay секунд.
+2. Каждый клиент шлет текст и фото, и еще один текст ждет в очереди воркера (lifecycle.queued,
+   до хендлера не дошел); пока фото качаются — drain() с DRAIN_TIMEOUT_S=--drain, как по SIGTERM.
+   Тексты успевают, фото — нет: их хендлеры не сохраняются и доделываются сами, в
+   SPOOL_DIR/unfinished-*.json уходят только тексты из очереди.
+3. Еще один клиент в это время посреди анкеты гарантии (описание есть, фото нет).
+4. "Рестарт": FSM и фильтр update_id очищены, lifecycle.start() поднимает FSM из
+   SPOOL_DIR/fsm-*.json и прогоняет сохраненное; клиент из п.3 досылает фото и "✅".
+По каждому тикету в ticket_messages и в outbox (пересылка оператору) должно
+оказаться ровно по три новые строки, в заявке из анкеты — описание и фото.
+Код выхода 1, если нет.
+"""
+import argparse
+import asyncio
+import sys
+import tempfile
+import time
+
+from sqlalchemy import select, func
+
+from bench.flood import _intake_counts
+from bench.harness import Harness
+from bench.outage import _open_dialog
+from src import lifecycle
+from src.config import settings
+from src.db.base import SessionLocal
+from src.db.models import Outbox, TicketMessage
+
+
+def _counts(ticket_ids: list[int]) -> tuple[int, int]:
+    with SessionLocal() as s:
+        messages = s.scalar(select(func.count()).select_from(TicketMessage)
+                            .where(TicketMessage.ticket_id.in_(ticket_ids))) or 0
+        relays = s.scalar(select(func.count()).select_from(Outbox)
+                          .where(Outbox.ticket_id.in_(ticket_ids), Outbox.method == "copy_message")) or 0
+    return messages, relays
+
+
+async def run(args) -> bool:
+    settings.spool_dir = args.spool or tempfile.mkdtemp(prefix="drain_bench_")
+    settings.drain_timeout_s = args.drain
+    h = Harness()
+    await h.start()
+    try:
+        dialogs = [await _open_dialog(h, n) for n in range(args.dialogs)]
+        ticket_ids = [tid for _, _, tid in dialogs]
+        before = await asyncio.to_thread(_counts, ticket_ids)
+
+        intake = h.tg_user(4_100_000_000 + int(time.time()) % 100_000, "Client")
+        await h.feed(h.text(intake, "/start"))
+        await h.feed(h.callback(intake, "warranty_start"))
+        await h.feed(h.text(intake, "Не включается, купили в магазине"))
+
+        h.fake.download_delay_s = args.delay
+        feeds = []
+        for user, _, _ in dialogs:
+            feeds.append(asyncio.create_task(h.feed(h.text(user, "последний вопрос перед выкладкой"))))
+            feeds.append(asyncio.create_task(h.feed(h.photo(user, caption="фото"))))
+            raw = h.text(user, "в очереди воркера")
+            lifecycle.queued[raw["update_id"]] = raw
+        await asyncio.sleep(0.3)
+
+        await lifecycle.drain(h.dp)  # type: ignore[arg-type]
+        print(f"drain: {lifecycle.stats['drain_ms']}ms  saved updates: {lifecycle.stats['saved_updates']}  "
+              f"abandoned: {lifecycle.stats['abandoned_updates']}  "
+              f"saved postprocess: {lifecycle.stats['saved_postprocess']}  saved FSM: {lifecycle.stats['saved_fsm']}")
+        await asyncio.gather(*feeds, return_exceptions=True)
+
+        h.fake.download_delay_s = 0
+        h.dedup.clear()
+        h.dp.storage.storage.clear()  # type: ignore[union-attr]
+        await lifecycle.start(h.bot, h.dp)  # type: ignore[arg-type]
+        print(f"restart: resumed updates: {lifecycle.stats['resumed_updates']}  "
+              f"restored FSM: {lifecycle.stats['restored_fsm']}  state: {lifecycle.state}")
+
+        after = await asyncio.to_thread(_counts, ticket_ids)
+        expected = 3 * args.dialogs
+        got = (after[0] - before[0], after[1] - before[1])
+        print(f"new ticket_messages: {got[0]}/{expected}  new relays: {got[1]}/{expected}")
+
+        await h.feed(h.photo(intake, caption="фото после выкладки"))
+        await h.feed(h.callback(intake, "warranty_done"))
+        card = await h.fake.wait_for(
+            h.operators_chat_id,
+            lambda m, p: m == "sendmessage" and f"TG ID: {intake['id']}" in p.get("text", ""),
+            timeout=30,
+        )
+        tid = int(card["reply_markup"]["inline_keyboard"][0][0]["callback_data"].split(":")[1])
+        intake_messages, _ = await asyncio.to_thread(_intake_counts, tid)
+        print(f"intake across restart: ticket_messages {intake_messages}/2")
+        return got == (expected, expected) and intake_messages == 2
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.drain")
+    p.add_argument("--dialogs", type=int, default=5)
+    p.add_argument("--delay", type=float, default=3.0, help="задержка скачивания файла, с")
+    p.add_argument("--drain", type=int, default=1, help="DRAIN_TIMEOUT_S")
+    p.add_argument("--spool", help="куда писать unfinished-*.json (по умолчанию — временная папка)")
+    args = p.parse_args(argv)
+    ok = asyncio.run(run(args))
+    print("ok" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Повторная доставка апдейтов: тот же поток апдейтов скармливаем боту еще два раза.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.duplicates --dialogs 5 --messages 5
+
+1. Открываем диалоги, обе стороны пишут по --messages реплик (текст и фото) — это поток.
+2. Повтор в том же процессе: все апдейты должен отбросить фильтр update_id.
+3. Повтор "после рестарта" (фильтр очищен): апдейты доходят до хендлеров,
+   дубли не дает уникальный ключ ticket_messages.
+После каждого повтора ни ticket_messages, ни пересылки, ни скачивания не должны
+прибавиться. Код выхода 1, если прибавились.
+"""
+import argparse
+import asyncio
+import sys
+
+from sqlalchemy import select, func
+
+from bench.harness import Harness
+from bench.outage import _open_dialog
+from src.db.base import SessionLocal
+from src.db.models import TicketMessage
+from src.middlewares import dedup
+
+
+def _count(ticket_ids: list[int]) -> int:
+    with SessionLocal() as s:
+        return s.scalar(select(func.count()).select_from(TicketMessage)
+                        .where(TicketMessage.ticket_id.in_(ticket_ids))) or 0
+
+
+async def _feed_all(h: Harness, stream: list[dict]) -> None:
+    for u in stream:
+        await h.feed(u)
+    await asyncio.sleep(1)  # outbox успевает доставить все, что поставили
+
+
+def _snapshot(h: Harness, ticket_ids: list[int]) -> tuple[int, int, int]:
+    return _count(ticket_ids), h.fake.calls["copymessage"], h.fake.calls["download"]
+
+
+async def run(args) -> bool:
+    h = Harness()
+    await h.start()
+    try:
+        dialogs = [await _open_dialog(h, n) for n in range(args.dialogs)]
+        ticket_ids = [tid for _, _, tid in dialogs]
+
+        stream = []
+        for i in range(args.messages):
+            for user, op, _ in dialogs:
+                stream.append(h.text(user, f"вопрос {i}"))
+                stream.append(h.photo(user) if i % 2 else h.text(op, f"ответ {i}"))
+        await _feed_all(h, stream)
+        first = _snapshot(h, ticket_ids)
+        print(f"stream: {len(stream)} updates  ticket_messages/copies/downloads: {first}")
+
+        ok = True
+        for label, restart in (("same process", False), ("after restart", True)):
+            if restart:
+                h.dedup.clear()
+            await _feed_all(h, stream)
+            again = _snapshot(h, ticket_ids)
+            ok &= again == first
+            print(f"replay {label}: {again}  filtered by update_id: {dedup.stats['duplicates']}  "
+                  f"{'ok' if again == first else 'DUPLICATES'}")
+        return ok
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.duplicates")
+    p.add_argument("--dialogs", type=int, default=5)
+    p.add_argument("--messages", type=int, default=4, help="реплик каждой стороны")
+    ok = asyncio.run(run(p.parse_args(argv)))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""
+Планы горячих запросов на большом синтетическом наборе: индексы не должны
+незаметно превратиться в Seq Scan.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.explain --users 20000
+
+Данные живут в отдельной схеме (--schema, по умолчанию explain_bench) той же
+базы: таблицы и индексы создаются так же, как при старте бота (init_db +
+bootstrap), потом generate_series наливает --users пользователей, по 5 тикетов
+на каждого и по 10 сообщений на тикет. Повторный запуск берет уже налитое,
+--reseed — налить заново.
+
+Для каждого запроса — EXPLAIN (FORMAT JSON) и проверка: по большим таблицам нет
+Seq Scan и используется ожидаемый индекс. Код выхода 1, если хоть один план
+поехал.
+"""
+import argparse
+import json
+import sys
+
+from sqlalchemy import create_engine, select, func, literal_column, text
+from sqlalchemy.dialects import postgresql
+
+from src.db.base import engine
+from src.db.bootstrap import bootstrap_indexes_and_tables
+from src.db.models import Base, Ticket, TicketStatus, TicketMessage, MessageAttachment, User
+
+BIG_TABLES = {"tickets", "ticket_messages", "message_attachments", "users"}
+
+SEED = """
+INSERT INTO users (tg_id, first_name, username, is_operator, created_at, updated_at, last_seen)
+SELECT 1000000000 + g, 'User' || g, 'user' || g, false, now(), now(), now()
+FROM generate_series(1, :users) g;
+
+INSERT INTO tickets (user_id, operator_tg_id, status, kind, created_at, claimed_at, closed_at, notified_at)
+SELECT u.id,
+       -- k — сквозной номер тикета: 1% ASSIGNED, 1% WAITING (из них половина без карточки)
+       CASE WHEN k % 100 = 1 THEN NULL ELSE 700000000 + k % 50 END,
+       (CASE WHEN k % 100 = 0 THEN 'assigned' WHEN k % 100 = 1 THEN 'waiting' ELSE 'closed' END)::ticketstatus,
+       CASE WHEN k % 2 = 0 THEN 'warranty' ELSE 'other' END,
+       now() - make_interval(mins => k % 525600),
+       now(), now(),
+       CASE WHEN k % 200 = 1 THEN NULL ELSE now() END
+FROM users u, generate_series(1, 5) AS t(n), LATERAL (SELECT u.id * 5 + t.n AS k) kk;
+
+INSERT INTO ticket_messages (ticket_id, sender_tg_id, sender_type, tg_message_id, content_type, message_text, created_at)
+SELECT t.id, CASE WHEN m.n % 2 = 0 THEN 1 ELSE 2 END,
+       CASE WHEN m.n % 2 = 0 THEN 'operator' ELSE 'user' END,
+       m.n, CASE WHEN m.n % 5 = 0 THEN 'photo' ELSE 'text' END, 'сообщение ' || m.n,
+       t.created_at + make_interval(mins => m.n)
+FROM tickets t, generate_series(1, 10) AS m(n);
+
+INSERT INTO message_attachments (ticket_message_id, ticket_id, media_type, file_id, file_unique_id, created_at)
+SELECT id, ticket_id, 'photo', 'file' || id, 'u' || id, created_at
+FROM ticket_messages WHERE content_type = 'photo';
+
+ANALYZE;
+"""
+
+
+def _engine(schema: str):
+    return create_engine(engine.url, connect_args={"options": f"-csearch_path={schema}"})
+
+
+def _seed(eng, schema: str, users: int, reseed: bool) -> None:
+    with engine.begin() as conn:
+        if reseed:
+            conn.exec_driver_sql(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+        conn.exec_driver_sql(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+    Base.metadata.create_all(eng)
+    bootstrap_indexes_and_tables(eng)
+    with eng.begin() as conn:
+        if conn.scalar(text("SELECT count(*) FROM users")):
+            return
+        print(f"seeding {users} users, {users * 5} tickets, {users * 50} messages...")
+        for stmt in filter(None, (s.strip() for s in SEED.split(";"))):
+            conn.execute(text(stmt), {"users": users})
+
+
+# у тикета десяток сообщений — ux_ticket_messages_key с сортировкой тоже годится
+MESSAGES = ("ix_ticket_messages_ticket_created", "ux_ticket_messages_key")
+
+
+def _queries(conn) -> list[tuple[str, object, tuple[str, ...], set[str]]]:
+    """
+    (название, запрос, индексы — хоть один должен быть в плане, таблицы, которые
+    можно читать целиком) — запросы как в хендлерах.
+    """
+    t = conn.execute(
+        select(Ticket.id, Ticket.user_id, Ticket.operator_tg_id)
+        .where(Ticket.status == TicketStatus.assigned).limit(1)
+    ).one()
+    user_tg = conn.scalar(select(User.tg_id).where(User.id == t.user_id))
+    other_ids = list(conn.scalars(select(Ticket.id).where(Ticket.user_id == t.user_id)))
+    cutoff = literal_column("now() - interval '24 hours'")
+
+    return [
+        ("proxy: диалог оператора",
+         select(Ticket).where(Ticket.operator_tg_id == t.operator_tg_id, Ticket.status == TicketStatus.assigned),
+         ("ix_tickets_operator_assigned",), set()),
+        ("proxy: пользователь по tg_id",
+         select(User).where(User.tg_id == user_tg),
+         ("ix_users_tg_id",), set()),
+        ("proxy: диалог пользователя",
+         select(Ticket).where(Ticket.user_id == t.user_id, Ticket.status == TicketStatus.assigned),
+         ("ix_ticket_user_active",), set()),
+        ("claim: сообщения клиента по порядку",
+         select(TicketMessage)
+         .where(TicketMessage.ticket_id == t.id, TicketMessage.sender_type == "user")
+         .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc()),
+         MESSAGES, set()),
+        ("история: сообщения тикета с вложениями",
+         select(TicketMessage.id, TicketMessage.message_text, MessageAttachment.id)
+         .outerjoin(MessageAttachment, MessageAttachment.ticket_message_id == TicketMessage.id)
+         .where(TicketMessage.ticket_id == t.id)
+         .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc(), MessageAttachment.id.asc()),
+         ("ix_message_attachments_ticket_message_id",), set()),
+        ("история: тикеты пользователя",
+         select(Ticket).where(Ticket.user_id == t.user_id, Ticket.id != t.id)
+         .order_by(Ticket.created_at.asc(), Ticket.id.asc()),
+         ("ix_ticket_user_active",), set()),
+        ("история: последнее сообщение тикетов",
+         select(TicketMessage.ticket_id, func.max(TicketMessage.id))
+         .where(TicketMessage.ticket_id.in_(other_ids)).group_by(TicketMessage.ticket_id),
+         MESSAGES, set()),
+        ("/phone: последние тикеты пользователя",
+         select(Ticket.id, Ticket.status, Ticket.created_at)
+         .where(Ticket.user_id == t.user_id).order_by(Ticket.id.desc()).limit(10),
+         ("ix_ticket_user_active",), set()),
+        ("reaper: брошенные intake",
+         select(Ticket.id).where(Ticket.status == TicketStatus.waiting, Ticket.notified_at.is_(None),
+                                 Ticket.created_at < cutoff).limit(200),
+         ("ix_tickets_intake",), set()),
+        ("reaper: заглохшие диалоги",
+         select(Ticket.id).where(
+             Ticket.status == TicketStatus.assigned,
+             func.greatest(
+                 select(func.max(TicketMessage.created_at))
+                 .where(TicketMessage.ticket_id == Ticket.id).correlate(Ticket).scalar_subquery(),
+                 Ticket.claimed_at, Ticket.created_at,
+             ) < cutoff,
+         ).limit(200),
+         ("ix_ticket_messages_ticket_created",), set()),
+        ("маршруты: все диалоги ASSIGNED",
+         select(Ticket.id, User.tg_id, Ticket.operator_tg_id)
+         .join(User, User.id == Ticket.user_id)
+         .where(Ticket.status == TicketStatus.assigned, Ticket.operator_tg_id.is_not(None))
+         .order_by(Ticket.id.desc()),
+         # снимок всех диалогов: users целиком в hash join — нормально
+         ("ix_tickets_operator_assigned", "ix_tickets_status"), {"users"}),
+    ]
+
+
+def _walk(node: dict):
+    yield node
+    for child in node.get("Plans", []):
+        yield from _walk(child)
+
+
+def check(conn, stmt, expect: tuple[str, ...], allow_seq: set[str]) -> tuple[bool, set[str], set[str]]:
+    sql = str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+    plan = conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    nodes = list(_walk(plan[0]["Plan"]))
+    indexes = {n["Index Name"] for n in nodes if "Index Name" in n}
+    seq = {n["Relation Name"] for n in nodes if n["Node Type"] == "Seq Scan"} & (BIG_TABLES - allow_seq)
+    return bool(indexes & set(expect)) and not seq, indexes, seq
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.explain")
+    p.add_argument("--users", type=int, default=20_000)
+    p.add_argument("--schema", default="explain_bench")
+    p.add_argument("--reseed", action="store_true", help="налить данные заново")
+    p.add_argument("--verbose", action="store_true", help="печатать планы целиком")
+    args = p.parse_args(argv)
+
+    eng = _engine(args.schema)
+    _seed(eng, args.schema, args.users, args.reseed)
+
+    failed = 0
+    with eng.connect() as conn:
+        for name, stmt, expect, allow_seq in _queries(conn):
+            ok, indexes, seq = check(conn, stmt, expect, allow_seq)
+            failed += not ok
+            print(f"{'ok  ' if ok else 'FAIL'} {name:<42} indexes: {', '.join(sorted(indexes)) or '—'}"
+                  + (f"  seq scan: {', '.join(sorted(seq))}" if seq else "")
+                  + ("" if indexes & set(expect) else f"  (ожидали {' / '.join(expect)})"))
+            if args.verbose or not ok:
+                sql = str(stmt.compile(dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}))
+                for (line,) in conn.exec_driver_sql("EXPLAIN " + sql):
+                    print("      " + line)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
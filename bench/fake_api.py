@@ -0,0 +1,169 @@
+"""
+Локальная заглушка Telegram Bot API для нагрузочных прогонов.
+
+Отвечает на методы, которые реально дергает бот (sendMessage, copyMessage,
+getFile, editMessageText, ...), отдает "файлы" фиксированного размера
+и считает все исходящие вызовы: всего, по методам и по чатам.
+
+Каждое сообщение, которое бот отправил в чат, кладется в inbox этого чата,
+чтобы симулятор пользователя/оператора мог дождаться ответа.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import Counter, defaultdict
+
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """
+    local_dir — вести себя как telegram-bot-api --local: getFile кладет файл
+    в local_dir и отвечает абсолютным путем к нему.
+    """
+
+    def __init__(self, file_size: int = 256 * 1024, local_dir: str | None = None):
+        self.file_size = file_size
+        self.local_dir = local_dir
+        self.download_delay_s = 0.0  # медленное скачивание: хендлеры подольше висят в обработке
+        self.calls: Counter[str] = Counter()
+        self.calls_by_chat: Counter[int] = Counter()
+        self.inboxes: dict[int, asyncio.Queue] = defaultdict(asyncio.Queue)
+        self._msg_id = 10_000_000
+        self._runner: web.AppRunner | None = None
+        self.base_url = ""
+
+    # --------- жизненный цикл ---------
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self._handle_file)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        real_port = site._server.sockets[0].getsockname()[1]  # type: ignore[union-attr]
+        self.base_url = f"http://{host}:{real_port}"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner:
+            await self._runner.cleanup()
+
+    # --------- хелперы для симуляторов ---------
+
+    async def wait_for(self, chat_id: int, predicate, timeout: float = 30.0) -> dict:
+        """
+        Ждем в inbox чата вызов, для которого predicate(method, params) истинно.
+        Остальное по пути выкидываем.
+        """
+        q = self.inboxes[chat_id]
+        deadline = time.monotonic() + timeout
+        while True:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                raise TimeoutError(f"chat {chat_id}: ожидаемое сообщение не пришло")
+            method, params = await asyncio.wait_for(q.get(), left)
+            if predicate(method, params):
+                return params
+
+    def drain(self, chat_id: int) -> None:
+        """Выкидываем все, что уже пришло в чат."""
+        q = self.inboxes[chat_id]
+        while not q.empty():
+            q.get_nowait()
+
+    def outbound_total(self) -> int:
+        return sum(n for m, n in self.calls.items() if m not in ("getme", "getupdates", "deletewebhook"))
+
+    # --------- обработчики ---------
+
+    def _next_id(self) -> int:
+        self._msg_id += 1
+        return self._msg_id
+
+    def _message(self, chat_id: int, **extra) -> dict:
+        return {
+            "message_id": self._next_id(),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            **extra,
+        }
+
+    async def _handle_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        form = await request.post()
+        params: dict = {}
+        for k, v in form.items():
+            if isinstance(v, str) and v[:1] in "{[":
+                try:
+                    v = json.loads(v)
+                except ValueError:
+                    pass
+            params[k] = v
+
+        self.calls[method] += 1
+        chat_id = params.get("chat_id")
+        if chat_id is not None:
+            chat_id = int(chat_id)
+            self.calls_by_chat[chat_id] += 1
+            self.inboxes[chat_id].put_nowait((method, params))
+
+        return web.json_response({"ok": True, "result": self._result(method, params, chat_id)})
+
+    def _result(self, method: str, params: dict, chat_id: int | None):
+        if method == "getme":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method in ("sendmessage", "editmessagetext"):
+            if method == "editmessagetext" and "inline_message_id" in params:
+                return True
+            return self._message(chat_id or 0, text=params.get("text", ""))
+        if method == "senddocument":
+            return self._message(chat_id or 0, document={
+                "file_id": f"doc{self._msg_id}", "file_unique_id": f"udoc{self._msg_id}",
+            })
+        if method == "copymessage":
+            return {"message_id": self._next_id()}
+        if method == "getfile":
+            fid = params.get("file_id", "f")
+            return {
+                "file_id": fid,
+                "file_unique_id": f"u_{fid}",
+                "file_size": self.file_size,
+                "file_path": self._local_file(fid) if self.local_dir else f"files/{fid}.bin",
+            }
+        if method == "getupdates":
+            return []
+        return True
+
+    def _local_file(self, fid: str) -> str:
+        path = os.path.join(self.local_dir, "documents", f"{fid}.bin")  # type: ignore[arg-type]
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                chunk = os.urandom(65536)
+                for _ in range(0, self.file_size, len(chunk)):
+                    f.write(chunk)
+                f.truncate(self.file_size)
+        return os.path.abspath(path)
+
+    async def _handle_file(self, request: web.Request) -> web.StreamResponse:
+        self.calls["download"] += 1
+        if self.download_delay_s:
+            await asyncio.sleep(self.download_delay_s)
+        resp = web.StreamResponse()
+        resp.content_length = self.file_size
+        try:
+            await resp.prepare(request)
+            chunk = b"\0" * 65536
+            left = self.file_size
+            while left > 0:
+                n = min(left, len(chunk))
+                await resp.write(chunk[:n])
+                left -= n
+            await resp.write_eof()
+        except ConnectionResetError:
+            pass  # клиент бросил скачивание (bench.drain)
+        return resp
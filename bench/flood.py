@@ -0,0 +1,104 @@
+"""
+Один клиент флудит в диалоге, остальные переписываются как обычно.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.flood --dialogs 10 --flood 300
+
+Флудер разом шлет --flood сообщений оператору, остальные клиенты в это время
+пишут по --messages реплик с паузой. Меряем, за сколько реплики обычных клиентов
+доходят до оператора. Сравнить с выключенным антифлудом: FLOOD_LIMITS=off python -m bench.flood
+
+Потом анкета гарантии: клиент разом шлет --intake отдельных фото (сверх пачки они
+ждут в антифлуде) и сразу жмет "✅". Все фото должны попасть в заявку и в карточку
+операторам; код выхода 1, если нет.
+"""
+import argparse
+import asyncio
+import sys
+import time
+
+from sqlalchemy import select, func
+
+from bench.harness import Harness, percentile
+from bench.loadtest import _is_copy_from
+from bench.outage import _open_dialog
+from src.config import settings
+from src.db.base import SessionLocal
+from src.db.models import Outbox, TicketMessage
+from src.middlewares import antiflood
+
+
+async def _polite(h: Harness, user: dict, op: dict, messages: int, latencies: list[float]) -> None:
+    for i in range(messages):
+        t0 = time.perf_counter()
+        await h.feed(h.text(user, f"вопрос {i}"))
+        await h.fake.wait_for(op["id"], _is_copy_from(user["id"]), timeout=120)
+        latencies.append(time.perf_counter() - t0)
+        await asyncio.sleep(0.2)
+
+
+def _intake_counts(ticket_id: int) -> tuple[int, int]:
+    with SessionLocal() as s:
+        messages = s.scalar(select(func.count()).select_from(TicketMessage)
+                            .where(TicketMessage.ticket_id == ticket_id)) or 0
+        copies = s.scalar(select(func.count()).select_from(Outbox)
+                          .where(Outbox.ticket_id == ticket_id, Outbox.method == "copy_message")) or 0
+    return messages, copies
+
+
+async def _intake(h: Harness, photos: int) -> bool:
+    user = h.tg_user(4_000_000_000 + int(time.time()) % 100_000, "Client")
+    await h.feed(h.text(user, "/start"))
+    await h.feed(h.callback(user, "warranty_start"))
+    await h.feed(h.text(user, "Течет крышка, купили на Ozon"))
+    feeds = [asyncio.create_task(h.feed(h.photo(user, caption=f"фото {i}"))) for i in range(photos)]
+    await asyncio.sleep(0.05)
+    await h.feed(h.callback(user, "warranty_done"))
+    await asyncio.gather(*feeds)
+    card = await h.fake.wait_for(
+        h.operators_chat_id,
+        lambda m, p: m == "sendmessage" and f"TG ID: {user['id']}" in p.get("text", ""),
+        timeout=30,
+    )
+    tid = int(card["reply_markup"]["inline_keyboard"][0][0]["callback_data"].split(":")[1])
+    messages, copies = await asyncio.to_thread(_intake_counts, tid)
+    # описание + фото; каждое — в заявке и копией в карточке
+    print(f"intake: {photos} photos, ticket_messages {messages}/{photos + 1}, card copies {copies}/{photos + 1}")
+    return messages == copies == photos + 1
+
+
+async def run(args) -> bool:
+    h = Harness()
+    await h.start()
+    try:
+        dialogs = [await _open_dialog(h, n) for n in range(args.dialogs + 1)]
+        (flooder, _, _), normal = dialogs[0], dialogs[1:]
+
+        latencies: list[float] = []
+        t0 = time.perf_counter()
+        await asyncio.gather(
+            *(h.feed(h.text(flooder, f"спам {i}")) for i in range(args.flood)),
+            *(_polite(h, u, o, args.messages, latencies) for u, o, _ in normal),
+        )
+        print(f"FLOOD_LIMITS={settings.flood_limits!r}  wall {time.perf_counter() - t0:.1f}s")
+        print(f"normal relay ms: p50 {percentile(latencies, 50) * 1000:.0f}  "
+              f"p95 {percentile(latencies, 95) * 1000:.0f}  max {max(latencies) * 1000:.0f}")
+        print(f"antiflood: {antiflood.stats}")
+        return await _intake(h, args.intake)
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.flood")
+    p.add_argument("--dialogs", type=int, default=10, help="обычных диалогов")
+    p.add_argument("--messages", type=int, default=5, help="реплик каждого обычного клиента")
+    p.add_argument("--flood", type=int, default=300, help="сообщений от флудера")
+    p.add_argument("--intake", type=int, default=8, help="отдельных фото в анкете перед \"✅\"")
+    ok = asyncio.run(run(p.parse_args(argv)))
+    print("ok" if ok else "FAIL")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+Обвязка для прогонов бота без Telegram.
+
+Поднимает FakeBotAPI, настоящий Bot (смотрит на заглушку) и тот же Dispatcher,
+что у бота (src.app.build_dispatcher: middleware, роутеры, startup/shutdown-хуки),
+а дальше кормит ему апдейты через feed_raw_update и меряет:
+- время каждого хендлера (inner-middleware на роутерах),
+- количество SQL-запросов на один апдейт (событие движка + contextvar),
+- общее время обработки апдейта.
+
+Нужна отдельная (scratch) база Postgres — переменные POSTGRES_* как у бота.
+"""
+import os
+import tempfile
+
+# до импорта src.config: боту не нужен настоящий токен и чат
+os.environ.setdefault("BOT_TOKEN", "42:bench")
+os.environ.setdefault("OPERATORS_CHAT_ID", "-1009999999999")
+os.environ.setdefault("MEDIA_ROOT", tempfile.mkdtemp(prefix="bench_media_"))
+# хуки lifecycle пишут FSM и недоделанное в SPOOL_DIR — не в ./spool бота
+os.environ.setdefault("SPOOL_DIR", tempfile.mkdtemp(prefix="bench_spool_"))
+
+import time
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Any
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from sqlalchemy import event
+
+from bench.fake_api import FakeBotAPI
+from src.app import build_bot, build_dispatcher
+from src.config import settings
+from src.db.base import engine, init_db
+from src.db.bootstrap import bootstrap_indexes_and_tables
+from src.routers import public, operators, proxy
+from src.middlewares.dedup import RecentUpdates
+from src.db import cache
+from src.utils import tg_session
+
+_queries: ContextVar[list[int] | None] = ContextVar("bench_queries", default=None)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    box = _queries.get()
+    if box is not None:
+        box[0] += 1
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, round(p / 100 * (len(ordered) - 1))))
+    return ordered[k]
+
+
+class Metrics:
+    def __init__(self):
+        self.handler_times: dict[str, list[float]] = defaultdict(list)
+        self.update_times: list[float] = []
+        self.queries_per_update: list[int] = []
+        self.errors = 0
+
+    def summary(self, wall: float, fake: FakeBotAPI, tickets: int) -> dict[str, Any]:
+        updates = len(self.update_times)
+        return {
+            "wall_s": round(wall, 3),
+            "updates": updates,
+            "errors": self.errors,
+            "updates_per_s": round(updates / wall, 2) if wall else 0.0,
+            "update_ms": {
+                "p50": round(percentile(self.update_times, 50) * 1000, 2),
+                "p95": round(percentile(self.update_times, 95) * 1000, 2),
+                "p99": round(percentile(self.update_times, 99) * 1000, 2),
+            },
+            "handlers_ms": {
+                name: {
+                    "n": len(ts),
+                    "p50": round(percentile(ts, 50) * 1000, 2),
+                    "p95": round(percentile(ts, 95) * 1000, 2),
+                    "p99": round(percentile(ts, 99) * 1000, 2),
+                }
+                for name, ts in sorted(self.handler_times.items())
+            },
+            "db_queries_per_update": {
+                "mean": round(sum(self.queries_per_update) / updates, 2) if updates else 0.0,
+                "p95": percentile(self.queries_per_update, 95),
+                "max": max(self.queries_per_update, default=0),
+            },
+            "tickets": tickets,
+            "api_calls_per_ticket": round(fake.outbound_total() / tickets, 2) if tickets else 0.0,
+            "api_calls": dict(sorted(fake.calls.items())),
+            # со стороны бота: задержки по методам Bot API (src/utils/tg_session.py)
+            "api_latency_ms": tg_session.latency_summary(),
+            # кэши процесса (src/db/cache.py)
+            "cache": dict(cache.stats),
+        }
+
+
+class _HandlerTimer(BaseMiddleware):
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        name = getattr(getattr(h, "callback", None), "__name__", "unknown")
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.metrics.handler_times[name].append(time.perf_counter() - t0)
+
+
+class Harness:
+    def __init__(self, file_size: int = 256 * 1024):
+        self.fake = FakeBotAPI(file_size=file_size)
+        self.metrics = Metrics()
+        self.bot: Bot | None = None
+        self.dp: Dispatcher | None = None
+        self.operators_chat_id = settings.operators_chat_id
+        self._update_id = 0
+        self._msg_ids: dict[int, int] = defaultdict(int)
+
+    async def start(self) -> None:
+        init_db()
+        bootstrap_indexes_and_tables()
+        # от прода отличается только адрес Bot API
+        self.bot = build_bot(await self.fake.start())
+        self.dp = build_dispatcher()
+        # фильтр повторов: бенчи чистят его, изображая рестарт
+        self.dedup = next(m for m in self.dp.update.outer_middleware if isinstance(m, RecentUpdates))
+        timer = _HandlerTimer(self.metrics)
+        for r in (public.router, operators.router, proxy.router):
+            r.message.middleware(timer)
+            r.callback_query.middleware(timer)
+        await self.dp.emit_startup(**self._hook_kwargs())
+
+    def _hook_kwargs(self) -> dict:
+        # то же, что передает хукам aiogram при polling
+        return {"bot": self.bot, "dispatcher": self.dp, "bots": [self.bot], **self.dp.workflow_data}
+
+    async def stop(self) -> None:
+        if self.dp:
+            await self.dp.emit_shutdown(**self._hook_kwargs())
+        if self.bot:
+            await self.bot.session.close()
+        await self.fake.stop()
+
+    async def feed(self, update: dict) -> None:
+        box = [0]
+        token = _queries.set(box)
+        t0 = time.perf_counter()
+        try:
+            await self.dp.feed_raw_update(self.bot, update)  # type: ignore[union-attr]
+        except Exception:
+            self.metrics.errors += 1
+        finally:
+            self.metrics.update_times.append(time.perf_counter() - t0)
+            self.metrics.queries_per_update.append(box[0])
+            _queries.reset(token)
+
+    # --------- конструкторы апдейтов ---------
+
+    def _next_update_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def _next_msg_id(self, chat_id: int) -> int:
+        self._msg_ids[chat_id] += 1
+        return self._msg_ids[chat_id]
+
+    @staticmethod
+    def tg_user(uid: int, name: str) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": name, "username": f"{name.lower()}{uid}"}
+
+    def message(self, user: dict, chat_id: int | None = None, **content) -> dict:
+        chat_id = chat_id if chat_id is not None else user["id"]
+        return {
+            "update_id": self._next_update_id(),
+            "message": {
+                "message_id": self._next_msg_id(chat_id),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": user,
+                **content,
+            },
+        }
+
+    def text(self, user: dict, text: str, chat_id: int | None = None) -> dict:
+        return self.message(user, chat_id, text=text)
+
+    def photo(self, user: dict, caption: str | None = None) -> dict:
+        n = self._next_update_id()
+        sizes = [
+            {"file_id": f"ph{user['id']}_{n}_s", "file_unique_id": f"phu{user['id']}_{n}_s",
+             "width": 90, "height": 90, "file_size": 2048},
+            {"file_id": f"ph{user['id']}_{n}", "file_unique_id": f"phu{user['id']}_{n}",
+             "width": 1280, "height": 960, "file_size": self.fake.file_size},
+        ]
+        extra = {"caption": caption} if caption else {}
+        return self.message(user, photo=sizes, **extra)
+
+    def callback(self, user: dict, data: str, chat_id: int | None = None) -> dict:
+        chat_id = chat_id if chat_id is not None else user["id"]
+        uid = self._next_update_id()
+        return {
+            "update_id": uid,
+            "callback_query": {
+                "id": str(uid),
+                "from": user,
+                "chat_instance": str(chat_id),
+                "data": data,
+                "message": {
+                    "message_id": self._next_msg_id(chat_id),
+                    "date": int(time.time()),
+                    "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                    "text": "menu",
+                },
+            },
+        }
@@ -0,0 +1,171 @@
+"""
+Нагрузочный прогон: синтетические клиенты и операторы против настоящих роутеров.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.loadtest --users 50 --operators 5 --save bench_output.json
+
+Клиент: /start -> гарантия или "другой вопрос" -> текст -> N фото -> "Отправить оператору"
+-> ждет подключения оператора -> переписка -> ждет отключения.
+Оператор: берет тикет из операторского чата -> переписка -> история -> завершить.
+
+--compare base.json завершает процесс с кодом 1, если пропускная способность
+упала или p95 какого-либо хендлера вырос больше, чем на --tolerance.
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import sys
+import time
+
+from bench.harness import Harness
+from src import texts
+
+CLAIM_RE = re.compile(r"claim:(\d+)")
+TG_ID_RE = re.compile(r"TG ID: (\d+)")
+
+
+def _is_text(expected: str):
+    return lambda method, p: method == "sendmessage" and p.get("text") == expected
+
+
+def _is_copy_from(chat_id: int):
+    return lambda method, p: method == "copymessage" and int(p.get("from_chat_id", 0)) == chat_id
+
+
+async def customer(h: Harness, uid: int, tickets: int, media: int, rounds: int, done: list[int]) -> None:
+    user = h.tg_user(uid, "Client")
+    for _ in range(tickets):
+        warranty = random.random() < 0.5
+        await h.feed(h.text(user, "/start"))
+        await h.feed(h.callback(user, "warranty_start" if warranty else "other_start"))
+        await h.feed(h.text(user, "Течет крышка, купили на Ozon"))
+        for i in range(media):
+            await h.feed(h.photo(user, caption="чек" if i == 0 else None))
+        await h.feed(h.callback(user, "warranty_done" if warranty else "other_done"))
+
+        await h.fake.wait_for(uid, _is_text(texts.OP_CONNECTED), timeout=120)
+        for i in range(rounds):
+            await h.fake.wait_for(uid, lambda m, p: m == "copymessage", timeout=60)
+            await h.feed(h.text(user, f"ответ клиента {i}"))
+        await h.fake.wait_for(uid, _is_text(texts.OP_DISCONNECTED), timeout=60)
+        done[0] += 1
+
+
+async def claims_feed(h: Harness, queue: asyncio.Queue) -> None:
+    """Разбираем карточки в операторском чате и раздаем тикеты операторам."""
+    while True:
+        p = await h.fake.wait_for(
+            h.operators_chat_id,
+            lambda m, p: m == "sendmessage" and "claim:" in json.dumps(p.get("reply_markup") or {}),
+            timeout=3600,
+        )
+        tid = int(CLAIM_RE.search(json.dumps(p["reply_markup"])).group(1))  # type: ignore[union-attr]
+        user_tg = int(TG_ID_RE.search(p.get("text", "")).group(1))  # type: ignore[union-attr]
+        queue.put_nowait((tid, user_tg))
+
+
+async def operator(h: Harness, uid: int, queue: asyncio.Queue, rounds: int) -> None:
+    op = h.tg_user(uid, "Operator")
+    while True:
+        tid, user_tg = await queue.get()
+        await h.feed(h.callback(op, f"claim:{tid}", chat_id=h.operators_chat_id))
+        # копии заявки, которые бот прислал при claim, нам не нужны
+        h.fake.drain(uid)
+        for i in range(rounds):
+            await h.feed(h.text(op, f"ответ оператора {i}"))
+            await h.fake.wait_for(uid, _is_copy_from(user_tg), timeout=60)
+        await h.feed(h.callback(op, f"history:{tid}"))
+        await h.feed(h.callback(op, f"finish:{tid}"))
+
+
+def _print_report(r: dict) -> None:
+    print(f"wall: {r['wall_s']}s  updates: {r['updates']}  errors: {r['errors']}  "
+          f"updates/s: {r['updates_per_s']}")
+    u = r["update_ms"]
+    print(f"update latency ms: p50={u['p50']} p95={u['p95']} p99={u['p99']}")
+    print(f"{'handler':<28}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, s in r["handlers_ms"].items():
+        print(f"{name:<28}{s['n']:>7}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}")
+    q = r["db_queries_per_update"]
+    print(f"db queries/update: mean={q['mean']} p95={q['p95']} max={q['max']}")
+    print(f"tickets: {r['tickets']}  api calls/ticket: {r['api_calls_per_ticket']}")
+    print("api calls:", ", ".join(f"{k}={v}" for k, v in r["api_calls"].items()))
+    for name, st in r.get("api_latency_ms", {}).items():
+        print(f"  {name:<24}{st['calls']:>7} calls  avg {st['avg_ms']}ms  max {st['max_ms']}ms")
+    if "cache" in r:
+        print("cache:", ", ".join(f"{k}={v}" for k, v in r["cache"].items()))
+
+
+def compare(current: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Список регрессий относительно сохраненного прогона."""
+    problems = []
+    if current["updates_per_s"] < baseline["updates_per_s"] * (1 - tolerance):
+        problems.append(f"updates/s {baseline['updates_per_s']} -> {current['updates_per_s']}")
+    for name, base in baseline["handlers_ms"].items():
+        cur = current["handlers_ms"].get(name)
+        if cur and base["p95"] and cur["p95"] > base["p95"] * (1 + tolerance):
+            problems.append(f"{name} p95 {base['p95']}ms -> {cur['p95']}ms")
+    base_q = baseline["db_queries_per_update"]["mean"]
+    if current["db_queries_per_update"]["mean"] > base_q * (1 + tolerance):
+        problems.append(f"db queries/update {base_q} -> {current['db_queries_per_update']['mean']}")
+    return problems
+
+
+async def run(args) -> dict:
+    random.seed(args.seed)
+    h = Harness(file_size=args.file_size)
+    await h.start()
+    try:
+        queue: asyncio.Queue = asyncio.Queue()
+        done = [0]
+        feeder = asyncio.create_task(claims_feed(h, queue))
+        ops = [
+            asyncio.create_task(operator(h, 7_000_000 + i, queue, args.rounds))
+            for i in range(args.operators)
+        ]
+        t0 = time.perf_counter()
+        await asyncio.gather(*(
+            customer(h, 1_000_000 + i, args.tickets, args.media, args.rounds, done)
+            for i in range(args.users)
+        ))
+        wall = time.perf_counter() - t0
+        for t in (feeder, *ops):
+            t.cancel()
+        return h.metrics.summary(wall, h.fake, done[0])
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.loadtest")
+    p.add_argument("--users", type=int, default=20)
+    p.add_argument("--operators", type=int, default=4)
+    p.add_argument("--tickets", type=int, default=2, help="обращений на одного клиента")
+    p.add_argument("--media", type=int, default=2, help="фото в одном обращении")
+    p.add_argument("--rounds", type=int, default=3, help="реплик в живом чате")
+    p.add_argument("--file-size", type=int, default=256 * 1024)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--save", help="сохранить результат в json")
+    p.add_argument("--compare", help="сравнить с сохраненным json")
+    p.add_argument("--tolerance", type=float, default=0.2)
+    args = p.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    _print_report(result)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for line in problems:
+            print("REGRESSION:", line)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
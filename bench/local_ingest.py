@@ -0,0 +1,65 @@
+"""
+Скачивание вложений: публичный Bot API (HTTP-поток) против своего
+telegram-bot-api в режиме --local (файл уже на диске, берем ссылкой).
+
+    python -m bench.local_ingest --files 20 --size-mb 50
+
+Заглушка в local-режиме пишет файлы в --server-dir и отдает из getFile
+абсолютный путь — как настоящий сервер. --server-dir на том же разделе,
+что и MEDIA_ROOT, — жесткие ссылки; на другом — копия.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+
+from aiogram import Bot
+
+from bench.fake_api import FakeBotAPI
+from src.config import settings
+from src.utils.files import download_by_file_id
+from src.utils.tg_session import TunedSession
+
+
+async def _run(mode: str, files: int, size: int, server_dir: str | None) -> float:
+    fake = FakeBotAPI(file_size=size, local_dir=server_dir)
+    base = await fake.start()
+    bot = Bot(token=settings.bot_token, session=TunedSession(base, local=server_dir is not None))
+    try:
+        if server_dir:
+            # "сервер" успевает скачать файлы до того, как бот о них спросит
+            for i in range(files):
+                fake._local_file(f"{mode}{i}")
+        t0 = time.perf_counter()
+        for i in range(files):
+            await download_by_file_id(bot, f"{mode}{i}", f"ingest_{mode}/{i}.bin", unique_id=f"u{mode}{i}")
+        return time.perf_counter() - t0
+    finally:
+        await bot.session.close()
+        await fake.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.local_ingest")
+    p.add_argument("--files", type=int, default=10)
+    p.add_argument("--size-mb", type=float, default=25)
+    p.add_argument("--server-dir", help="рабочая папка заглушки local-сервера (по умолчанию — рядом с MEDIA_ROOT)")
+    args = p.parse_args(argv)
+    size = int(args.size_mb * 1024 * 1024)
+    server_dir = args.server_dir or tempfile.mkdtemp(prefix="tg_api_", dir=os.path.dirname(os.path.abspath(settings.media_root)))
+
+    try:
+        total_mb = args.files * size / 2**20
+        for mode, local in (("http", None), ("local", server_dir)):
+            took = asyncio.run(_run(mode, args.files, size, local))
+            print(f"{mode:<6} {args.files} x {args.size_mb} MB: {took:.2f}s  {total_mb / took:.0f} MB/s  "
+                  f"{took / args.files * 1000:.1f} ms/file")
+    finally:
+        if not args.server_dir:
+            shutil.rmtree(server_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
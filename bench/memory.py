@@ -0,0 +1,86 @@
+"""
+Растет ли память от волны к волне.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.memory --waves 5 --users 20 --frames 1
+
+Несколько волн сценария bench.loadtest в одном процессе: каждая волна — новые
+клиенты (как новые люди в проде), операторы те же. После волны — gc и снимок
+src/diagnostics.py: RSS, tracemalloc, FSM, сессии SQLAlchemy, размеры кэшей и
+очередей, и где выросло с прошлой волны. То, что растет каждую волну и не
+упирается в лимит (CACHE_SIZE, DEDUP_UPDATES...), — кандидат на утечку.
+Цена tracemalloc — сравнить updates/s с --frames 0.
+"""
+import argparse
+import asyncio
+import gc
+import random
+import time
+
+from bench.harness import Harness
+from bench.loadtest import claims_feed, customer, operator
+from src import diagnostics
+
+
+def _print_wave(n: int, updates_per_s: float, r: dict, top: int) -> None:
+    t = r.get("tracemalloc", {})
+    print(f"wave {n}: {updates_per_s} updates/s  rss {r['rss_mib']} MiB  "
+          f"traced {t.get('traced_mib', '-')} MiB  snapshot {t.get('snapshot_ms', '-')}ms")
+    print(f"  fsm: {r['fsm']}  sessions: {r['sqlalchemy_sessions']}")
+    print("  sizes:", ", ".join(f"{k}={v}" for k, v in r["sizes"].items() if v))
+    for g in t.get("growth_recent", [])[:top]:
+        print(f"  +{g['size_diff_kib']:>8} KiB {g['count_diff']:>+7}  {g['where']}")
+
+
+async def run(args) -> None:
+    random.seed(args.seed)
+    h = Harness()
+    await h.start()
+    try:
+        diagnostics.attach(h.dp, args.frames)  # type: ignore[arg-type]
+        await diagnostics.snapshot()
+        queue: asyncio.Queue = asyncio.Queue()
+        feeder = asyncio.create_task(claims_feed(h, queue))
+        ops = [
+            asyncio.create_task(operator(h, 7_000_000 + i, queue, args.rounds))
+            for i in range(args.operators)
+        ]
+        for wave in range(1, args.waves + 1):
+            done = [0]
+            before = len(h.metrics.update_times)
+            t0 = time.perf_counter()
+            await asyncio.gather(*(
+                customer(h, 2_000_000 + wave * args.users + i, 1, args.media, args.rounds, done)
+                for i in range(args.users)
+            ))
+            wall = time.perf_counter() - t0
+            gc.collect()
+            await diagnostics.snapshot()
+            rate = round((len(h.metrics.update_times) - before) / wall, 2)
+            _print_wave(wave, rate, diagnostics.report(), args.top)
+        for t in (feeder, *ops):
+            t.cancel()
+        r = diagnostics.report(args.top)
+        print("since start:")
+        for g in r.get("tracemalloc", {}).get("growth_since_start", [])[:args.top]:
+            print(f"  +{g['size_diff_kib']:>8} KiB {g['count_diff']:>+7}  {g['where']}")
+        print("objects:", ", ".join(f"{name}={n}" for name, n in r["objects"]))
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.memory")
+    p.add_argument("--waves", type=int, default=5)
+    p.add_argument("--users", type=int, default=20, help="новых клиентов в волне")
+    p.add_argument("--operators", type=int, default=3)
+    p.add_argument("--media", type=int, default=1)
+    p.add_argument("--rounds", type=int, default=2, help="реплик в живом чате")
+    p.add_argument("--frames", type=int, default=1, help="DIAG_TRACEMALLOC_FRAMES; 0 — без tracemalloc")
+    p.add_argument("--top", type=int, default=8)
+    p.add_argument("--seed", type=int, default=1)
+    asyncio.run(run(p.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Прогон деградированного режима: база "падает" посреди живых диалогов.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.outage --dialogs 10 --messages 5
+
+1. Клиенты создают заявки, операторы берут их в работу (база жива).
+2. База становится недоступна. По умолчанию отказ имитируется в самом движке
+   (каждое новое соединение падает с OperationalError, пул сбрасывается);
+   --down-cmd / --up-cmd — настоящая остановка, например
+   --down-cmd "docker compose stop db" --up-cmd "docker compose start db".
+3. Обе стороны пишут --messages реплик: проверяем, что каждая дошла до собеседника
+   и что предохранитель разомкнулся.
+4. База возвращается: ждем, пока журнал зальется, и сверяем ticket_messages.
+Код выхода 1, если что-то потерялось.
+"""
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+import psycopg2
+from sqlalchemy import event, select, func
+from sqlalchemy.exc import OperationalError
+
+from bench.harness import Harness
+from bench.loadtest import CLAIM_RE, _is_text, _is_copy_from
+from src import texts
+from src.db import spool
+from src.db.base import engine, SessionLocal, breaker
+from src.db.models import TicketMessage
+from src.tasks import replayer
+
+_down = False
+
+
+@event.listens_for(engine, "do_connect")
+def _refuse(dialect, conn_rec, cargs, cparams):
+    if _down:
+        # так же, как psycopg2 отвечает на отказ в соединении
+        raise psycopg2.OperationalError("simulated outage: connection refused")
+
+
+def _set_down(down: bool, cmd: str | None) -> None:
+    global _down
+    if cmd:
+        subprocess.run(cmd, shell=True, check=True)
+    else:
+        _down = down
+    if down:
+        engine.dispose()
+
+
+async def _open_dialog(h: Harness, n: int) -> tuple[dict, dict, int]:
+    # свои id на каждый прогон: незакрытые диалоги прошлых прогонов не мешают
+    run = int(time.time()) % 100_000 * 1000
+    user = h.tg_user(2_000_000_000 + run + n, "Client")
+    op = h.tg_user(3_000_000_000 + run + n, "Operator")
+    await h.feed(h.text(user, "/start"))
+    await h.feed(h.callback(user, "other_start"))
+    await h.feed(h.text(user, "Не включается"))
+    await h.feed(h.callback(user, "other_done"))
+    card = await h.fake.wait_for(
+        h.operators_chat_id,
+        lambda m, p: m == "sendmessage" and f"TG ID: {user['id']}" in p.get("text", ""),
+        timeout=30,
+    )
+    tid = int(CLAIM_RE.search(str(card["reply_markup"])).group(1))  # type: ignore[union-attr]
+    await h.feed(h.callback(op, f"claim:{tid}", chat_id=h.operators_chat_id))
+    await h.fake.wait_for(user["id"], _is_text(texts.OP_CONNECTED), timeout=30)
+    h.fake.drain(op["id"])
+    h.fake.drain(user["id"])
+    return user, op, tid
+
+
+async def _chat(h: Harness, user: dict, op: dict, messages: int) -> int:
+    """Переписка во время отказа; возвращаем, сколько реплик не дошло."""
+    lost = 0
+    for i in range(messages):
+        for sender, peer in ((user, op), (op, user)):
+            await h.feed(h.text(sender, f"реплика {i} от {sender['id']}"))
+            try:
+                await h.fake.wait_for(peer["id"], _is_copy_from(sender["id"]), timeout=10)
+            except asyncio.TimeoutError:
+                lost += 1
+    return lost
+
+
+def _count(ticket_ids: list[int]) -> int:
+    with SessionLocal() as s:
+        return s.scalar(select(func.count()).select_from(TicketMessage)
+                        .where(TicketMessage.ticket_id.in_(ticket_ids))) or 0
+
+
+async def run(args) -> bool:
+    h = Harness()
+    await h.start()
+    try:
+        dialogs = [await _open_dialog(h, n) for n in range(args.dialogs)]
+        ticket_ids = [tid for _, _, tid in dialogs]
+        before = await asyncio.to_thread(_count, ticket_ids)
+        await asyncio.to_thread(replayer._load_routes)
+
+        _set_down(True, args.down_cmd)
+        t0 = time.perf_counter()
+        lost = sum(await asyncio.gather(*(_chat(h, u, o, args.messages) for u, o, _ in dialogs)))
+        outage_s = time.perf_counter() - t0
+        print(f"outage: {outage_s:.1f}s  breaker open: {breaker.is_open}  "
+              f"degraded relays: {spool.stats['degraded_relays']}  spooled: {spool.stats['spooled']}  "
+              f"not relayed: {lost}")
+
+        _set_down(False, args.up_cmd)
+        expected = before + 2 * args.messages * args.dialogs
+        t0 = time.perf_counter()
+        got = before
+        while time.perf_counter() - t0 < args.timeout:
+            try:
+                got = await asyncio.to_thread(_count, ticket_ids)
+            except OperationalError:
+                pass
+            if got >= expected:
+                break
+            await asyncio.sleep(0.5)
+        print(f"replay: {time.perf_counter() - t0:.1f}s  ticket_messages {got - before}/{expected - before}  "
+              f"replayed: {spool.stats['replayed']}  skipped: {spool.stats['replay_skipped']}")
+        return lost == 0 and got == expected
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.outage")
+    p.add_argument("--dialogs", type=int, default=5)
+    p.add_argument("--messages", type=int, default=5, help="реплик каждой стороны во время отказа")
+    p.add_argument("--down-cmd", help="команда, которая останавливает базу (по умолчанию — имитация)")
+    p.add_argument("--up-cmd", help="команда, которая поднимает базу обратно")
+    p.add_argument("--timeout", type=float, default=60, help="сколько ждать заливки журнала, с")
+    args = p.parse_args(argv)
+    ok = asyncio.run(run(args))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
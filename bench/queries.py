@@ -0,0 +1,171 @@
+"""
+Горячий путь прокси на ORM и на Core (src/db/queries.py): время и аллокации на вызов.
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.queries --calls 2000
+
+Заводим диалог (клиент, оператор, тикет ASSIGNED, --history сообщений клиента)
+и гоняем то, что хендлеры делают на каждую реплику, без отправки в Telegram:
+  - реплика оператора: upsert пользователя, поиск его диалога, tg_id клиента;
+  - реплика клиента: upsert, пользователь по tg_id, его диалог;
+  - claim: клиент тикета и его сообщения по порядку.
+ORM-вариант — как было в хендлерах до src/db/queries.py. Каждый вызов — своя
+сессия и commit, как в хендлере. Печатаем мкс CPU процесса (клиентская часть:
+сборка и компиляция SQL, разбор строк) и стену на вызов, пик памяти за вызов
+(tracemalloc, отдельным прогоном — он сам замедляет).
+Данные удаляются в конце.
+"""
+import argparse
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from sqlalchemy import select, delete
+
+from src.db.base import SessionLocal
+from src.db import queries
+from src.db.models import Ticket, TicketStatus, TicketMessage, User
+from src.db.users import upsert_user_from_tg
+
+USER_TG = 990_000_001
+OPERATOR_TG = 990_000_002
+
+
+def _seed(history: int) -> int:
+    with SessionLocal() as s:
+        _cleanup(s)
+        user = User(tg_id=USER_TG, first_name="Bench", username="bench_user")
+        op = User(tg_id=OPERATOR_TG, first_name="Op", username="bench_op", is_operator=True)
+        s.add_all([user, op])
+        s.flush()
+        t = Ticket(user_id=user.id, operator_tg_id=OPERATOR_TG, status=TicketStatus.assigned, kind="other")
+        s.add(t)
+        s.flush()
+        s.add_all(
+            TicketMessage(ticket_id=t.id, sender_tg_id=USER_TG, sender_type="user",
+                          tg_message_id=i, content_type="text", message_text=f"сообщение {i}")
+            for i in range(1, history + 1)
+        )
+        s.commit()
+        return t.id
+
+
+def _cleanup(s) -> None:
+    s.execute(delete(User).where(User.tg_id.in_([USER_TG, OPERATOR_TG])))
+    s.commit()
+
+
+# -------------------------
+# ORM — как было в хендлерах
+# -------------------------
+
+def orm_operator(tg) -> None:
+    with SessionLocal() as s:
+        upsert_user_from_tg(s, tg, mark_operator=False)
+        s.commit()
+        t = s.scalar(select(Ticket).where(Ticket.operator_tg_id == tg.id, Ticket.status == TicketStatus.assigned))
+        upsert_user_from_tg(s, tg, mark_operator=True)
+        s.commit()
+        t.user.tg_id  # type: ignore[union-attr]
+
+
+def orm_user(tg) -> None:
+    with SessionLocal() as s:
+        upsert_user_from_tg(s, tg, mark_operator=False)
+        s.commit()
+        t = s.scalar(select(Ticket).where(Ticket.operator_tg_id == tg.id, Ticket.status == TicketStatus.assigned))
+        user = s.scalar(select(User).where(User.tg_id == tg.id))
+        t = s.scalar(select(Ticket).where(Ticket.user_id == user.id, Ticket.status == TicketStatus.assigned))  # type: ignore[union-attr]
+        t.operator_tg_id  # type: ignore[union-attr]
+
+
+def orm_claim(ticket_id: int) -> None:
+    with SessionLocal() as s:
+        t = s.get(Ticket, ticket_id)
+        u = s.get(User, t.user_id)  # type: ignore[union-attr]
+        msgs = s.scalars(
+            select(TicketMessage)
+            .where(TicketMessage.ticket_id == ticket_id, TicketMessage.sender_type == "user")
+            .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc())
+        ).all()
+        [(m.content_type, m.tg_message_id) for m in msgs]
+        u.tg_id  # type: ignore[union-attr]
+
+
+# -------------------------
+# Core — src/db/queries.py
+# -------------------------
+
+def core_operator(tg) -> None:
+    with SessionLocal() as s:
+        d = queries.operator_dialog(s, tg.id)
+        queries.touch_user(s, tg, mark_operator=True)
+        s.commit()
+        d.user_tg_id  # type: ignore[union-attr]
+
+
+def core_user(tg) -> None:
+    with SessionLocal() as s:
+        queries.operator_dialog(s, tg.id)
+        queries.touch_user(s, tg)
+        d = queries.user_dialog(s, tg.id)
+        s.commit()
+        d.operator_tg_id  # type: ignore[union-attr]
+
+
+def core_claim(ticket_id: int) -> None:
+    with SessionLocal() as s:
+        u = queries.ticket_user(s, ticket_id)
+        [(m.content_type, m.tg_message_id) for m in queries.user_messages(s, ticket_id)]
+        u.tg_id  # type: ignore[union-attr]
+
+
+def _measure(fn, arg, calls: int) -> tuple[float, float, float]:
+    """(мкс CPU, мкс стены, пик памяти КиБ) на вызов."""
+    for _ in range(min(calls, 50)):  # прогрев: кэш компиляции, пул соединений
+        fn(arg)
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(calls):
+        fn(arg)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+
+    n = max(calls // 10, 1)
+    peak = 0
+    tracemalloc.start()
+    for _ in range(n):
+        base = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        fn(arg)
+        peak += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return cpu / calls * 1e6, wall / calls * 1e6, peak / n / 1024
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.queries")
+    p.add_argument("--calls", type=int, default=2000)
+    p.add_argument("--history", type=int, default=10, help="сообщений клиента в тикете (claim)")
+    args = p.parse_args(argv)
+
+    ticket_id = _seed(args.history)
+    op = SimpleNamespace(id=OPERATOR_TG, first_name="Op", username="bench_op")
+    user = SimpleNamespace(id=USER_TG, first_name="Bench", username="bench_user")
+    cases = [
+        ("реплика оператора", orm_operator, core_operator, op),
+        ("реплика клиента", orm_user, core_user, user),
+        ("claim: клиент и сообщения", orm_claim, core_claim, ticket_id),
+    ]
+    try:
+        print(f"{'':<28}{'CPU мкс':>18}{'стена мкс':>20}{'пик КиБ':>16}")
+        print(f"{'':<28}{'ORM → Core':>18}{'ORM → Core':>20}{'ORM → Core':>16}")
+        for name, orm_fn, core_fn, arg in cases:
+            o = _measure(orm_fn, arg, args.calls)
+            c = _measure(core_fn, arg, args.calls)
+            print(f"{name:<28}{o[0]:>9.0f} → {c[0]:<6.0f}{o[1]:>11.0f} → {c[1]:<6.0f}{o[2]:>8.1f} → {c[2]:<6.1f}")
+    finally:
+        with SessionLocal() as s:
+            _cleanup(s)
+
+
+if __name__ == "__main__":
+    main()
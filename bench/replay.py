@@ -0,0 +1,217 @@
+"""
+Воспроизведение записанного трафика (RECORD_UPDATES, src/middlewares/recorder.py).
+
+    POSTGRES_HOST=localhost POSTGRES_DB=care_bench POSTGRES_USER=... POSTGRES_PASSWORD=... \\
+        python -m bench.replay updates.jsonl.gz [updates.jsonl.gz.1 ...] --speed 0 --save replay.json
+
+Апдейты из записи идут в настоящие роутеры (bench/harness.py: заглушка Bot API,
+scratch-база) в порядке времени прихода:
+  --speed 1 — в реальном времени (паузы длиннее --max-gap сжимаются),
+  --speed 0 — так быстро, как получается.
+Порядок внутри одного чата сохраняется (ключ как у src/cluster.py), разные чаты
+идут параллельно — как в проде.
+
+Номера тикетов в scratch-базе другие, поэтому кнопки claim:/history:/finish:
+переписываются: номер, который в записи появился у апдейта, создавшего тикет,
+сопоставляется с номером, который получился при воспроизведении. Кнопку с еще не
+созданным тикетом придерживаем до --wait секунд.
+
+Отчет — как у bench.loadtest (--save / --compare / --tolerance), плюс для
+сравнения время тех же хендлеров в проде по записи.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import re
+import sys
+import time
+import zlib
+from collections import defaultdict
+
+from aiogram import BaseMiddleware
+
+from bench.harness import Harness, percentile
+from bench.loadtest import _print_report, compare
+from src.cluster import shard_key
+from src.config import settings
+from src.utils.logging import context
+
+TICKET_DATA = re.compile(r"^(claim|history|finish):(\d+)$")
+
+
+def load(paths: list[str]) -> tuple[list[dict], int | None]:
+    """Записи из всех файлов по времени и operators_chat_id из заголовков."""
+    records: list[dict] = []
+    chat_id = None
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        r = json.loads(line)
+                    except ValueError:
+                        continue  # оборванная последняя строка
+                    if "v" in r:
+                        chat_id = r.get("operators_chat_id", chat_id)
+                    else:
+                        records.append(r)
+            except (EOFError, zlib.error, gzip.BadGzipFile):
+                # процесс упал посреди записи — берем то, что успело сброситься
+                print(f"{path}: truncated, read {len(records)} records so far")
+    records.sort(key=lambda r: r["t"])
+    return records, chat_id
+
+
+class _TicketProbe(BaseMiddleware):
+    """Outer-middleware после UpdateContext: какой тикет получился у апдейта."""
+
+    def __init__(self):
+        self.tickets: dict[int, int | None] = {}
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            self.tickets[event.update_id] = context().get("ticket_id")
+
+
+class Replay:
+    def __init__(self, h: Harness, records: list[dict], wait: float):
+        self.h = h
+        self.records = records
+        self.wait = wait
+        self.probe = _TicketProbe()
+        self.ticket_map: dict[int, int] = {}
+        self._mapped: dict[int, asyncio.Event] = defaultdict(asyncio.Event)
+        self._locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.unmapped = 0
+        # тикеты, которые в записи создал обычный апдейт (а не кнопка с уже известным номером)
+        self._created: set[int] = set()
+        for r in records:
+            tid = r.get("tid")
+            if tid is None or tid in self._created:
+                continue
+            data = (r["u"].get("callback_query") or {}).get("data") or ""
+            m = TICKET_DATA.match(data)
+            if not (m and int(m.group(2)) == tid):
+                self._created.add(tid)
+
+    async def _rewrite(self, update: dict) -> None:
+        cq = update.get("callback_query")
+        m = TICKET_DATA.match(cq.get("data") or "") if cq else None
+        if not m:
+            return
+        old = int(m.group(2))
+        if old in self._created and old not in self.ticket_map:
+            try:
+                await asyncio.wait_for(self._mapped[old].wait(), self.wait)
+            except asyncio.TimeoutError:
+                pass
+        new = self.ticket_map.get(old)
+        if new is None:
+            self.unmapped += 1
+            return
+        cq["data"] = f"{m.group(1)}:{new}"
+
+    async def _one(self, update_id: int, r: dict) -> None:
+        update = {**r["u"], "update_id": update_id}
+        async with self._locks[shard_key(update)]:
+            await self._rewrite(update)
+            await self.h.feed(update)
+        old = r.get("tid")
+        new = self.probe.tickets.pop(update_id, None)
+        if old is not None and new is not None and old not in self.ticket_map:
+            self.ticket_map[old] = new
+            self._mapped[old].set()
+
+    async def run(self, speed: float, max_gap: float) -> float:
+        tasks = []
+        t0 = time.perf_counter()
+        due = 0.0
+        prev = self.records[0]["t"] if self.records else 0.0
+        for n, r in enumerate(self.records, 1):
+            if speed > 0:
+                due += min(r["t"] - prev, max_gap) / speed
+                prev = r["t"]
+                delay = t0 + due - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(self._one(n, r)))
+            if speed <= 0 and n % 100 == 0:
+                await asyncio.sleep(0)  # даем первым апдейтам стартовать, пока создаем остальные
+        await asyncio.gather(*tasks)
+        return time.perf_counter() - t0
+
+
+def recorded_handlers(records: list[dict]) -> dict[str, dict]:
+    """Время апдейтов в проде по записи (от Recorder до конца обработки), по хендлерам."""
+    times: dict[str, list[float]] = defaultdict(list)
+    for r in records:
+        times[r.get("h") or "unknown"].append(r["ms"])
+    return {
+        name: {"n": len(ts), "p50": percentile(ts, 50), "p95": percentile(ts, 95), "p99": percentile(ts, 99)}
+        for name, ts in sorted(times.items())
+    }
+
+
+async def run(args) -> dict:
+    records, chat_id = load(args.files)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        raise SystemExit("no records")
+    if chat_id is not None:
+        settings.operators_chat_id = chat_id
+    settings.record_updates = ""  # воспроизведение само не пишется
+    h = Harness(file_size=args.file_size)
+    await h.start()
+    try:
+        replay = Replay(h, records, args.wait)
+        h.dp.update.outer_middleware(replay.probe)  # type: ignore[union-attr]
+        wall = await replay.run(args.speed, args.max_gap)
+        result = h.metrics.summary(wall, h.fake, len(replay.ticket_map))
+        result["recorded_span_s"] = round(records[-1]["t"] - records[0]["t"], 3)
+        result["unmapped_tickets"] = replay.unmapped
+        result["recorded_handlers_ms"] = recorded_handlers(records)
+        return result
+    finally:
+        await h.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.replay")
+    p.add_argument("files", nargs="+", help="файлы RECORD_UPDATES (.jsonl.gz)")
+    p.add_argument("--speed", type=float, default=0.0, help="1 — реальное время, 0 — без пауз")
+    p.add_argument("--max-gap", type=float, default=60.0, help="паузы длиннее, с, сжимаются до этой")
+    p.add_argument("--limit", type=int, default=0, help="только первые N апдейтов")
+    p.add_argument("--wait", type=float, default=10.0, help="сколько ждать создания тикета для кнопки, с")
+    p.add_argument("--file-size", type=int, default=256 * 1024)
+    p.add_argument("--save", help="сохранить результат в json")
+    p.add_argument("--compare", help="сравнить с сохраненным json")
+    p.add_argument("--tolerance", type=float, default=0.2)
+    args = p.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    _print_report(result)
+    print(f"recorded span: {result['recorded_span_s']}s  unmapped ticket buttons: {result['unmapped_tickets']}")
+    print(f"{'recorded (prod) update ms':<28}{'n':>7}{'p50':>10}{'p95':>10}{'p99':>10}")
+    for name, s in result["recorded_handlers_ms"].items():
+        print(f"{name:<28}{s['n']:>7}{s['p50']:>10}{s['p95']:>10}{s['p99']:>10}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(result, json.load(f), args.tolerance)
+        for line in problems:
+            print("REGRESSION:", line)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
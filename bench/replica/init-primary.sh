@@ -0,0 +1,5 @@
+#!/bin/bash
+# Выполняется при первой инициализации primary (docker-entrypoint-initdb.d):
+# разрешаем реплике подключаться по протоколу репликации.
+set -e
+echo "host replication all all scram-sha-256" >> "$PGDATA/pg_hba.conf"
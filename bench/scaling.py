@@ -0,0 +1,86 @@
+"""
+Масштабирование по ядрам: та же синтетическая нагрузка через WorkerPool
+с 1, 2, ... N процессами-воркерами.
+
+    POSTGRES_DB=care_bench ... python -m bench.scaling --max-workers 4 --users 200
+
+Клиенты проходят intake (start -> гарантия -> текст -> фото -> отправить),
+каждый апдейт подтверждается воркером, меряем updates/s от первого
+апдейта до последнего подтверждения.
+"""
+import argparse
+import asyncio
+import multiprocessing as mp
+import time
+
+from bench.harness import Harness
+from src.cluster import WorkerPool
+from src.db.base import init_db
+from src.db.bootstrap import bootstrap_indexes_and_tables
+
+
+def _intake_updates(h: Harness, users: int, media: int, base_uid: int) -> list[dict]:
+    out: list[dict] = []
+    for i in range(users):
+        u = h.tg_user(base_uid + i, "Client")
+        out.append(h.text(u, "/start"))
+        out.append(h.callback(u, "warranty_start"))
+        out.append(h.text(u, "Не держит тепло, купили на WB"))
+        for _ in range(media):
+            out.append(h.photo(u))
+        out.append(h.callback(u, "warranty_done"))
+    return out
+
+
+async def _run_once(h: Harness, workers: int, updates: list[dict]) -> float:
+    done_q = mp.get_context("spawn").Queue()
+    pool = WorkerPool(workers, api_base=h.fake.base_url, done_q=done_q)
+    pool.start()
+    loop = asyncio.get_running_loop()
+    ready = 0
+    while ready < workers:
+        msg = await loop.run_in_executor(None, done_q.get)
+        ready += isinstance(msg, tuple)
+
+    t0 = time.perf_counter()
+    for raw in updates:
+        await pool.dispatch(raw)
+    acked = 0
+    while acked < len(updates):
+        acked += await loop.run_in_executor(None, done_q.get)
+    wall = time.perf_counter() - t0
+
+    await loop.run_in_executor(None, pool.stop)
+    return wall
+
+
+async def run(args) -> None:
+    init_db()
+    bootstrap_indexes_and_tables()
+    h = Harness(file_size=args.file_size)
+    await h.fake.start()
+    try:
+        base = None
+        print(f"{'workers':>8}{'updates':>10}{'wall, s':>10}{'upd/s':>10}{'speedup':>10}")
+        for n in range(1, args.max_workers + 1):
+            # у каждого прогона свои пользователи, чтобы не пересекаться по FSM и тикетам
+            updates = _intake_updates(h, args.users, args.media, base_uid=2_000_000 + n * 100_000)
+            wall = await _run_once(h, n, updates)
+            rate = len(updates) / wall
+            base = base or rate
+            print(f"{n:>8}{len(updates):>10}{wall:>10.2f}{rate:>10.1f}{rate / base:>10.2f}")
+    finally:
+        await h.fake.stop()
+
+
+def main(argv=None) -> None:
+    p = argparse.ArgumentParser(prog="python -m bench.scaling")
+    p.add_argument("--max-workers", type=int, default=mp.cpu_count())
+    p.add_argument("--users", type=int, default=100)
+    p.add_argument("--media", type=int, default=2)
+    p.add_argument("--file-size", type=int, default=64 * 1024)
+    asyncio.run(run(p.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,2 @@
-import phonenumbers
-from src.config import settings
-
-def normalize_phone(raw: str) -> str | None:
-    try:
-        num = phonenumbers.parse(raw, settings.default_region)
-        if phonenumbers.is_valid_number(num):
-            return phonenumbers.format_number(num, phonenumbers.PhoneNumberFormat.E164)
-        return None
-    except Exception:
-        return None
+# перенесено в src/utils/phone.py (ленивый импорт phonenumbers + кэш)
+from src.utils.phone import normalize_phone, normalize_many  # noqa: F401
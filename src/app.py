@@ -2,24 +2,121 @@ import asyncio
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.filters import ExceptionTypeFilter
+from aiogram.types import ErrorEvent
+from sqlalchemy.exc import OperationalError
+from src import texts, lifecycle, diagnostics
 from src.config import settings
-from src.db.base import init_db
+from src.db.base import engine
 from src.routers import public, operators, proxy
-from src.utils.logging import setup_logging
-from src.db.bootstrap import bootstrap_indexes_and_tables
+from src.utils.logging import setup_logging, log_slow_queries
+from src.utils.tg_session import TunedSession
+from src.middlewares.log_context import UpdateContext, HandlerContext
+from src.middlewares import antiflood, recorder
+from src.middlewares.dedup import RecentUpdates
+from src.db.bootstrap import ensure_schema
+from src.utils import media_post
+from src.tasks import reaper, media_store, outbox, replayer, cards
+from src.db import notify, cache
 
-async def main():
-    setup_logging()
-    init_db() # если нет таблиц, то создаст их, а если есть то все в покое
-    bootstrap_indexes_and_tables()
-    bot = Bot(token=settings.bot_token, 
-              default=DefaultBotProperties(parse_mode=ParseMode.HTML)
-              )
+
+def build_bot(api_base: str | None = None) -> Bot:
+    """
+    api_base — адрес другого Bot API сервера (заглушка в bench/).
+    Без него — TG_API_BASE из настроек (свой telegram-bot-api) или api.telegram.org.
+    """
+    if api_base:
+        session = TunedSession(api_base)
+    else:
+        session = TunedSession(settings.tg_api_base, local=settings.tg_api_local)
+    return Bot(token=settings.bot_token,
+               session=session,
+               default=DefaultBotProperties(parse_mode=ParseMode.HTML)
+               )
+
+
+async def _on_db_down(event: ErrorEvent) -> None:
+    """
+    База недоступна, а хендлеру без нее никак (создать тикет, взять в работу...).
+    Состояние FSM не трогаем — пользователь просто повторит действие.
+    Реплики диалога и сообщения intake сюда не попадают: они уходят в src/db/spool.py.
+    """
+    u = event.update
+    try:
+        if u.callback_query:
+            await u.callback_query.answer(texts.DB_UNAVAILABLE, show_alert=True)
+        elif u.message:
+            await u.message.answer(texts.DB_UNAVAILABLE)
+    except Exception:
+        pass
+
+
+def build_dispatcher() -> Dispatcher:
     dp = Dispatcher()
+    # что в обработке: при остановке дожидаемся или сохраняем (src/lifecycle.py)
+    dp.update.outer_middleware(lifecycle.InFlight())
+    # повторно доставленный апдейт — мимо хендлеров
+    dp.update.outer_middleware(RecentUpdates())
+    # контекст логов: update_id / chat_id / ticket_id / имя хендлера
+    dp.update.outer_middleware(UpdateContext())
+    # запись трафика для bench/replay.py — внутри UpdateContext: нужен ticket_id из контекста
+    if settings.record_updates:
+        dp.update.outer_middleware(recorder.Recorder())
+    dp.message.middleware(HandlerContext())
+    dp.callback_query.middleware(HandlerContext())
+    # лимит сообщений на пользователя: intake и переписка с оператором
+    antiflood.protect(public.router, "public")
+    antiflood.protect(proxy.router, "proxy")
     dp.include_router(public.router)
     dp.include_router(operators.router)
     dp.include_router(proxy.router)
-    await dp.start_polling(bot)
+    dp.errors.register(_on_db_down, ExceptionTypeFilter(OperationalError))
+    dp.startup.register(outbox.start)
+    dp.startup.register(reaper.start)
+    dp.startup.register(media_store.start)
+    dp.startup.register(replayer.start)
+    dp.startup.register(cards.start)
+    dp.startup.register(cache.start)
+    dp.startup.register(recorder.start)
+    dp.startup.register(diagnostics.start)
+    # последним: прогрев, недоделанное прошлым процессом, ready
+    dp.startup.register(lifecycle.start)
+    # первым: дожидаемся начатого, пока остальные еще работают
+    dp.shutdown.register(lifecycle.drain)
+    dp.shutdown.register(cards.stop)
+    dp.shutdown.register(recorder.stop)
+    dp.shutdown.register(diagnostics.stop)
+    dp.shutdown.register(outbox.stop)
+    dp.shutdown.register(notify.stop)
+    dp.shutdown.register(cache.stop)
+    dp.shutdown.register(reaper.stop)
+    dp.shutdown.register(media_store.stop)
+    dp.shutdown.register(replayer.stop)
+    dp.shutdown.register(media_post.shutdown)
+    dp.shutdown.register(lifecycle.stopped)
+    return dp
+
+
+async def main():
+    setup_logging()
+    log_slow_queries(engine)
+    # /healthz отвечает уже во время старта, /readyz — после прогрева
+    await lifecycle.start_health()
+    try:
+        # таблицы и индексы — только если модели поменялись с прошлого старта
+        await asyncio.to_thread(ensure_schema, settings.bootstrap_always)
+        bot = build_bot()
+
+        if settings.workers > 1:
+            # один процесс читает getUpdates и раздает апдейты воркерам по chat id
+            from src.cluster import run_supervisor
+            await run_supervisor(bot, settings.workers)
+            return
+
+        dp = build_dispatcher()
+        await dp.start_polling(bot)
+    finally:
+        await lifecycle.stop_health()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,267 @@
+"""
+Горизонтальное масштабирование на несколько ядер.
+
+Супервизор (этот процесс) один читает getUpdates и раскладывает апдейты
+по N процессам-воркерам. Воркер выбирается консистентным хэшированием
+по chat id (для callback — по id нажавшего), поэтому все апдейты одного
+пользователя попадают в один процесс: FSM в памяти и порядок реплик
+в диалоге сохраняются. Внутри воркера апдейты одного чата
+обрабатываются строго по очереди, разные чаты — параллельно.
+
+Общее состояние у процессов только в Postgres.
+
+Включается через WORKERS=N в .env (по умолчанию 1 — обычный polling).
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import multiprocessing as mp
+import queue
+import signal
+import time
+from collections import defaultdict
+
+from aiogram import Bot
+
+from src.config import settings
+
+log = logging.getLogger(__name__)
+
+VNODES = 64
+POLL_TIMEOUT = 25
+WORKERS_READY_S = 120
+
+
+def _h(s: str) -> int:
+    return int.from_bytes(hashlib.blake2b(s.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    Консистентное хэширование с виртуальными узлами:
+    при изменении числа воркеров переезжает ~1/N чатов, а не все.
+    """
+
+    def __init__(self, nodes: int, vnodes: int = VNODES):
+        ring = sorted((_h(f"{n}:{v}"), n) for n in range(nodes) for v in range(vnodes))
+        self._keys = [k for k, _ in ring]
+        self._nodes = [n for _, n in ring]
+
+    def node(self, key: int) -> int:
+        i = bisect.bisect(self._keys, _h(str(key))) % len(self._keys)
+        return self._nodes[i]
+
+
+def shard_key(update: dict) -> int:
+    """
+    Ключ шардирования для сырого апдейта.
+    Сообщения — по чату, callback — по пользователю (в личке это тот же chat id,
+    а claim-кнопки из операторского чата не сваливаются все в один воркер).
+    """
+    cq = update.get("callback_query")
+    if cq:
+        return cq["from"]["id"]
+    for kind in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        ev = update.get(kind)
+        if ev:
+            return ev["chat"]["id"]
+    for ev in update.values():
+        if isinstance(ev, dict) and isinstance(ev.get("from"), dict):
+            return ev["from"]["id"]
+    return 0
+
+
+# -------------------------
+# воркер
+# -------------------------
+
+def worker_main(idx: int, q, api_base: str | None = None, done_q=None, ready=None) -> None:
+    # останавливает супервизор (None в очередь), Ctrl+C по группе процессов воркеры не рвет
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(_worker(idx, q, api_base, done_q, ready))
+
+
+async def _worker(idx: int, q, api_base: str | None, done_q, ready=None) -> None:
+    from src import lifecycle
+    from src.app import build_bot, build_dispatcher
+    from src.db.base import engine
+    from src.utils.logging import setup_logging, log_slow_queries
+
+    setup_logging(worker=idx)
+    log_slow_queries(engine)
+    bot = build_bot(api_base)
+    dp = build_dispatcher()
+    dp["worker_index"] = idx
+    await dp.emit_startup(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+    log.info("worker %s started", idx)
+    if ready is not None:
+        ready.set()
+    if done_q is not None:
+        done_q.put(("ready", idx))
+
+    loop = asyncio.get_running_loop()
+    locks: dict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+    pending: dict[int, int] = defaultdict(int)
+    tasks: set[asyncio.Task] = set()
+
+    async def handle(raw: dict, key: int) -> None:
+        # asyncio.Lock честный (FIFO) — апдейты одного чата идут в порядке поступления
+        async with locks[key]:
+            # останавливаемся — не начатый апдейт остается в lifecycle.queued и уйдет на диск
+            if lifecycle.accepting():
+                lifecycle.queued.pop(raw["update_id"], None)
+                try:
+                    await dp.feed_raw_update(bot, raw)
+                except Exception:
+                    log.exception("worker %s: update %s failed", idx, raw.get("update_id"))
+        pending[key] -= 1
+        if not pending[key]:
+            del pending[key]
+            locks.pop(key, None)
+        if done_q is not None:
+            done_q.put_nowait(1)
+
+    try:
+        while True:
+            raw = await loop.run_in_executor(None, q.get)
+            if raw is None:
+                break
+            key = shard_key(raw)
+            lifecycle.queued[raw["update_id"]] = raw
+            pending[key] += 1
+            t = asyncio.create_task(handle(raw, key))
+            tasks.add(t)
+            t.add_done_callback(tasks.discard)
+    finally:
+        # lifecycle.drain дождется начатых апдейтов, остальное сохранит
+        await dp.emit_shutdown(bot=bot, dispatcher=dp, bots=[bot], **dp.workflow_data)
+        for t in tasks:
+            t.cancel()
+        await bot.session.close()
+        log.info("worker %s stopped", idx)
+
+
+class WorkerPool:
+    """N процессов-воркеров + раздача апдейтов по кольцу."""
+
+    def __init__(self, workers: int, api_base: str | None = None, done_q=None):
+        self.ctx = mp.get_context("spawn")
+        self.ring = HashRing(workers)
+        self.api_base = api_base
+        self.done_q = done_q
+        self.queues = [self.ctx.Queue(maxsize=10_000) for _ in range(workers)]
+        self.ready = [self.ctx.Event() for _ in range(workers)]
+        self.procs: list = [None] * workers
+
+    def _spawn(self, idx: int):
+        p = self.ctx.Process(
+            target=worker_main,
+            args=(idx, self.queues[idx], self.api_base, self.done_q, self.ready[idx]),
+            name=f"bot-worker-{idx}",
+            daemon=False,
+        )
+        p.start()
+        self.procs[idx] = p
+
+    def start(self) -> None:
+        for i in range(len(self.queues)):
+            self._spawn(i)
+
+    def wait_ready(self, timeout: float) -> bool:
+        """Все воркеры прошли startup (в т.ч. прогрев lifecycle.start)."""
+        deadline = time.monotonic() + timeout
+        return all(e.wait(max(0.0, deadline - time.monotonic())) for e in self.ready)
+
+    def respawn_dead(self) -> None:
+        for i, p in enumerate(self.procs):
+            if p is not None and not p.is_alive():
+                log.error("worker %s died with code %s, restarting", i, p.exitcode)
+                self._spawn(i)
+
+    async def dispatch(self, raw: dict) -> None:
+        q = self.queues[self.ring.node(shard_key(raw))]
+        try:
+            q.put_nowait(raw)
+        except queue.Full:
+            # воркер не успевает — ждем, тем самым притормаживаем getUpdates
+            await asyncio.get_running_loop().run_in_executor(None, q.put, raw)
+
+    def stop(self, timeout: float | None = None) -> None:
+        if timeout is None:
+            # воркеру нужно DRAIN_TIMEOUT_S на drain и немного на остальные shutdown-хуки
+            timeout = settings.drain_timeout_s + 10
+        for q in self.queues:
+            q.put(None)
+        for p in self.procs:
+            if p is not None:
+                p.join(timeout)
+                if p.is_alive():
+                    p.terminate()
+
+
+async def run_supervisor(bot: Bot, workers: int) -> None:
+    from src import lifecycle
+
+    # недоделанное и FSM прошлого запуска читают все воркеры (каждый свои чаты);
+    # удаляем, когда все прочитали — иначе следующий рестарт прогонит их еще раз
+    spooled = lifecycle.spool_files()
+    pool = WorkerPool(workers)
+    pool.start()
+    log.info("supervisor: %s workers", workers)
+
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+
+    def on_signal() -> None:
+        lifecycle.set_state("draining")
+        stop.set()
+
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, on_signal)
+        except NotImplementedError:  # windows
+            pass
+
+    # getUpdates — только когда все воркеры прогрелись: после раскатки нет всплеска задержек
+    if not await loop.run_in_executor(None, pool.wait_ready, WORKERS_READY_S):
+        log.warning("supervisor: not all workers ready after %ss, polling anyway", WORKERS_READY_S)
+    else:
+        for path in spooled:
+            path.unlink(missing_ok=True)
+    if not stop.is_set():
+        lifecycle.set_state("ready")
+
+    await bot.delete_webhook(drop_pending_updates=False)
+    offset: int | None = None
+    try:
+        while not stop.is_set():
+            poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=POLL_TIMEOUT))
+            stopper = asyncio.create_task(stop.wait())
+            await asyncio.wait({poll, stopper}, return_when=asyncio.FIRST_COMPLETED)
+            stopper.cancel()
+            if not poll.done():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception:
+                log.exception("getUpdates failed")
+                await asyncio.sleep(1)
+                continue
+
+            for u in updates:
+                await pool.dispatch(u.model_dump(mode="json", by_alias=True, exclude_none=True))
+                offset = u.update_id + 1
+            pool.respawn_dead()
+    finally:
+        # подтверждаем последний offset, чтобы после рестарта не получить апдейты повторно
+        if offset is not None:
+            try:
+                await bot.get_updates(offset=offset, timeout=0, limit=1)
+            except Exception:
+                pass
+        await loop.run_in_executor(None, pool.stop)
+        await bot.session.close()
+        lifecycle.set_state("stopped")
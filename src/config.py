@@ -8,15 +8,110 @@ class Settings(BaseSettings):
     postgres_db: str
     postgres_user: str
     postgres_password: str
+    # необязательная read-реплика (та же база и пользователь); пусто — все идет в primary
+    postgres_replica_host: str | None = None
+    postgres_replica_port: int | None = None
+    replica_max_lag_s: float = 5.0    # больше — читаем с primary
+    replica_lag_check_s: float = 2.0  # как часто перепроверять отставание
     default_region: str = "RU"
     media_root: str = "media"
+    media_backend: str = "local"    # local | s3 (см. src/utils/storage.py)
+    s3_endpoint_url: str | None = None  # для MinIO/Yandex и т.п.; пусто — AWS
+    s3_region: str | None = None
+    s3_bucket: str = ""
+    s3_prefix: str = ""
+    s3_access_key: str | None = None
+    s3_secret_key: str | None = None
     store_media_local: bool = True 
+    media_workers: int = 2  # процессы для превью/хэшей, 0 — выключить постобработку
+    media_quota_mb: int = 0         # лимит media_root, 0 — без лимита
+    media_gc_interval_s: int = 600  # как часто проверять квоту
+    transcript_cache_mb: int = 512  # кэш фрагментов html-истории (media_root/_transcripts), 0 — без лимита
+    workers: int = 1        # процессов-обработчиков апдейтов (>1 — супервизор + шардирование по чатам)
 
+    # сессия к Bot API (src/utils/tg_session.py)
+    tg_api_base: str | None = None    # свой telegram-bot-api, например http://telegram-bot-api:8081
+    tg_api_local: bool = False        # сервер запущен с --local: файлы берем прямо с диска
+    tg_api_server_dir: str = "/var/lib/telegram-bot-api"  # рабочая папка сервера (как ее видит сервер)
+    tg_api_files_dir: str | None = None  # она же у бота, если смонтирована по другому пути
+    tg_api_ingest: str = "link"       # link — жесткая ссылка (или копия, если другой диск), move — перенос
+    tg_conn_limit: int = 100          # одновременных соединений
+    tg_keepalive_s: float = 60        # сколько держать простаивающее соединение
+    tg_dns_ttl_s: int = 600
+    tg_connect_timeout_s: float = 10
+    tg_request_timeout_s: float = 60
+    get_file_cache_ttl_s: int = 3000  # ссылка из getFile живет не меньше часа
 
-    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8')
+    # логи (src/utils/logging.py)
+    log_level: str = "INFO"
+    log_format: str = "json"        # json | text
+    log_sample: str = "aiogram.event=0.1,src.routers.proxy=0.1"  # логгер=доля для записей ниже WARNING
+    log_slow_update_ms: int = 1000  # апдейт дольше — warning, 0 — выключить
+    log_slow_query_ms: int = 200    # SQL дольше — warning, 0 — выключить
+
+    # деградированный режим при недоступной базе (src/db/spool.py)
+    db_connect_timeout_s: int = 5
+    db_breaker_failures: int = 3     # столько ошибок соединения подряд — считаем базу лежащей
+    db_breaker_reset_s: float = 10   # как часто пробовать снова
+    spool_dir: str = "spool"         # журнал реплик, пока базы нет; должен переживать рестарт
+    spool_fsync_ms: int = 50         # fsync пачкой раз в столько мс
+    spool_replay_s: int = 5          # как часто проверять, не пора ли залить журнал в базу
+
+    # outbox: доставка уведомлений операторам и реплик диалога (src/tasks/outbox.py)
+    outbox_concurrency: int = 8    # сколько чатов доставляем параллельно
+    outbox_sweep_s: int = 30       # досмотр таблицы на случай потерянных NOTIFY
+    outbox_max_attempts: int = 10
+    outbox_keep_days: int = 7
+    outbox_lease_s: int = 60       # аренда очереди чата одним экземпляром (два бота не шлют одно и то же)
+    card_edit_debounce_ms: int = 500  # правки карточек тикетов копятся столько и уходят пачкой
+
+    # reaper: закрытие брошенных intake и заглохших диалогов (0 — выключить)
+    reaper_interval_s: int = 300
+    reaper_intake_ttl_h: int = 24
+    reaper_idle_ttl_h: int = 72
+    reaper_batch: int = 200
+
+    # антифлуд (src/middlewares/antiflood.py)
+    flood_limits: str = "public=1/5,proxy=2/10"  # роутер=сообщений в секунду/пачка, off — выключить
+    flood_max_delay_s: float = 10   # дольше ждать очереди не даем — сообщение выбрасывается
+    flood_idle_s: int = 300         # как часто забывать затихших пользователей
+    dedup_updates: int = 10_000     # сколько последних update_id помнить, чтобы отбросить повторы
+
+    # кэши в памяти процесса, сброс между процессами через NOTIFY (src/db/cache.py)
+    cache_ttl_s: int = 300          # страховка от пропущенного сброса; 0 — не кэшировать
+    cache_size: int = 10_000        # ключей в каждом кэше
+
+    # жизненный цикл (src/lifecycle.py)
+    drain_timeout_s: int = 20       # SIGTERM: столько ждем начатые апдейты и отправки, остальное — на диск
+    health_host: str = "0.0.0.0"
+    health_port: int = 0            # /healthz, /readyz; 0 — не поднимать
+    bootstrap_always: bool = False  # гонять DDL на каждом старте, даже если схема не менялась
+
+    # запись апдейтов для python -m bench.replay (src/middlewares/recorder.py)
+    record_updates: str = ""        # путь к .jsonl.gz; пусто — не писать
+    record_salt: str = ""           # соль для хэшей id и имен; пусто — случайная на процесс
+    record_max_mb: int = 500        # больше — запись останавливается
+
+    # диагностика памяти (src/diagnostics.py)
+    diag_port: int = 0              # /debug/memory; 0 — не поднимать; воркер N — diag_port + N
+    diag_host: str = "127.0.0.1"    # только локально: наружу не светим
+    diag_tracemalloc_frames: int = 0  # глубина стека tracemalloc; 0 — выключен, 1 — дешево
+    diag_snapshot_s: int = 300      # как часто снимать снимок tracemalloc и писать RSS в лог
+    diag_trace_window_s: int = 10   # tracemalloc пишет только столько секунд из DIAG_SNAPSHOT_S; 0 — все время
+
+
+    # пустые строки из .env (KEY=) считаем незаданными -> берется значение по умолчанию
+    model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', env_ignore_empty=True)
 
     @property
     def dsn(self) -> str:
         return f"postgresql+psycopg2://{self.postgres_user}:{self.postgres_password}@{self.postgres_host}:{self.postgres_port}/{self.postgres_db}"
 
+    @property
+    def replica_dsn(self) -> str | None:
+        if not self.postgres_replica_host:
+            return None
+        port = self.postgres_replica_port or self.postgres_port
+        return f"postgresql+psycopg2://{self.postgres_user}:{self.postgres_password}@{self.postgres_replica_host}:{port}/{self.postgres_db}"
+
 settings = Settings()
@@ -1,10 +1,173 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import logging
+import threading
+import time
+
+from sqlalchemy import create_engine, event, text
+from sqlalchemy.orm import sessionmaker, Session
 from .models import Base
 from src.config import settings
 
-engine = create_engine(settings.dsn, pool_pre_ping=True)
+log = logging.getLogger(__name__)
+
+# connect_timeout: недоступная база (хост не отвечает) не должна вешать хендлер надолго
+engine = create_engine(settings.dsn, pool_pre_ping=True,
+                       connect_args={"connect_timeout": settings.db_connect_timeout_s})
 SessionLocal = sessionmaker(bind=engine, expire_on_commit=False)
 
-def init_db():
-    Base.metadata.create_all(engine)
+
+class CircuitBreaker:
+    """
+    Предохранитель вокруг engine. DB_BREAKER_FAILURES подряд ошибок соединения —
+    размыкаемся: allow() отвечает False, и хендлеры сразу уходят в деградированный
+    режим (src/db/spool.py), не дожидаясь таймаутов. Раз в DB_BREAKER_RESET_S
+    пропускаем одну пробу; удалась — замыкаемся обратно.
+    """
+
+    def __init__(self, failures: int, reset_s: float):
+        self.failures = failures
+        self.reset_s = reset_s
+        self._lock = threading.Lock()
+        self._fails = 0
+        self._retry_at: float | None = None  # None — замкнут, база доступна
+
+    @property
+    def is_open(self) -> bool:
+        return self._retry_at is not None
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._retry_at is None:
+                return True
+            now = time.monotonic()
+            if now < self._retry_at:
+                return False
+            self._retry_at = now + self.reset_s  # одна проба за период
+            return True
+
+    def success(self) -> None:
+        if self._fails == 0 and self._retry_at is None:
+            return
+        with self._lock:
+            if self._retry_at is not None:
+                log.warning("database is back, leaving degraded mode")
+            self._fails = 0
+            self._retry_at = None
+
+    def failure(self) -> None:
+        with self._lock:
+            self._fails += 1
+            if self._retry_at is None and self._fails >= self.failures:
+                log.warning("database unreachable, degraded mode for at least %.0fs", self.reset_s)
+                self._retry_at = time.monotonic() + self.reset_s
+            elif self._retry_at is not None:
+                self._retry_at = time.monotonic() + self.reset_s
+
+
+breaker = CircuitBreaker(settings.db_breaker_failures, settings.db_breaker_reset_s)
+
+
+@event.listens_for(engine, "handle_error")
+def _on_db_error(ctx) -> None:
+    # считаем только проблемы со связью: не подключились или соединение порвалось,
+    # ошибки в самих запросах предохранитель не трогают
+    if ctx.is_disconnect or ctx.connection is None:
+        breaker.failure()
+
+
+@event.listens_for(engine, "checkout")
+def _on_checkout(dbapi_conn, record, proxy) -> None:
+    # pool_pre_ping уже проверил соединение — база отвечает
+    breaker.success()
+
+
+def db_available() -> bool:
+    """Стоит ли сейчас идти в базу (см. CircuitBreaker)."""
+    return breaker.allow()
+
+# необязательная реплика для тяжелого чтения (история, поиск, выгрузки)
+replica_engine = create_engine(settings.replica_dsn, pool_pre_ping=True) if settings.replica_dsn else None
+ReplicaSessionLocal = sessionmaker(bind=replica_engine, expire_on_commit=False) if replica_engine else None
+
+replica_stats = {
+    "replica_reads": 0,
+    "primary_fallbacks": 0,
+    "lag_s": None,
+}
+
+# сравниваем с primary, а не receive == replay: при оборванном потоке WAL они
+# равны, и стоящая реплика выглядела бы догнавшей. Проиграла все, что было на
+# primary к моменту проверки, — отставания нет, даже если последняя транзакция
+# была давно; иначе — время с последней проигранной (NULL — неизвестно, считаем
+# отстающей). primary лежит — писать некуда, достаточно проиграть все принятое.
+# Не реплика (pg_is_in_recovery = false) — 0.
+_PRIMARY_LSN_SQL = text("SELECT pg_current_wal_lsn()::text")
+_LAG_SQL = text("""
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_replay_lsn() >= COALESCE(CAST(:primary_lsn AS pg_lsn), pg_last_wal_receive_lsn()) THEN 0
+        ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+    END
+""")
+
+_lag_lock = threading.Lock()
+_lag_checked_at = 0.0
+_replica_ok = False
+
+
+def _measure_lag() -> float:
+    # сначала primary: все, что закоммичено до проверки, реплика должна уже проиграть
+    primary_lsn = None
+    if not breaker.is_open:
+        try:
+            with engine.connect() as conn:
+                primary_lsn = conn.execute(_PRIMARY_LSN_SQL).scalar()
+        except Exception as e:
+            log.warning("replica check: primary unreachable, comparing with received WAL: %s", e)
+    with replica_engine.connect() as conn:
+        lag = conn.execute(_LAG_SQL, {"primary_lsn": primary_lsn}).scalar()
+    return float("inf") if lag is None else float(lag)
+
+
+def replica_usable() -> bool:
+    """
+    Можно ли сейчас читать с реплики. Отставание меряем не чаще,
+    чем раз в REPLICA_LAG_CHECK_S; реплика недоступна — считаем, что отстает.
+    """
+    global _lag_checked_at, _replica_ok
+    if replica_engine is None:
+        return False
+    with _lag_lock:
+        now = time.monotonic()
+        if now - _lag_checked_at < settings.replica_lag_check_s:
+            return _replica_ok
+        _lag_checked_at = now
+        try:
+            lag = _measure_lag()
+        except Exception as e:
+            lag = None
+            if _replica_ok:
+                log.warning("replica check failed, reading from primary: %s", e)
+        ok = lag is not None and lag <= settings.replica_max_lag_s
+        if ok != _replica_ok and lag is not None:
+            log.info("replica lag %.1fs -> reading from %s", lag, "replica" if ok else "primary")
+        replica_stats["lag_s"] = lag
+        _replica_ok = ok
+        return ok
+
+
+def read_session() -> Session:
+    """
+    Сессия только для чтения, где не страшно отстать на пару секунд.
+    Реплика, если она настроена и не отстает больше REPLICA_MAX_LAG_S, иначе primary.
+    Писать через нее нельзя.
+    """
+    if replica_usable():
+        replica_stats["replica_reads"] += 1
+        return ReplicaSessionLocal()
+    if replica_engine is not None:
+        replica_stats["primary_fallbacks"] += 1
+    return SessionLocal()
+
+
+def init_db(bind=None):
+    Base.metadata.create_all(bind or engine)
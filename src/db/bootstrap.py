@@ -1,5 +1,17 @@
+import hashlib
+import logging
+
 from sqlalchemy import text
-from .base import engine
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex, CreateTable
+
+from .base import engine, init_db
+from .models import Base
+
+log = logging.getLogger(__name__)
+
+# ключ advisory lock: два процесса, стартующие при раскатке, не гоняют DDL одновременно
+SCHEMA_LOCK = 0x73636865
 
 DDL = """
 ALTER TABLE ticket_messages
@@ -26,7 +38,13 @@ ALTER TABLE message_attachments
   ADD COLUMN IF NOT EXISTS ticket_id int;
 CREATE INDEX IF NOT EXISTS ix_message_attachments_ticket_id ON message_attachments(ticket_id);
 
-CREATE INDEX IF NOT EXISTS ix_msg_att_msg ON message_attachments(ticket_message_id);
+-- постобработка медиа: превью, перцептивный хэш
+ALTER TABLE message_attachments
+  ADD COLUMN IF NOT EXISTS size int,
+  ADD COLUMN IF NOT EXISTS thumb_path varchar(512),
+  ADD COLUMN IF NOT EXISTS phash varchar(16),
+  ADD COLUMN IF NOT EXISTS processed_at timestamp without time zone;
+CREATE INDEX IF NOT EXISTS ix_message_attachments_phash ON message_attachments(phash);
 
 -- доп. столбцы в users
 ALTER TABLE users
@@ -35,10 +53,133 @@ ALTER TABLE users
   ADD COLUMN IF NOT EXISTS last_seen  timestamp without time zone NOT NULL DEFAULT now();
 
 CREATE INDEX IF NOT EXISTS ix_users_is_operator ON users(is_operator);
+
+-- момент claim (reaper считает простой диалога от него)
+ALTER TABLE tickets
+  ADD COLUMN IF NOT EXISTS claimed_at timestamp without time zone;
+
+-- карточка тикета в операторском чате: ее правим при claim / закрытии
+ALTER TABLE tickets
+  ADD COLUMN IF NOT EXISTS card_chat_id bigint,
+  ADD COLUMN IF NOT EXISTS card_message_id bigint;
+
+-- тип обращения (для SLA-статистики)
+ALTER TABLE tickets
+  ADD COLUMN IF NOT EXISTS kind varchar(16);
+
+-- телефон из присланного контакта
+ALTER TABLE users
+  ADD COLUMN IF NOT EXISTS phone varchar(32),
+  ADD COLUMN IF NOT EXISTS phone_e164 varchar(16);
+CREATE INDEX IF NOT EXISTS ix_users_phone_e164 ON users(phone_e164);
+
+-- аренда очереди outbox (два экземпляра бота не доставляют одну строку)
+ALTER TABLE outbox
+  ADD COLUMN IF NOT EXISTS locked_by varchar(64),
+  ADD COLUMN IF NOT EXISTS locked_until timestamp without time zone;
 """
 
+# блоки, которые нельзя резать по ";" — выполняются целиком
+DO_BLOCKS = [
+    # момент отправки карточки операторам (по нему reaper отличает брошенный intake).
+    # для уже существующих тикетов карточки считаем отправленными.
+    """
+    DO $$
+    BEGIN
+      IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'tickets' AND column_name = 'notified_at'
+      ) THEN
+        ALTER TABLE tickets ADD COLUMN notified_at timestamp without time zone;
+        UPDATE tickets SET notified_at = created_at;
+      END IF;
+    END $$
+    """,
+    # уникальный ключ реплики; дубли, накопившиеся до него, удаляем (оставляем первую)
+    """
+    DO $$
+    BEGIN
+      IF NOT EXISTS (SELECT 1 FROM pg_indexes
+                     WHERE schemaname = current_schema() AND indexname = 'ux_ticket_messages_key') THEN
+        DELETE FROM ticket_messages a
+          USING ticket_messages b
+          WHERE a.ticket_id = b.ticket_id
+            AND a.sender_tg_id = b.sender_tg_id
+            AND a.tg_message_id = b.tg_message_id
+            AND a.id > b.id;
+        CREATE UNIQUE INDEX ux_ticket_messages_key
+          ON ticket_messages(ticket_id, sender_tg_id, tg_message_id);
+      END IF;
+    END $$
+    """,
+]
 
-def bootstrap_indexes_and_tables() -> None:
-    with engine.begin() as conn:
+
+# индексы под горячие запросы (проверка планов: python -m bench.explain);
+# после DO_BLOCKS — ix_tickets_intake нужен notified_at
+INDEXES = """
+CREATE INDEX IF NOT EXISTS ix_ticket_messages_ticket_created ON ticket_messages(ticket_id, created_at, id);
+CREATE INDEX IF NOT EXISTS ix_tickets_operator_assigned ON tickets(operator_tg_id) WHERE status = 'assigned';
+CREATE INDEX IF NOT EXISTS ix_tickets_intake ON tickets(created_at) WHERE status = 'waiting' AND notified_at IS NULL;
+CREATE INDEX IF NOT EXISTS ix_message_attachments_ticket_message_id ON message_attachments(ticket_message_id);
+
+-- лишние: покрыты ix_ticket_messages_ticket_created / ux_ticket_messages_key,
+-- ix_msg_att_msg — дубль ix_message_attachments_ticket_message_id
+DROP INDEX IF EXISTS ix_ticket_messages_ticket_id;
+DROP INDEX IF EXISTS ix_ticket_messages_sender_tg_id;
+DROP INDEX IF EXISTS ix_msg_att_msg;
+"""
+
+
+def bootstrap_indexes_and_tables(bind=None) -> None:
+    with (bind or engine).begin() as conn:
         for stmt in filter(None, (s.strip() for s in DDL.split(";"))):
             conn.exec_driver_sql(stmt)
+        for block in DO_BLOCKS:
+            conn.exec_driver_sql(block)
+        for stmt in filter(None, (s.strip() for s in INDEXES.split(";"))):
+            conn.exec_driver_sql(stmt)
+
+
+def schema_fingerprint() -> str:
+    """Хэш того, что делают init_db и bootstrap: модели (таблицы, индексы) и DDL выше."""
+    dialect = postgresql.dialect()
+    h = hashlib.sha256()
+    for table in Base.metadata.sorted_tables:
+        h.update(str(CreateTable(table).compile(dialect=dialect)).encode())
+        for index in sorted(table.indexes, key=lambda i: i.name or ""):
+            h.update(str(CreateIndex(index).compile(dialect=dialect)).encode())
+    for part in (DDL, *DO_BLOCKS, INDEXES):
+        h.update(part.encode())
+    return h.hexdigest()[:16]
+
+
+def ensure_schema(force: bool = False) -> bool:
+    """
+    init_db + bootstrap, только если схема в базе от другой версии кода
+    (отпечаток в schema_state). Рестарт без изменений моделей — один SELECT.
+    True — применили.
+    """
+    fp = schema_fingerprint()
+    with engine.connect() as conn:
+        conn.exec_driver_sql(f"SELECT pg_advisory_lock({SCHEMA_LOCK})")
+        try:
+            conn.exec_driver_sql(
+                "CREATE TABLE IF NOT EXISTS schema_state ("
+                " id int PRIMARY KEY, fingerprint varchar(64) NOT NULL, applied_at timestamp NOT NULL DEFAULT now())"
+            )
+            conn.commit()
+            if not force and conn.scalar(text("SELECT fingerprint FROM schema_state WHERE id = 1")) == fp:
+                return False
+            log.info("applying schema %s", fp)
+            init_db()
+            bootstrap_indexes_and_tables()
+            conn.execute(text(
+                "INSERT INTO schema_state (id, fingerprint) VALUES (1, :fp) "
+                "ON CONFLICT (id) DO UPDATE SET fingerprint = excluded.fingerprint, applied_at = now()"
+            ), {"fp": fp})
+            conn.commit()
+            return True
+        finally:
+            conn.exec_driver_sql(f"SELECT pg_advisory_unlock({SCHEMA_LOCK})")
+            conn.commit()
@@ -0,0 +1,143 @@
+"""
+Кэши в памяти процесса и их сброс между процессами (воркеры, второй экземпляр бота).
+
+Кэши:
+  dialogs — активный диалог по tg_id: ("operator" | "user", ticket_id, tg_id собеседника)
+            или None (диалога нет); на каждую реплику в proxy.
+  users   — подпись оператора по tg_id (история обращений).
+
+Кто меняет данные, тот в той же транзакции вызывает publish(s, cache, *keys):
+pg_notify в канал "cache" уходит только после commit, и все процессы, включая
+этот, выкидывают ключи — claim / закрытие на другом узле не оставит устаревший
+маршрут. Брокер не нужен, хватает слушателя из src/db/notify.py.
+
+Уведомления за время разрыва слушателя теряются, поэтому кэши работают, только
+пока он подключен; после каждого (пере)подключения все сбрасываются. CACHE_TTL_S —
+страховка на случай, если разрыв еще не заметили (keepalive). 0 — кэши выключены.
+"""
+import time
+from collections import OrderedDict
+from typing import Any, Callable
+
+from sqlalchemy.orm import Session
+
+from src.config import settings
+from src.db import notify
+
+CHANNEL = "cache"
+
+stats = {
+    "hits": 0,
+    "misses": 0,
+    "published": 0,
+    "evicted": 0,
+    "resyncs": 0,
+}
+
+
+class Cache:
+    """LRU с TTL. get_or_load не кладет значение, если за время загрузки пришел сброс."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._data: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self._gen = 0
+
+    def get_or_load(self, key, load: Callable[[], Any]):
+        ttl = settings.cache_ttl_s
+        if ttl <= 0 or not notify.connected():
+            return load()
+        hit = self._data.get(key)
+        now = time.monotonic()
+        if hit is not None and hit[0] > now:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:  # сбросили из event loop, пока читали из потока
+                pass
+            stats["hits"] += 1
+            return hit[1]
+        stats["misses"] += 1
+        gen = self._gen
+        value = load()
+        if gen == self._gen:
+            self._data[key] = (now + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > settings.cache_size:
+                try:
+                    self._data.popitem(last=False)
+                except KeyError:
+                    break
+        return value
+
+    def generation(self) -> int:
+        return self._gen
+
+    def fill(self, items, gen: int) -> int:
+        """Прогрев: положить загруженное пачкой, если с gen (до загрузки) не было сбросов."""
+        if settings.cache_ttl_s <= 0 or gen != self._gen:
+            return 0
+        expires = time.monotonic() + settings.cache_ttl_s
+        n = 0
+        for key, value in items:
+            if len(self._data) >= settings.cache_size:
+                break
+            self._data[key] = (expires, value)
+            n += 1
+        return n
+
+    def evict(self, key) -> None:
+        self._gen += 1
+        if self._data.pop(key, None) is not None:
+            stats["evicted"] += 1
+
+    def clear(self) -> None:
+        self._gen += 1
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+dialogs = Cache("dialogs")
+users = Cache("users")
+
+CACHES = {c.name: c for c in (dialogs, users)}
+
+
+def publish(s: Session, cache: Cache, *keys: int | None) -> None:
+    """Ключи устарели — сбросить во всех процессах после commit (и здесь сразу)."""
+    keys = tuple(k for k in keys if k is not None)
+    if not keys:
+        return
+    for k in keys:
+        cache.evict(k)
+    notify.notify(s, CHANNEL, f"{cache.name}:{','.join(map(str, keys))}")
+    stats["published"] += 1
+
+
+def _on_notify(payload: str) -> None:
+    name, _, keys = payload.partition(":")
+    cache = CACHES.get(name)
+    if cache is None:
+        return
+    for k in keys.split(","):
+        if k:
+            cache.evict(int(k))
+
+
+def _resync() -> None:
+    # пропущенные уведомления не восстановить — забываем все
+    stats["resyncs"] += 1
+    for c in CACHES.values():
+        c.clear()
+
+
+async def start(bot=None, worker_index: int = 0) -> None:
+    """startup-хук: в каждом процессе — подписка на сбросы."""
+    notify.subscribe(CHANNEL, _on_notify, on_connect=_resync)
+    notify.start()
+
+
+async def stop() -> None:
+    for c in CACHES.values():
+        c.clear()
@@ -0,0 +1,30 @@
+from aiogram.types import Message
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+from src.db.models import TicketMessage
+
+# ключ реплики: одно сообщение Telegram в тикете логируется один раз
+MESSAGE_KEY = ("ticket_id", "sender_tg_id", "tg_message_id")
+
+
+def insert_ticket_message(s: Session, ticket_id: int, m: Message, sender_type: str) -> int | None:
+    """
+    INSERT ... ON CONFLICT DO NOTHING в ticket_messages.
+    None — это сообщение уже залогировано (повторная доставка апдейта, рестарт
+    посреди обработки): ни скачивать, ни пересылать его второй раз не нужно.
+    """
+    content_type = m.content_type
+    return s.scalar(
+        insert(TicketMessage)
+        .values(
+            ticket_id=ticket_id,
+            sender_tg_id=m.from_user.id,      # type: ignore
+            sender_type=sender_type,
+            tg_message_id=m.message_id,
+            content_type=content_type,
+            message_text=m.text if content_type == "text" else None,
+            caption=m.caption,
+        )
+        .on_conflict_do_nothing(index_elements=list(MESSAGE_KEY))
+        .returning(TicketMessage.id)
+    )
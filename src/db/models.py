@@ -1,5 +1,6 @@
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import String, BigInteger, ForeignKey, Text, Enum, Index, func, Integer
+from sqlalchemy import String, BigInteger, ForeignKey, Text, Enum, Index, func, Integer, text
+from sqlalchemy.dialects.postgresql import JSONB
 import enum
 from datetime import datetime
 
@@ -18,6 +19,8 @@ class User(Base):
     # актуальные данные профиля
     first_name: Mapped[str | None] = mapped_column(String(128))
     username: Mapped[str | None] = mapped_column(String(64))
+    phone: Mapped[str | None] = mapped_column(String(32))                   # как прислал пользователь
+    phone_e164: Mapped[str | None] = mapped_column(String(16), index=True)  # нормализованный, для поиска
 
     # служебка
     is_operator: Mapped[bool] = mapped_column(default=False, index=True)
@@ -31,20 +34,30 @@ class Ticket(Base):
     user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"))
     operator_tg_id: Mapped[int | None] = mapped_column(BigInteger, index=True)
     status: Mapped[TicketStatus] = mapped_column(Enum(TicketStatus), index=True)
+    kind: Mapped[str | None] = mapped_column(String(16))  # warranty / other (у старых тикетов пусто)
     created_at: Mapped[datetime] = mapped_column(default=func.now())
+    claimed_at: Mapped[datetime | None]   # оператор взял в работу
     closed_at: Mapped[datetime | None]
+    notified_at: Mapped[datetime | None]  # карточка ушла операторам (иначе intake не дописан)
+    card_chat_id: Mapped[int | None] = mapped_column(BigInteger)     # где карточка (src/tasks/cards.py)
+    card_message_id: Mapped[int | None] = mapped_column(BigInteger)
 
     user: Mapped[User] = relationship()
 
     __table_args__ = (
         Index("ix_ticket_user_active", "user_id", "status"),
+        # прокси: активный диалог оператора; маршруты деградированного режима
+        Index("ix_tickets_operator_assigned", "operator_tg_id", postgresql_where=text("status = 'assigned'")),
+        # reaper: брошенные intake
+        Index("ix_tickets_intake", "created_at",
+              postgresql_where=text("status = 'waiting' AND notified_at IS NULL")),
     )
 
 class TicketMessage(Base):
     __tablename__ = "ticket_messages"
     id: Mapped[int] = mapped_column(primary_key=True)
-    ticket_id: Mapped[int] = mapped_column(ForeignKey("tickets.id", ondelete="CASCADE"), index=True)
-    sender_tg_id: Mapped[int] = mapped_column(BigInteger, index=True)
+    ticket_id: Mapped[int] = mapped_column(ForeignKey("tickets.id", ondelete="CASCADE"))
+    sender_tg_id: Mapped[int] = mapped_column(BigInteger)
     sender_type: Mapped[str] = mapped_column(String(16))  # "user" / "operator"
     tg_message_id: Mapped[int] = mapped_column()
     content_type: Mapped[str] = mapped_column(String(32)) # text/photo/document/voice/video/...
@@ -52,6 +65,13 @@ class TicketMessage(Base):
     caption: Mapped[str | None] = mapped_column(Text)        # подпись к медиа
     created_at: Mapped[datetime] = mapped_column(default=func.now())
 
+    __table_args__ = (
+        # одно сообщение Telegram логируется один раз (см. src/db/messages.py)
+        Index("ux_ticket_messages_key", "ticket_id", "sender_tg_id", "tg_message_id", unique=True),
+        # сообщения тикета по порядку (claim, история, reaper: последняя активность)
+        Index("ix_ticket_messages_ticket_created", "ticket_id", "created_at", "id"),
+    )
+
 class MessageAttachment(Base):
     __tablename__ = "message_attachments"
     id: Mapped[int] = mapped_column(primary_key=True)
@@ -72,4 +92,56 @@ class MessageAttachment(Base):
     height: Mapped[int | None] = mapped_column(Integer)
     duration: Mapped[int | None] = mapped_column(Integer)    # seconds
     local_path: Mapped[str | None] = mapped_column(String(512))
-    created_at: Mapped[datetime] = mapped_column(default=func.now())
\ No newline at end of file
+    created_at: Mapped[datetime] = mapped_column(default=func.now())
+
+    # постобработка (src/utils/media_post.py)
+    thumb_path: Mapped[str | None] = mapped_column(String(512))
+    phash: Mapped[str | None] = mapped_column(String(16), index=True)  # dHash, hex
+    processed_at: Mapped[datetime | None]
+
+
+class TicketStatsHourly(Base):
+    """
+    Почасовые агрегаты по тикетам на оператора и тип обращения (src/db/sla.py).
+    Обновляются на claim/закрытии, /stats читает только их.
+    """
+    __tablename__ = "ticket_stats_hourly"
+    bucket: Mapped[datetime] = mapped_column(primary_key=True)                 # начало часа
+    operator_tg_id: Mapped[int] = mapped_column(BigInteger, primary_key=True)  # 0 — без оператора
+    kind: Mapped[str] = mapped_column(String(16), primary_key=True)            # "" — неизвестно
+
+    claimed: Mapped[int] = mapped_column(Integer, default=0)
+    claim_wait_s: Mapped[int] = mapped_column(BigInteger, default=0)     # сумма: карточка -> claim
+    claim_wait_max_s: Mapped[int] = mapped_column(Integer, default=0)
+    closed: Mapped[int] = mapped_column(Integer, default=0)
+    auto_closed: Mapped[int] = mapped_column(Integer, default=0)         # закрыл reaper
+    handle_s: Mapped[int] = mapped_column(BigInteger, default=0)         # сумма: claim -> закрытие
+    resolve_s: Mapped[int] = mapped_column(BigInteger, default=0)        # сумма: создание -> закрытие
+
+
+class Outbox(Base):
+    """
+    Исходящие сообщения бота (src/tasks/outbox.py).
+    Пишутся в одной транзакции с тикетом / репликой, доставляются фоновыми воркерами.
+    """
+    __tablename__ = "outbox"
+    id: Mapped[int] = mapped_column(BigInteger, primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)           # куда; в пределах чата — строго по id
+    method: Mapped[str] = mapped_column(String(32))            # send_message / copy_message
+    payload: Mapped[dict] = mapped_column(JSONB)               # аргументы метода
+    ticket_id: Mapped[int | None] = mapped_column(Integer, index=True)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(default=func.now())
+    created_at: Mapped[datetime] = mapped_column(default=func.now())
+    sent_at: Mapped[datetime | None]
+    failed_at: Mapped[datetime | None]                         # сдались (чат заблокирован, сообщение удалено...)
+    sent_message_id: Mapped[int | None] = mapped_column(BigInteger)
+    last_error: Mapped[str | None] = mapped_column(Text)
+    # аренда: кто сейчас доставляет голову очереди чата и до какого момента
+    locked_by: Mapped[str | None] = mapped_column(String(64))
+    locked_until: Mapped[datetime | None]
+
+    __table_args__ = (
+        Index("ix_outbox_pending", "chat_id", "id",
+              postgresql_where=text("sent_at IS NULL AND failed_at IS NULL")),
+    )
@@ -0,0 +1,148 @@
+"""
+Postgres LISTEN/NOTIFY.
+
+notify(s, channel, payload) — отправить в той же транзакции, что и данные:
+слушатели получат уведомление только после commit.
+
+Слушатель один на процесс: отдельное psycopg2-соединение в autocommit,
+читается через loop.add_reader — без потоков и без опроса базы.
+Соединение пропало — переподключаемся, после каждого (пере)подключения
+вызываем on_connect-колбэки: за время разрыва уведомления могли потеряться,
+подписчик должен сам догнать состояние по базе.
+"""
+import asyncio
+import logging
+from typing import Callable
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from src.config import settings
+
+log = logging.getLogger(__name__)
+
+_handlers: dict[str, list[Callable[[str], None]]] = {}
+_on_connect: list[Callable[[], None]] = []
+_task: asyncio.Task | None = None
+_conn = None
+
+stats = {
+    "received": 0,
+    "reconnects": 0,
+}
+
+
+def notify(s: Session, channel: str, payload: str = "") -> None:
+    s.execute(select(func.pg_notify(channel, payload)))
+
+
+def subscribe(channel: str, cb: Callable[[str], None], on_connect: Callable[[], None] | None = None) -> None:
+    """cb(payload) вызывается в event loop, должен быть быстрым (поставить задачу, дернуть Event)."""
+    if cb in _handlers.get(channel, ()):
+        return
+    _handlers.setdefault(channel, []).append(cb)
+    if on_connect and on_connect not in _on_connect:
+        _on_connect.append(on_connect)
+    if _conn is not None:
+        with _conn.cursor() as cur:
+            cur.execute(f'LISTEN "{channel}"')
+
+
+def connected() -> bool:
+    """Слушатель на связи: уведомления сейчас не теряются."""
+    return _conn is not None
+
+
+def _connect():
+    import psycopg2
+    from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+
+    conn = psycopg2.connect(
+        host=settings.postgres_host,
+        port=settings.postgres_port,
+        dbname=settings.postgres_db,
+        user=settings.postgres_user,
+        password=settings.postgres_password,
+        application_name="bot-listener",
+        # мертвое соединение без трафика иначе не заметить
+        keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3,
+    )
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    with conn.cursor() as cur:
+        for channel in _handlers:
+            cur.execute(f'LISTEN "{channel}"')
+    return conn
+
+
+def _dispatch(conn) -> None:
+    while conn.notifies:
+        n = conn.notifies.pop(0)
+        stats["received"] += 1
+        for cb in _handlers.get(n.channel, ()):
+            try:
+                cb(n.payload)
+            except Exception:
+                log.exception("notify handler for %s failed", n.channel)
+
+
+async def _run() -> None:
+    global _conn
+    loop = asyncio.get_running_loop()
+    backoff = 1.0
+    while True:
+        try:
+            conn = await asyncio.to_thread(_connect)
+        except Exception as e:
+            log.warning("listener: can't connect (%s), retry in %.0fs", e, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+            continue
+        backoff = 1.0
+        _conn = conn
+        fd = conn.fileno()  # после разрыва psycopg2 его уже не отдаст
+        lost = loop.create_future()
+
+        def on_readable() -> None:
+            try:
+                conn.poll()
+            except Exception as e:
+                if not lost.done():
+                    lost.set_result(e)
+                return
+            _dispatch(conn)
+
+        loop.add_reader(fd, on_readable)
+        for cb in _on_connect:
+            try:
+                cb()
+            except Exception:
+                log.exception("listener on_connect callback failed")
+        try:
+            err = await lost
+            log.warning("listener: connection lost (%s), reconnecting", err)
+            stats["reconnects"] += 1
+        finally:
+            loop.remove_reader(fd)
+            _conn = None
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def start() -> None:
+    """Запускаем слушателя, если он еще не запущен. Подписки — до или после, неважно."""
+    global _task
+    if _task is None:
+        _task = asyncio.create_task(_run())
+
+
+async def stop() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
@@ -0,0 +1,135 @@
+"""
+Запросы горячего пути (прокси, claim, finish) на Core.
+
+ORM-версия на каждое сообщение собирала select(), грузила целые Ticket / User
+(и t.user отдельным запросом), чтобы прочитать два-три столбца. Здесь запросы
+собраны один раз при импорте, с bindparam вместо значений: SQL компилируется
+на первом вызове и дальше берется из кэша движка, на каждом вызове передаются
+только параметры. Результат — Row (кортеж), без identity map и отслеживания изменений.
+
+Сравнение с ORM-путем: python -m bench.queries.
+"""
+from aiogram.types import User as TgUser
+from sqlalchemy import bindparam, select, case, or_, and_, func
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.engine import Row
+from sqlalchemy.orm import Session
+
+from src.db import cache
+from src.db.models import Ticket, TicketStatus, TicketMessage, User
+
+_OPERATOR_DIALOG = (
+    select(Ticket.id.label("ticket_id"), User.tg_id.label("user_tg_id"))
+    .join(User, User.id == Ticket.user_id)
+    .where(Ticket.operator_tg_id == bindparam("tg_id"), Ticket.status == TicketStatus.assigned)
+    .limit(1)
+)
+
+_USER_DIALOG = (
+    select(Ticket.id.label("ticket_id"), Ticket.operator_tg_id)
+    .join(User, User.id == Ticket.user_id)
+    .where(User.tg_id == bindparam("tg_id"), Ticket.status == TicketStatus.assigned)
+    .limit(1)
+)
+
+_TICKET_USER = (
+    select(User.tg_id, User.first_name, User.username)
+    .join(Ticket, Ticket.user_id == User.id)
+    .where(Ticket.id == bindparam("ticket_id"))
+)
+
+_TICKET_OPERATOR = select(Ticket.operator_tg_id).where(Ticket.id == bindparam("ticket_id"))
+
+_USER_TG_ID = select(User.tg_id).where(User.id == bindparam("user_id"))
+
+_ACTIVE_DIALOGS = (
+    select(Ticket.id.label("ticket_id"), User.tg_id.label("user_tg_id"), Ticket.operator_tg_id)
+    .join(User, User.id == Ticket.user_id)
+    .where(Ticket.status == TicketStatus.assigned, Ticket.operator_tg_id.is_not(None))
+)
+
+_USER_MESSAGES = (
+    select(TicketMessage.content_type, TicketMessage.tg_message_id)
+    .where(TicketMessage.ticket_id == bindparam("ticket_id"), TicketMessage.sender_type == "user")
+    .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc())
+)
+
+
+def _touch_user_stmt():
+    stmt = insert(User).values(
+        tg_id=bindparam("tg_id"),
+        first_name=bindparam("first_name"),
+        username=bindparam("username"),
+        is_operator=bindparam("is_operator"),
+    )
+    ex = stmt.excluded
+    changed = or_(
+        User.first_name.is_distinct_from(ex.first_name),
+        User.username.is_distinct_from(ex.username),
+        and_(ex.is_operator, ~User.is_operator),
+    )
+    return stmt.on_conflict_do_update(
+        index_elements=[User.tg_id],
+        set_=dict(
+            first_name=ex.first_name,
+            username=ex.username,
+            is_operator=User.is_operator | ex.is_operator,
+            last_seen=ex.last_seen,
+            updated_at=case((changed, ex.updated_at), else_=User.updated_at),
+        ),
+    ).returning(
+        # now() — время начала транзакции: совпало, значит профиль только что поменялся
+        (User.updated_at == func.now()).label("changed")
+    )
+
+
+_TOUCH_USER = _touch_user_stmt()
+
+
+def operator_dialog(s: Session, operator_tg_id: int) -> Row | None:
+    """Диалог, который ведет оператор: (ticket_id, user_tg_id)."""
+    return s.execute(_OPERATOR_DIALOG, {"tg_id": operator_tg_id}).first()
+
+
+def user_dialog(s: Session, user_tg_id: int) -> Row | None:
+    """Диалог пользователя с оператором: (ticket_id, operator_tg_id)."""
+    return s.execute(_USER_DIALOG, {"tg_id": user_tg_id}).first()
+
+
+def active_dialogs(s: Session) -> list[Row]:
+    """Все диалоги ASSIGNED: (ticket_id, user_tg_id, operator_tg_id) — прогрев кэша."""
+    return list(s.execute(_ACTIVE_DIALOGS))
+
+
+def ticket_user(s: Session, ticket_id: int) -> Row | None:
+    """Клиент тикета: (tg_id, first_name, username)."""
+    return s.execute(_TICKET_USER, {"ticket_id": ticket_id}).first()
+
+
+def ticket_operator(s: Session, ticket_id: int) -> int | None:
+    return s.scalar(_TICKET_OPERATOR, {"ticket_id": ticket_id})
+
+
+def user_tg_id(s: Session, user_id: int) -> int | None:
+    return s.scalar(_USER_TG_ID, {"user_id": user_id})
+
+
+def user_messages(s: Session, ticket_id: int) -> list[Row]:
+    """Сообщения клиента по тикету по порядку: (content_type, tg_message_id)."""
+    return list(s.execute(_USER_MESSAGES, {"ticket_id": ticket_id}))
+
+
+def touch_user(s: Session, tg: TgUser, *, mark_operator: bool = False) -> None:
+    """
+    То же, что upsert_user_from_tg, одним INSERT ... ON CONFLICT, без загрузки User:
+    профиль обновляем, last_seen = now(), is_operator только включается.
+    Профиль поменялся — сбрасываем его в кэшах всех процессов.
+    """
+    changed = s.scalar(_TOUCH_USER, {
+        "tg_id": tg.id,
+        "first_name": tg.first_name,
+        "username": tg.username,
+        "is_operator": mark_operator,
+    })
+    if changed:
+        cache.publish(s, cache.users, tg.id)
@@ -0,0 +1,141 @@
+"""
+SLA-статистика по тикетам без сканов всей истории.
+
+На каждом claim и закрытии в той же транзакции прибавляем счетчики
+в ticket_stats_hourly (час, оператор, тип обращения). /stats читает
+только эту таблицу — стоимость отчета не растет вместе с tickets.
+
+Пересчитать агрегаты с нуля по tickets (после первого деплоя или если
+что-то разошлось):
+    python -m src.db.sla --rebuild
+"""
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, func, delete, text
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from src.db.models import Ticket, TicketStatus, TicketStatsHourly as H
+
+COUNTERS = ("claimed", "claim_wait_s", "claim_wait_max_s", "closed", "auto_closed", "handle_s", "resolve_s")
+
+
+def _hour(ts: datetime) -> datetime:
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def _secs(a: datetime | None, b: datetime | None) -> int:
+    return max(0, int((b - a).total_seconds())) if a and b else 0
+
+
+def _bump(s: Session, ts: datetime, operator_tg_id: int | None, kind: str | None, **vals: int) -> None:
+    row = {c: 0 for c in COUNTERS}
+    row.update(vals)
+    stmt = insert(H).values(bucket=_hour(ts), operator_tg_id=operator_tg_id or 0, kind=kind or "", **row)
+    upd = {c: getattr(H, c) + getattr(stmt.excluded, c) for c in vals if c != "claim_wait_max_s"}
+    if "claim_wait_max_s" in vals:
+        upd["claim_wait_max_s"] = func.greatest(H.claim_wait_max_s, stmt.excluded.claim_wait_max_s)
+    s.execute(stmt.on_conflict_do_update(index_elements=[H.bucket, H.operator_tg_id, H.kind], set_=upd))
+
+
+def record_claim(s: Session, t) -> None:
+    """
+    t — тикет или строка с operator_tg_id, kind, created_at, notified_at, claimed_at.
+    Ожидание считаем от отправки карточки операторам, а не от начала intake.
+    """
+    wait = _secs(t.notified_at or t.created_at, t.claimed_at)
+    _bump(s, t.claimed_at, t.operator_tg_id, t.kind, claimed=1, claim_wait_s=wait, claim_wait_max_s=wait)
+
+
+def record_close(s: Session, t, auto: bool = False) -> None:
+    """t — тикет или строка с operator_tg_id, kind, created_at, claimed_at, closed_at."""
+    _bump(
+        s, t.closed_at, t.operator_tg_id, t.kind,
+        closed=1,
+        auto_closed=int(auto),
+        handle_s=_secs(t.claimed_at or t.created_at, t.closed_at),
+        resolve_s=_secs(t.created_at, t.closed_at),
+    )
+
+
+def summary(s: Session, hours: int) -> list:
+    """Суммы по (оператор, тип) за последние hours часов (считая текущий неполный)."""
+    since = func.date_trunc("hour", func.now() - timedelta(hours=hours - 1))
+    return s.execute(
+        select(
+            H.operator_tg_id,
+            H.kind,
+            *[func.sum(getattr(H, c)).label(c) for c in COUNTERS if c != "claim_wait_max_s"],
+            func.max(H.claim_wait_max_s).label("claim_wait_max_s"),
+        )
+        .where(H.bucket >= since)
+        .group_by(H.operator_tg_id, H.kind)
+    ).all()
+
+
+def rebuild(s: Session) -> int:
+    """
+    Пересчет всех агрегатов по tickets. Таблицу на это время блокируем:
+    claim/закрытие, которые идут параллельно, дождутся конца пересчета
+    и добавят себя уже поверх — ничего не посчитается дважды.
+    Для старых тикетов без claimed_at время работы считаем от отправки карточки.
+    """
+    s.execute(text(f"LOCK TABLE {H.__tablename__} IN EXCLUSIVE MODE"))
+    s.execute(delete(H))
+
+    rows: dict[tuple, dict[str, int]] = defaultdict(lambda: {c: 0 for c in COUNTERS})
+    op = func.coalesce(Ticket.operator_tg_id, 0)
+    kind = func.coalesce(Ticket.kind, "")
+
+    def epoch(a, b):
+        # целые секунды по каждому тикету — как при живом обновлении
+        return func.greatest(func.floor(func.extract("epoch", b - a)), 0)
+
+    claim_bucket = func.date_trunc("hour", Ticket.claimed_at)
+    wait = epoch(func.coalesce(Ticket.notified_at, Ticket.created_at), Ticket.claimed_at)
+    for b, o, k, n, w, wmax in s.execute(
+        select(claim_bucket, op, kind, func.count(), func.sum(wait), func.max(wait))
+        .where(Ticket.claimed_at.is_not(None))
+        .group_by(claim_bucket, op, kind)
+    ):
+        r = rows[(b, o, k)]
+        r.update(claimed=n, claim_wait_s=int(w or 0), claim_wait_max_s=int(wmax or 0))
+
+    close_bucket = func.date_trunc("hour", Ticket.closed_at)
+    start = func.coalesce(Ticket.claimed_at, Ticket.notified_at, Ticket.created_at)
+    for b, o, k, n, h, res in s.execute(
+        select(close_bucket, op, kind, func.count(),
+               func.sum(epoch(start, Ticket.closed_at)),
+               func.sum(epoch(Ticket.created_at, Ticket.closed_at)))
+        .where(
+            Ticket.status == TicketStatus.closed,
+            Ticket.closed_at.is_not(None),
+            # закрытые без оператора — брошенные intake, операторы их не видели
+            Ticket.operator_tg_id.is_not(None),
+        )
+        .group_by(close_bucket, op, kind)
+    ):
+        r = rows[(b, o, k)]
+        r.update(closed=n, handle_s=int(h or 0), resolve_s=int(res or 0))
+
+    if rows:
+        s.execute(insert(H), [
+            {"bucket": b, "operator_tg_id": o, "kind": k, **v} for (b, o, k), v in rows.items()
+        ])
+    return len(rows)
+
+
+if __name__ == "__main__":
+    from src.db.base import SessionLocal
+
+    p = argparse.ArgumentParser(prog="python -m src.db.sla")
+    p.add_argument("--rebuild", action="store_true", help="пересчитать ticket_stats_hourly по tickets")
+    args = p.parse_args()
+    if not args.rebuild:
+        p.error("укажите --rebuild")
+    with SessionLocal() as s:
+        n = rebuild(s)
+        s.commit()
+    print(f"rebuilt {n} hourly buckets")
@@ -0,0 +1,307 @@
+"""
+Деградированный режим: база недоступна, а переписка идет.
+
+- append_message() пишет реплику в локальный журнал SPOOL_DIR — по строке JSON,
+  только дописывая в конец; fsync пачкой раз в SPOOL_FSYNC_MS.
+- routes — таблица маршрутов "кто кому пишет" по диалогам ASSIGNED. Пока база
+  есть, ее обновляют прокси и src/tasks/replayer.py; когда базы нет, прокси
+  пересылает реплики по ней.
+- replay_file() заливает журнал в базу пачками, когда она вернулась.
+  Повторная заливка (упали посередине) дублей не создает.
+
+Файл журнала у каждого процесса свой и держится под flock, пока в него пишут.
+Взять flock на чужом файле получилось — значит, писатель его закрыл (или
+процесс умер) и файл можно заливать; так журнал подбирается и после рестарта,
+и из соседнего воркера.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+import asyncio
+from datetime import datetime, timezone
+from pathlib import Path
+
+from aiogram import types
+from sqlalchemy import select, tuple_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from src.config import settings
+from src.db.models import Ticket, TicketStatus, TicketMessage, MessageAttachment, User
+from src.db.users import set_user_phone
+from src.db.messages import MESSAGE_KEY
+
+log = logging.getLogger(__name__)
+
+BATCH = 500
+ROUTES_MAX = 50_000
+
+stats = {
+    "spooled": 0,
+    "replayed": 0,
+    "replay_skipped": 0,
+    "degraded_relays": 0,
+}
+
+# tg_id отправителя -> (ticket_id, кому пересылать, sender_type)
+routes: dict[int, tuple[int, int, str]] = {}
+
+_fd: int | None = None
+_path: Path | None = None
+_fsync_handle: asyncio.TimerHandle | None = None
+
+
+# -------------------------
+# маршруты
+# -------------------------
+
+def remember_route(sender_tg_id: int, ticket_id: int, peer_tg_id: int, sender_type: str) -> None:
+    if sender_tg_id not in routes and len(routes) >= ROUTES_MAX:
+        routes.pop(next(iter(routes)))
+    routes[sender_tg_id] = (ticket_id, peer_tg_id, sender_type)
+
+
+def forget_route(sender_tg_id: int) -> None:
+    routes.pop(sender_tg_id, None)
+
+
+def route_for(sender_tg_id: int) -> tuple[int, int, str] | None:
+    return routes.get(sender_tg_id)
+
+
+def load_routes(s: Session) -> int:
+    """Полный снимок маршрутов по всем диалогам ASSIGNED."""
+    fresh: dict[int, tuple[int, int, str]] = {}
+    rows = s.execute(
+        select(Ticket.id, User.tg_id, Ticket.operator_tg_id)
+        .join(User, User.id == Ticket.user_id)
+        .where(Ticket.status == TicketStatus.assigned, Ticket.operator_tg_id.is_not(None))
+        .order_by(Ticket.id.desc())
+    )
+    # у одного человека несколько диалогов ASSIGNED — берем самый свежий
+    for ticket_id, user_tg_id, operator_tg_id in rows:
+        fresh.setdefault(operator_tg_id, (ticket_id, user_tg_id, "operator"))
+        fresh.setdefault(user_tg_id, (ticket_id, operator_tg_id, "user"))
+    routes.clear()
+    routes.update(fresh)
+    return len(fresh)
+
+
+# -------------------------
+# запись
+# -------------------------
+
+def _open() -> int:
+    global _fd, _path
+    if _fd is None:
+        d = Path(settings.spool_dir)
+        d.mkdir(parents=True, exist_ok=True)
+        name = f"{os.getpid()}-{time.time_ns()}"
+        tmp = d / f"{name}.tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+        # лочим до того, как файл получит имя *.jsonl: иначе заливщик может успеть
+        # забрать и удалить пустой файл
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        _path = d / f"{name}.jsonl"
+        os.rename(tmp, _path)
+        _fd = fd
+        log.warning("spooling to %s", _path)
+    return _fd
+
+
+def _fsync() -> None:
+    global _fsync_handle
+    _fsync_handle = None
+    if _fd is not None:
+        os.fsync(_fd)
+
+
+def append(kind: str, **rec) -> None:
+    line = json.dumps({"kind": kind, "ts": datetime.now(timezone.utc).isoformat(), **rec},
+                      ensure_ascii=False) + "\n"
+    os.write(_open(), line.encode())
+    stats["spooled"] += 1
+
+    global _fsync_handle
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        _fsync()
+        return
+    if _fsync_handle is None:
+        _fsync_handle = loop.call_later(settings.spool_fsync_ms / 1000, _fsync)
+
+
+def seal() -> None:
+    """Закрыть текущий файл журнала: он станет доступен заливщику, новые записи пойдут в новый."""
+    global _fd, _path, _fsync_handle
+    if _fsync_handle is not None:
+        _fsync_handle.cancel()
+        _fsync_handle = None
+    if _fd is not None:
+        os.fsync(_fd)
+        os.close(_fd)
+        _fd = None
+        _path = None
+
+
+def _attachment(m: types.Message) -> dict | None:
+    if m.photo:
+        ph = m.photo[-1]
+        return dict(media_type="photo", file_id=ph.file_id, file_unique_id=ph.file_unique_id,
+                    size=ph.file_size, width=ph.width, height=ph.height)
+    for media_type in ("document", "video", "voice"):
+        obj = getattr(m, media_type, None)
+        if obj:
+            return dict(
+                media_type=media_type,
+                file_id=obj.file_id,
+                file_unique_id=obj.file_unique_id,
+                size=getattr(obj, "file_size", None),
+                mime_type=getattr(obj, "mime_type", None),
+                file_name=getattr(obj, "file_name", None),
+                width=getattr(obj, "width", None),
+                height=getattr(obj, "height", None),
+                duration=getattr(obj, "duration", None),
+            )
+    return None
+
+
+def append_message(ticket_id: int, m: types.Message, sender_type: str) -> None:
+    """То же, что сохранили бы в ticket_messages (+ вложение и телефон из контакта)."""
+    content_type = m.content_type
+    phone = None
+    if content_type == "contact" and sender_type == "user" and m.contact:
+        if m.contact.user_id in (None, m.from_user.id):  # type: ignore
+            phone = m.contact.phone_number
+    append(
+        "ticket_message",
+        ticket_id=ticket_id,
+        sender_tg_id=m.from_user.id,  # type: ignore
+        sender_type=sender_type,
+        tg_message_id=m.message_id,
+        content_type=content_type,
+        message_text=m.text if content_type == "text" else None,
+        caption=m.caption,
+        attachment=_attachment(m),
+        phone=phone,
+    )
+
+
+# -------------------------
+# заливка в базу
+# -------------------------
+
+def pending_files() -> list[Path]:
+    d = Path(settings.spool_dir)
+    if not d.is_dir():
+        return []
+    return sorted(p for p in d.glob("*.jsonl") if p != _path)
+
+
+def _apply(s: Session, recs: list[dict]) -> list[tuple[int, int | None]]:
+    """Вставляем пачку реплик, уже залитые пропускаем. Возвращаем (tm_id, att_id) новых."""
+    ticket_ids = {r["ticket_id"] for r in recs}
+    known = set(s.scalars(select(Ticket.id).where(Ticket.id.in_(ticket_ids))))
+    keys = [(r["ticket_id"], r["sender_tg_id"], r["tg_message_id"]) for r in recs]
+    seen = set(s.execute(
+        select(TicketMessage.ticket_id, TicketMessage.sender_tg_id, TicketMessage.tg_message_id)
+        .where(tuple_(TicketMessage.ticket_id, TicketMessage.sender_tg_id, TicketMessage.tg_message_id)
+               .in_(keys))
+    ).all())
+
+    fresh, dup = [], set()
+    for r, key in zip(recs, keys):
+        if r["ticket_id"] not in known or key in seen or key in dup:
+            stats["replay_skipped"] += 1
+            continue
+        dup.add(key)
+        fresh.append(r)
+    if not fresh:
+        return []
+
+    # ON CONFLICT: реплику могли залогировать вживую, пока мы читали журнал
+    ret = s.execute(
+        insert(TicketMessage)
+        .on_conflict_do_nothing(index_elements=list(MESSAGE_KEY))
+        .returning(TicketMessage.ticket_id, TicketMessage.sender_tg_id, TicketMessage.tg_message_id,
+                   TicketMessage.id),
+        [
+            dict(
+                ticket_id=r["ticket_id"],
+                sender_tg_id=r["sender_tg_id"],
+                sender_type=r["sender_type"],
+                tg_message_id=r["tg_message_id"],
+                content_type=r["content_type"],
+                message_text=r["message_text"],
+                caption=r["caption"],
+                created_at=datetime.fromisoformat(r["ts"]),
+            )
+            for r in fresh
+        ],
+    ).all()
+    inserted = {(t, snd, mid): tm_id for t, snd, mid, tm_id in ret}
+    stats["replay_skipped"] += len(fresh) - len(inserted)
+    fresh = [r for r in fresh if (r["ticket_id"], r["sender_tg_id"], r["tg_message_id"]) in inserted]
+    tm_ids = [inserted[(r["ticket_id"], r["sender_tg_id"], r["tg_message_id"])] for r in fresh]
+
+    with_att = [(tm_id, r) for tm_id, r in zip(tm_ids, fresh) if r.get("attachment")]
+    att_ids: dict[int, int] = {}
+    if with_att:
+        rows = s.execute(
+            insert(MessageAttachment).returning(
+                MessageAttachment.ticket_message_id, MessageAttachment.id, sort_by_parameter_order=True
+            ),
+            [dict(ticket_message_id=tm_id, ticket_id=r["ticket_id"], **r["attachment"]) for tm_id, r in with_att],
+        )
+        att_ids = dict(rows.all())
+
+    for r in fresh:
+        if r.get("phone"):
+            set_user_phone(s, r["sender_tg_id"], r["phone"])
+
+    stats["replayed"] += len(fresh)
+    return [(tm_id, att_ids.get(tm_id)) for tm_id in tm_ids]
+
+
+def replay_file(path: Path, session_factory) -> list[tuple[int, int | None]] | None:
+    """
+    Залить один файл журнала и удалить его. None — файл сейчас пишется
+    (или его уже забрал кто-то другой). Каждая пачка — своя транзакция.
+    """
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except FileNotFoundError:
+        return None
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        if os.fstat(fd).st_nlink == 0:
+            return None  # пока ждали, файл залил и удалил соседний процесс
+
+        recs = []
+        with os.fdopen(os.dup(fd), "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # оборванная последняя строка (упали посреди записи)
+                    log.warning("spool %s: skipping broken line", path.name)
+                    continue
+                if rec.get("kind") == "ticket_message":
+                    recs.append(rec)
+
+        done: list[tuple[int, int | None]] = []
+        for i in range(0, len(recs), BATCH):
+            with session_factory() as s:
+                done += _apply(s, recs[i:i + BATCH])
+                s.commit()
+        os.unlink(path)
+        log.info("spool %s replayed: %d records, %d new", path.name, len(recs), len(done))
+        return done
+    finally:
+        os.close(fd)
@@ -1,8 +1,10 @@
 from typing import Optional
-from aiogram.types import User as TgUser
+from aiogram.types import Message, User as TgUser
 from sqlalchemy import select, func
 from sqlalchemy.orm import Session
+from src.db import cache
 from src.db.models import User
+from src.utils.phone import normalize_phone
 
 def upsert_user_from_tg(s: Session, tg: TgUser, *, mark_operator: bool = False) -> User:
     """
@@ -35,4 +37,43 @@ def upsert_user_from_tg(s: Session, tg: TgUser, *, mark_operator: bool = False)
         u.last_seen = func.now()
         if changed:
             s.flush()
+            cache.publish(s, cache.users, tg.id)
     return u
+
+
+def set_user_phone(s: Session, tg_id: int, raw: str | None) -> str | None:
+    """
+    Сохраняем телефон из контакта: сырой + нормализованный E.164.
+    Возвращаем E.164 (или None, если номер не распарсился).
+    """
+    if not raw:
+        return None
+    e164 = normalize_phone(raw)
+    u = s.scalar(select(User).where(User.tg_id == tg_id))
+    if u and (u.phone != raw or u.phone_e164 != e164):
+        u.phone = raw
+        u.phone_e164 = e164
+        s.flush()
+    return e164
+
+
+def find_user_by_phone(s: Session, raw: str) -> Optional[User]:
+    """Поиск по индексу ix_users_phone_e164: сравниваем уже нормализованные номера."""
+    e164 = normalize_phone(raw)
+    if not e164:
+        return None
+    return s.scalar(select(User).where(User.phone_e164 == e164).order_by(User.last_seen.desc()).limit(1))
+
+
+def capture_contact(s: Session, m: Message) -> None:
+    """
+    Пользователь поделился контактом — запоминаем номер.
+    Берем только свой контакт (или контакт без привязки к TG-аккаунту),
+    чужие аккаунты к этому пользователю не пишем.
+    """
+    c = m.contact
+    if not c or not m.from_user:
+        return
+    if c.user_id is not None and c.user_id != m.from_user.id:
+        return
+    set_user_phone(s, m.from_user.id, c.phone_number)
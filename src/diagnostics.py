@@ -0,0 +1,305 @@
+"""
+Память долгоживущего процесса: что растет и где.
+
+DIAG_PORT (0 — выключено) поднимает на DIAG_HOST (по умолчанию только 127.0.0.1,
+смотреть через docker exec / ssh) отдельный HTTP-сервер; с WORKERS>1 воркер N
+слушает DIAG_PORT+N — память у каждого воркера своя.
+
+    GET /debug/memory              RSS, gc, размеры кэшей и очередей, FSM, сессии SQLAlchemy,
+                                   рост по tracemalloc
+    GET /debug/memory?objects=30   + топ типов объектов по количеству (gc.get_objects — это
+                                   проход по всей куче, десятки мс; только по запросу)
+    GET /debug/memory?snapshot=1   снять снимок tracemalloc сейчас (если он сейчас пишет)
+
+tracemalloc включается DIAG_TRACEMALLOC_FRAMES (глубина стека, 0 — нет; 1 — место
+аллокации без стека, дешевле всего). Выборки по частоте у него нет: пока он
+включен, платит каждая аллокация (на bench.memory — вдвое меньше updates/s).
+Поэтому выборка по времени: раз в DIAG_SNAPSHOT_S он пишет DIAG_TRACE_WINDOW_S
+секунд, в конце окна снимок и выключение. В ответе — что из выделенного за окно
+еще живо, по строкам кода: то, что держится окно за окном, и копится.
+DIAG_TRACE_WINDOW_S=0 — писать все время (отладка утечки): рост с прошлого
+снимка и со старта. Снимки сразу сворачиваются по строкам в отдельном потоке.
+В лог раз в DIAG_SNAPSHOT_S — одна строка с RSS.
+"""
+import asyncio
+import gc
+import logging
+import resource
+import time
+import tracemalloc
+from collections import Counter
+
+from aiogram import Bot, Dispatcher
+from aiohttp import web
+from sqlalchemy.orm import session as orm_session
+
+from src import lifecycle
+from src.config import settings
+from src.db import cache, spool
+from src.middlewares.antiflood import AntiFlood
+from src.middlewares.dedup import RecentUpdates
+from src.middlewares import recorder
+from src.routers import public, proxy
+from src.tasks import cards, media_store, outbox
+from src.utils import files, media_post
+
+log = logging.getLogger(__name__)
+
+TOP = 20
+_IGNORED = {__file__, tracemalloc.__file__, "<frozen importlib._bootstrap>", "<frozen importlib._bootstrap_external>",
+            "<unknown>"}
+
+stats = {
+    "snapshots": 0,
+    "snapshot_ms": 0,
+    "rss_bytes": 0,
+    "rss_peak_bytes": 0,
+}
+
+_dp: Dispatcher | None = None
+_runner: web.AppRunner | None = None
+_loop_task: asyncio.Task | None = None
+_lock = asyncio.Lock()
+# снимки сразу сворачиваются по строкам: (файл, строка) -> (байт, блоков);
+# сами снимки (кортеж на каждую живую аллокацию) не храним
+_base: dict[tuple[str, int], tuple[int, int]] | None = None
+_prev: dict[tuple[str, int], tuple[int, int]] | None = None
+_growth: dict[str, list[dict]] = {"recent": [], "since_start": []}
+_taken = 0.0
+_windowed = False  # tracemalloc пишет окнами (DIAG_TRACE_WINDOW_S), а не все время
+
+
+# -------------------------
+# RSS и размеры
+# -------------------------
+
+def rss() -> tuple[int, int]:
+    """(текущий RSS, пиковый) в байтах."""
+    current = peak = 0
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    current = int(line.split()[1]) * 1024
+                elif line.startswith("VmHWM:"):
+                    peak = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if not peak:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # Linux: КиБ
+    return current or peak, peak
+
+
+def _fsm(dp: Dispatcher | None) -> dict:
+    """FSM в памяти: записи не удаляются и после state.clear() — видно, сколько их пустых."""
+    storage = getattr(getattr(dp, "storage", None), "storage", None)
+    if not isinstance(storage, dict):
+        return {}
+    empty = list_items = 0
+    for record in list(storage.values()):
+        if record.state is None and not record.data:
+            empty += 1
+        list_items += sum(len(v) for v in record.data.values() if isinstance(v, (list, dict, set)))
+    return {"records": len(storage), "empty": empty, "list_items": list_items}
+
+
+def _sessions() -> dict:
+    """Живые сессии SQLAlchemy и сколько объектов в их identity map."""
+    alive = list(orm_session._sessions.values())
+    maps = [len(s.identity_map) for s in alive]
+    return {"open": len(alive), "identity_map": sum(maps), "identity_map_max": max(maps, default=0)}
+
+
+def sizes() -> dict:
+    """Размеры внутренних кэшей и очередей процесса."""
+    out = {
+        "cache_dialogs": len(cache.dialogs),
+        "cache_users": len(cache.users),
+        "file_paths": len(files._file_paths),
+        "spool_routes": len(spool.routes),
+        "media_store_tickets": len(media_store.ticket_bytes),
+        "media_post_tasks": len(media_post._tasks),
+        "outbox_active": len(outbox._active),
+        "cards_pending": len(cards._pending),
+        "inflight_updates": len(lifecycle._inflight),
+        "queued_updates": len(lifecycle.queued),
+        "recorder_buffer": len(recorder._buf),
+        "asyncio_tasks": len(asyncio.all_tasks()),
+    }
+    if _dp is not None:
+        for mw in _dp.update.outer_middleware:
+            if isinstance(mw, RecentUpdates):
+                out["dedup_update_ids"] = len(mw._seen)
+    for router in (public.router, proxy.router):
+        for mw in router.message.outer_middleware:
+            if isinstance(mw, AntiFlood):
+                out[f"antiflood_{mw.name}_users"] = len(mw._tat)
+    return out
+
+
+def object_counts(top: int) -> list[tuple[str, int]]:
+    counts = Counter(type(o).__qualname__ for o in gc.get_objects())
+    return counts.most_common(top)
+
+
+# -------------------------
+# tracemalloc
+# -------------------------
+
+def _group(snap: tracemalloc.Snapshot) -> dict[tuple[str, int], tuple[int, int]]:
+    out = {}
+    for st in snap.statistics("lineno"):
+        frame = st.traceback[0]
+        if frame.filename not in _IGNORED:
+            out[(frame.filename, frame.lineno)] = (st.size, st.count)
+    return out
+
+
+def _diff(new: dict, old: dict) -> list[dict]:
+    grown = []
+    for where, (size, count) in new.items():
+        old_size, old_count = old.get(where, (0, 0))
+        if size > old_size:
+            grown.append((size - old_size, count - old_count, size, where))
+    grown.sort(reverse=True)
+    return [
+        {"where": f"{f}:{line}", "size_diff_kib": round(d / 1024, 1), "size_kib": round(size / 1024, 1),
+         "count_diff": dc}
+        for d, dc, size, (f, line) in grown[:TOP]
+    ]
+
+
+def _compare(snap: tracemalloc.Snapshot, window: bool) -> None:
+    global _base, _prev
+    lines = _group(snap)
+    if window:
+        # все трассы окна — новые: живое из окна и есть рост
+        _growth["recent"] = _diff(lines, {})
+        return
+    if _base is None:
+        _base = lines
+    if _prev is not None:
+        _growth["recent"] = _diff(lines, _prev)
+    _growth["since_start"] = _diff(lines, _base)
+    _prev = lines
+
+
+async def snapshot(stop: bool = False) -> None:
+    """Снять снимок tracemalloc и пересчитать рост (сравнение — в потоке); stop — конец окна."""
+    global _taken
+    async with _lock:
+        if not tracemalloc.is_tracing():
+            return
+        t0 = time.perf_counter()
+        # копия трасс — под GIL, цикл стоит; пропорционально числу живых аллокаций
+        snap = tracemalloc.take_snapshot()
+        if stop:
+            tracemalloc.stop()
+        await asyncio.to_thread(_compare, snap, _windowed)
+        del snap
+        _taken = time.time()
+        stats["snapshots"] += 1
+        stats["snapshot_ms"] = int((time.perf_counter() - t0) * 1000)
+
+
+def report(objects: int = 0) -> dict:
+    current, peak = rss()
+    stats["rss_bytes"], stats["rss_peak_bytes"] = current, peak
+    out: dict = {
+        "rss_mib": round(current / 2**20, 1),
+        "rss_peak_mib": round(peak / 2**20, 1),
+        "gc": {"counts": gc.get_count(), "collections": [g["collections"] for g in gc.get_stats()],
+               "garbage": len(gc.garbage)},
+        "sizes": sizes(),
+        "fsm": _fsm(_dp),
+        "sqlalchemy_sessions": _sessions(),
+    }
+    if tracemalloc.is_tracing() or _taken:
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        out["tracemalloc"] = {
+            "tracing": tracemalloc.is_tracing(),
+            "window_s": settings.diag_trace_window_s if _windowed else 0,
+            "traced_mib": round(traced / 2**20, 1),
+            "traced_peak_mib": round(traced_peak / 2**20, 1),
+            "overhead_mib": round(tracemalloc.get_tracemalloc_memory() / 2**20, 1),
+            "snapshot_at": round(_taken, 3),
+            "snapshot_ms": stats["snapshot_ms"],
+            "growth_recent": _growth["recent"],
+        }
+        if not _windowed:
+            out["tracemalloc"]["growth_since_start"] = _growth["since_start"]
+    if objects:
+        out["objects"] = object_counts(objects)
+    return out
+
+
+async def _snapshot_loop() -> None:
+    window = settings.diag_trace_window_s
+    while True:
+        try:
+            if _windowed:
+                await asyncio.sleep(max(settings.diag_snapshot_s - window, 0))
+                tracemalloc.start(settings.diag_tracemalloc_frames)
+                await asyncio.sleep(window)
+                await snapshot(stop=True)
+            else:
+                await asyncio.sleep(settings.diag_snapshot_s)
+                await snapshot()
+            current, _ = rss()
+            log.info("memory: rss %.1f MiB, fsm records %s, open sessions %s",
+                     current / 2**20, _fsm(_dp).get("records", 0), _sessions()["open"])
+        except asyncio.CancelledError:
+            tracemalloc.stop()
+            raise
+        except Exception:
+            log.exception("diagnostics: snapshot failed")
+
+
+# -------------------------
+# HTTP
+# -------------------------
+
+async def _memory(request: web.Request) -> web.Response:
+    if request.query.get("snapshot"):
+        await snapshot()
+    objects = int(request.query.get("objects") or 0)
+    # обход кучи под GIL — событийный цикл все равно стоит, поток не поможет
+    return web.json_response(report(min(objects, 200)))
+
+
+def attach(dispatcher: Dispatcher, frames: int) -> None:
+    """Чей FSM смотреть; frames > 0 — включить tracemalloc."""
+    global _dp
+    _dp = dispatcher
+    if frames > 0 and not tracemalloc.is_tracing():
+        tracemalloc.start(frames)
+
+
+async def start(bot: Bot, dispatcher: Dispatcher, worker_index: int = 0) -> None:
+    """startup-хук: tracemalloc, первый снимок, сервер на DIAG_PORT+номер воркера."""
+    global _runner, _loop_task, _windowed
+    if not settings.diag_port:
+        return
+    frames = settings.diag_tracemalloc_frames
+    _windowed = frames > 0 and settings.diag_trace_window_s > 0
+    # окнами tracemalloc включает _snapshot_loop; иначе пишет с этого момента
+    attach(dispatcher, 0 if _windowed else frames)
+    await snapshot()
+    app = web.Application()
+    app.router.add_get("/debug/memory", _memory)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    port = settings.diag_port + worker_index
+    await web.TCPSite(_runner, settings.diag_host, port).start()
+    _loop_task = asyncio.create_task(_snapshot_loop())
+    log.info("diagnostics on %s:%s", settings.diag_host, port)
+
+
+async def stop() -> None:
+    global _runner, _loop_task
+    if _loop_task is not None:
+        _loop_task.cancel()
+        _loop_task = None
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
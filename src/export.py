@@ -0,0 +1,292 @@
+"""
+Выгрузка тикетов, сообщений и метаданных вложений.
+
+Примеры:
+    python -m src.export --out export/
+    python -m src.export --out export/ --format csv --since 2025-01-01 --until 2025-07-01
+    python -m src.export --out export/ --status CLOSED --workers 4
+    python -m src.export --out export/ --resume
+
+Данные читаются серверным курсором (yield_per), поэтому память не растёт
+от размера таблиц. С --workers N выгрузка режется по ticket_id % N,
+каждый воркер пишет свои файлы <dataset>.part<k>.<ext> и свой чекпоинт.
+"""
+import argparse
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from enum import Enum
+from pathlib import Path
+
+from sqlalchemy import select, types
+
+from src.db.base import read_session, engine, replica_engine
+from src.db.models import Ticket, TicketMessage, MessageAttachment, User, TicketStatus
+
+BATCH = 1000
+
+DATASETS = ("tickets", "messages", "attachments")
+
+
+def _dataset_query(name: str, args, shard: int, shards: int, after_id: int):
+    """
+    Собираем select для одного датасета.
+    Фильтры (даты/статус/шард) всегда применяются к тикету,
+    сообщения и вложения к нему джойнятся.
+    """
+    if name == "tickets":
+        q = (
+            select(
+                Ticket.id,
+                Ticket.user_id,
+                User.tg_id.label("user_tg_id"),
+                User.username.label("user_username"),
+                Ticket.operator_tg_id,
+                Ticket.status,
+                Ticket.created_at,
+                Ticket.closed_at,
+            )
+            .join(User, User.id == Ticket.user_id)
+        )
+        pk = Ticket.id
+    elif name == "messages":
+        q = (
+            select(
+                TicketMessage.id,
+                TicketMessage.ticket_id,
+                TicketMessage.sender_tg_id,
+                TicketMessage.sender_type,
+                TicketMessage.tg_message_id,
+                TicketMessage.content_type,
+                TicketMessage.message_text,
+                TicketMessage.caption,
+                TicketMessage.created_at,
+            )
+            .join(Ticket, Ticket.id == TicketMessage.ticket_id)
+        )
+        pk = TicketMessage.id
+    else:
+        q = (
+            select(
+                MessageAttachment.id,
+                MessageAttachment.ticket_message_id,
+                MessageAttachment.ticket_id,
+                MessageAttachment.media_type,
+                MessageAttachment.file_id,
+                MessageAttachment.file_unique_id,
+                MessageAttachment.file_name,
+                MessageAttachment.mime_type,
+                MessageAttachment.size,
+                MessageAttachment.width,
+                MessageAttachment.height,
+                MessageAttachment.duration,
+                MessageAttachment.local_path,
+                MessageAttachment.created_at,
+            )
+            .join(TicketMessage, TicketMessage.id == MessageAttachment.ticket_message_id)
+            .join(Ticket, Ticket.id == TicketMessage.ticket_id)
+        )
+        pk = MessageAttachment.id
+
+    if args.since:
+        q = q.where(Ticket.created_at >= args.since)
+    if args.until:
+        q = q.where(Ticket.created_at < args.until)
+    if args.status:
+        q = q.where(Ticket.status.in_([TicketStatus(st) for st in args.status]))
+    if shards > 1:
+        q = q.where(Ticket.id % shards == shard)
+    if after_id:
+        q = q.where(pk > after_id)
+
+    # keyset-порядок по pk — на нём же держится чекпоинт
+    return q.order_by(pk.asc())
+
+
+def _jsonable(v):
+    if isinstance(v, datetime):
+        return v.isoformat()
+    if isinstance(v, Enum):
+        return v.value
+    return v
+
+
+def _arrow_schema(columns):
+    """
+    Схема parquet по типам колонок select, а не по первому батчу: колонка,
+    в которой в первом батче одни NULL (closed_at, file_name...), иначе
+    получит тип null, и следующий батч с значениями не запишется.
+    """
+    import pyarrow as pa
+
+    fields = []
+    for c in columns:
+        t = c.type
+        if isinstance(t, types.Enum):      # Enum — тоже String, проверяем раньше
+            at = pa.string()
+        elif isinstance(t, types.Integer):
+            at = pa.int64()
+        elif isinstance(t, types.Boolean):
+            at = pa.bool_()
+        elif isinstance(t, types.DateTime):
+            at = pa.timestamp("us", tz="UTC" if t.timezone else None)
+        else:
+            at = pa.string()
+        fields.append(pa.field(c.name, at))
+    return pa.schema(fields)
+
+
+def _arrow_value(v):
+    # даты parquet хранит своим типом, enum — строкой
+    return v.value if isinstance(v, Enum) else v
+
+
+class _Writer:
+    """
+    Пишет батчи строк в jsonl / csv / parquet.
+    jsonl и csv дописываются при --resume, parquet — всегда заново.
+    """
+
+    def __init__(self, path: Path, fmt: str, columns: list, append: bool):
+        """columns — q.selected_columns: parquet берет из них схему."""
+        self.fmt = fmt
+        self.columns = [c.name for c in columns]
+        self._pq = None
+        if fmt == "parquet":
+            import pyarrow.parquet as pq  # проверили в _parse_args
+            self._schema = _arrow_schema(columns)
+            self._pq = pq.ParquetWriter(path, self._schema)
+            self._f = None
+            return
+
+        exists = path.exists() and path.stat().st_size > 0
+        self._f = open(path, "a" if append else "w", encoding="utf-8", newline="")
+        if fmt == "csv":
+            self._csv = csv.writer(self._f)
+            if not (append and exists):
+                self._csv.writerow(self.columns)
+
+    def write(self, rows: list[tuple]) -> None:
+        if self.fmt == "jsonl":
+            for r in rows:
+                self._f.write(json.dumps(
+                    {k: _jsonable(v) for k, v in zip(self.columns, r)},
+                    ensure_ascii=False,
+                ))
+                self._f.write("\n")
+        elif self.fmt == "csv":
+            self._csv.writerows([[_jsonable(v) for v in r] for r in rows])
+        else:
+            import pyarrow as pa
+            self._pq.write_table(pa.Table.from_pylist(
+                [{k: _arrow_value(v) for k, v in zip(self.columns, r)} for r in rows],
+                schema=self._schema,
+            ))
+
+    def flush(self) -> None:
+        if self._f:
+            self._f.flush()
+
+    def close(self) -> None:
+        if self._f:
+            self._f.close()
+        if self._pq:
+            self._pq.close()
+
+
+def _load_checkpoint(path: Path) -> dict[str, int]:
+    if path.exists():
+        return json.loads(path.read_text())
+    return {}
+
+
+def _save_checkpoint(path: Path, data: dict[str, int]) -> None:
+    tmp = path.with_suffix(".tmp")
+    tmp.write_text(json.dumps(data))
+    tmp.replace(path)
+
+
+def export_shard(args, shard: int, shards: int) -> dict[str, int]:
+    """
+    Выгружаем все датасеты одного шарда.
+    Возвращаем количество выгруженных строк по каждому датасету.
+    """
+    # после fork не тащим соединения родителя
+    engine.dispose(close=False)
+    if replica_engine is not None:
+        replica_engine.dispose(close=False)
+
+    out = Path(args.out)
+    suffix = f".part{shard}" if shards > 1 else ""
+    ckpt_path = out / f"checkpoint{suffix}.json"
+    ckpt = _load_checkpoint(ckpt_path) if args.resume else {}
+    counts: dict[str, int] = {}
+
+    for name in DATASETS:
+        after_id = ckpt.get(name, 0)
+        q = _dataset_query(name, args, shard, shards, after_id)
+        path = out / f"{name}{suffix}.{args.format}"
+        w = _Writer(path, args.format, list(q.selected_columns), append=args.resume)
+        counts[name] = 0
+
+        try:
+            # выгрузка — чистое чтение, идет на реплику, если она есть и не отстает
+            with read_session() as s:
+                # yield_per включает stream_results -> серверный курсор psycopg2
+                result = s.execute(q.execution_options(yield_per=BATCH))
+                for part in result.partitions():
+                    rows = [tuple(r) for r in part]
+                    w.write(rows)
+                    w.flush()
+                    counts[name] += len(rows)
+                    # чекпоинт двигаем только после того, как батч записан
+                    ckpt[name] = rows[-1][0]
+                    _save_checkpoint(ckpt_path, ckpt)
+        finally:
+            w.close()
+
+    return counts
+
+
+def _parse_args(argv=None):
+    p = argparse.ArgumentParser(prog="python -m src.export", description="Выгрузка тикетов и переписки")
+    p.add_argument("--out", default="export", help="папка для файлов выгрузки")
+    p.add_argument("--format", choices=("jsonl", "csv", "parquet"), default="jsonl")
+    p.add_argument("--since", type=datetime.fromisoformat, help="created_at тикета >= (ISO дата)")
+    p.add_argument("--until", type=datetime.fromisoformat, help="created_at тикета < (ISO дата)")
+    p.add_argument("--status", action="append", choices=[st.value for st in TicketStatus],
+                   help="фильтр по статусу тикета, можно несколько раз")
+    p.add_argument("--workers", type=int, default=1, help="число параллельных шардов")
+    p.add_argument("--resume", action="store_true", help="продолжить с последнего чекпоинта")
+    args = p.parse_args(argv)
+
+    if args.format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            p.error("для --format parquet нужен pyarrow (pip install pyarrow)")
+        if args.resume:
+            p.error("--resume не поддерживается для parquet, используйте jsonl/csv")
+    if args.workers < 1:
+        p.error("--workers должен быть >= 1")
+    return args
+
+
+def main(argv=None) -> None:
+    args = _parse_args(argv)
+    Path(args.out).mkdir(parents=True, exist_ok=True)
+
+    if args.workers == 1:
+        results = [export_shard(args, 0, 1)]
+    else:
+        with ProcessPoolExecutor(max_workers=args.workers) as pool:
+            futures = [pool.submit(export_shard, args, k, args.workers) for k in range(args.workers)]
+            results = [f.result() for f in futures]
+
+    for name in DATASETS:
+        print(f"{name}: {sum(r[name] for r in results)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""
+Жизненный цикл процесса: готовность, мягкая остановка, недоделанная работа.
+
+Старт. start() — последний startup-хук: ждем слушателя NOTIFY, прогреваем кэш
+диалогов одним запросом, прогоняем то, что не доделал прошлый процесс, и только
+тогда "ready". aiogram начинает polling после startup-хуков, супервизор
+(src/cluster.py) — когда готовы все воркеры, так что первые апдейты после
+раскатки не бьют в холодный кэш. /readyz отвечает 200 только в "ready".
+
+Остановка (SIGTERM). aiogram / супервизор перестают забирать апдейты, drain() —
+первый shutdown-хук: /readyz сразу 503, апдейты, которые уже в обработке, и
+постобработку вложений ждем не дольше DRAIN_TIMEOUT_S. В SPOOL_DIR/unfinished-*.json
+уходят только апдейты, до хендлера не дошедшие (очередь воркера, lifecycle.queued),
+и id сообщений без постобработки; следующий процесс прогонит их при старте.
+Начатый хендлер на диск не пишем и не отменяем — он доделывается или падает сам:
+хендлеры коммитят по ходу (анкета создает тикет, claim назначает оператора), и
+повтор с начала завел бы второй тикет или взял тикет еще раз. Хендлер, не
+успевший до конца процесса, теряется — это видно в логе и в stats.
+Остальные хуки (outbox, карточки) укладываются в тот же срок — remaining().
+
+FSM (анкеты гарантии и вопросов) живет в памяти, поэтому drain() последним
+делом пишет непустые состояния в SPOOL_DIR/fsm-*.json, а start() поднимает их до
+прогона недоделанного — иначе после выкладки клиент посреди анкеты проваливается
+в proxy, и его сообщения теряются.
+
+С WORKERS>1 файлы читают все воркеры, каждый берет только свои чаты (то же
+кольцо, что у супервизора), удаляет их супервизор, когда все воркеры готовы.
+
+Health-сервер (HEALTH_PORT, 0 — не поднимать): /healthz — процесс жив,
+/readyz — готов принимать апдейты.
+"""
+import asyncio
+import dataclasses
+import json
+import logging
+import os
+import time
+from collections import Counter
+from pathlib import Path
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.types import Update
+from aiohttp import web
+
+from src.cluster import HashRing, shard_key
+from src.config import settings
+from src.db import cache, notify, queries
+from src.db.base import SessionLocal
+from src.utils import media_post
+
+log = logging.getLogger(__name__)
+
+LISTENER_WAIT_S = 10
+
+state = "starting"   # starting -> ready -> draining -> stopped
+
+stats = {
+    "warmed_dialogs": 0,
+    "resumed_updates": 0,
+    "resumed_postprocess": 0,
+    "saved_updates": 0,
+    "saved_postprocess": 0,
+    "abandoned_updates": 0,
+    "saved_fsm": 0,
+    "restored_fsm": 0,
+    "drain_ms": 0,
+}
+
+# update_id -> апдейт, который сейчас в хендлере
+_inflight: dict[int, Update] = {}
+# получены, но еще не начаты (очередь воркера в src/cluster.py): update_id -> сырой апдейт
+queued: dict[int, dict] = {}
+_idle = asyncio.Event()
+_idle.set()
+_deadline: float | None = None
+_runner: web.AppRunner | None = None
+_ring: HashRing | None = None
+
+# доп. маршруты health-сервера: (путь, async handler(request))
+routes: list[tuple[str, object]] = []
+
+
+def set_state(new: str) -> None:
+    global state
+    if state != new:
+        log.info("lifecycle: %s -> %s", state, new)
+        state = new
+
+
+def accepting() -> bool:
+    return state in ("starting", "ready")
+
+
+def owns(chat_id: int, worker_index: int) -> bool:
+    """Этот ли воркер обслуживает чат (с WORKERS=1 — всегда)."""
+    global _ring
+    if settings.workers <= 1:
+        return True
+    if _ring is None:
+        _ring = HashRing(settings.workers)
+    return _ring.node(chat_id) == worker_index
+
+
+def spool_files() -> list[Path]:
+    """Файлы, которые прогоняет start(): недоделанные апдейты и FSM."""
+    d = Path(settings.spool_dir)
+    return sorted(d.glob("unfinished-*.json")) + sorted(d.glob("fsm-*.json"))
+
+
+def remaining() -> float:
+    """Сколько осталось до конца drain (до его начала — весь DRAIN_TIMEOUT_S)."""
+    if _deadline is None:
+        return float(settings.drain_timeout_s)
+    return max(0.0, _deadline - time.monotonic())
+
+
+class InFlight(BaseMiddleware):
+    """Outer-middleware диспетчера: какие апдейты сейчас в обработке."""
+
+    async def __call__(self, handler, event: Update, data):
+        _inflight[event.update_id] = event
+        _idle.clear()
+        try:
+            return await handler(event, data)
+        finally:
+            _inflight.pop(event.update_id, None)
+            if not _inflight:
+                _idle.set()
+
+
+# -------------------------
+# старт
+# -------------------------
+
+def _active_dialogs() -> list[tuple[int, tuple[str, int, int]]]:
+    """Записи для cache.dialogs по всем диалогам ASSIGNED (как _dialog в proxy)."""
+    with SessionLocal() as s:
+        rows = queries.active_dialogs(s)
+    # у оператора несколько диалогов — какой взять, решит запрос в proxy
+    ops = Counter(r.operator_tg_id for r in rows)
+    items = []
+    for r in rows:
+        items.append((r.user_tg_id, ("user", r.ticket_id, r.operator_tg_id)))
+        if ops[r.operator_tg_id] == 1:
+            items.append((r.operator_tg_id, ("operator", r.ticket_id, r.user_tg_id)))
+    return items
+
+
+async def _warm() -> None:
+    # без слушателя кэши не работают (src/db/cache.py) — греть нечего
+    for _ in range(LISTENER_WAIT_S * 10):
+        if notify.connected():
+            break
+        await asyncio.sleep(0.1)
+    else:
+        log.warning("lifecycle: NOTIFY listener not connected, starting with cold caches")
+        return
+    if settings.cache_ttl_s <= 0:
+        return
+    gen = cache.dialogs.generation()
+    items = await asyncio.to_thread(_active_dialogs)
+    stats["warmed_dialogs"] = cache.dialogs.fill(items, gen)
+
+
+def _claim_unfinished() -> list[Path]:
+    """Забираем файлы прошлых процессов себе (rename атомарен — двое не возьмут один)."""
+    if settings.workers > 1:
+        # читают все воркеры, каждый свои апдейты; удаляет супервизор (src/cluster.py)
+        return sorted(Path(settings.spool_dir).glob("unfinished-*.json"))
+    claimed = []
+    for p in sorted(Path(settings.spool_dir).glob("unfinished-*.json")):
+        mine = p.with_name(f"{p.name}.{os.getpid()}.resuming")
+        try:
+            p.rename(mine)
+        except FileNotFoundError:
+            continue
+        claimed.append(mine)
+    return claimed
+
+
+async def _restore_fsm(dispatcher: Dispatcher, worker_index: int) -> None:
+    storage = dispatcher.storage
+    if not isinstance(storage, MemoryStorage):
+        return  # хранилище и так переживает рестарт
+    for path in sorted(Path(settings.spool_dir).glob("fsm-*.json")):
+        try:
+            records = json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            log.exception("lifecycle: can't read %s", path)
+            continue
+        for r in records:
+            key = StorageKey(**r["key"])
+            if not owns(key.chat_id, worker_index):
+                continue
+            await storage.set_state(key, r["state"])
+            await storage.set_data(key, r["data"])
+            stats["restored_fsm"] += 1
+        if settings.workers <= 1:
+            path.unlink(missing_ok=True)
+    if stats["restored_fsm"]:
+        log.info("lifecycle: restored %s FSM states", stats["restored_fsm"])
+
+
+async def _resume(bot: Bot, dispatcher: Dispatcher, worker_index: int) -> None:
+    for path in _claim_unfinished():
+        try:
+            data = json.loads(path.read_text(encoding="utf-8"))
+        except Exception:
+            log.exception("lifecycle: can't read %s", path)
+            continue
+        for raw in data.get("updates", []):
+            if not owns(shard_key(raw), worker_index):
+                continue
+            try:
+                await dispatcher.feed_raw_update(bot, raw)
+            except Exception:
+                log.exception("lifecycle: resumed update %s failed", raw.get("update_id"))
+            stats["resumed_updates"] += 1
+        if worker_index == 0:
+            for tm_id in data.get("postprocess", []):
+                media_post.schedule_postprocess(tm_id)
+                stats["resumed_postprocess"] += 1
+        if settings.workers <= 1:
+            path.unlink(missing_ok=True)
+    if stats["resumed_updates"] or stats["resumed_postprocess"]:
+        log.info("lifecycle: resumed %s updates, %s postprocess jobs",
+                 stats["resumed_updates"], stats["resumed_postprocess"])
+
+
+async def start(bot: Bot, dispatcher: Dispatcher, worker_index: int = 0) -> None:
+    """startup-хук, последний: прогрев, FSM и недоделанное прошлым процессом, готовность."""
+    await _warm()
+    await _restore_fsm(dispatcher, worker_index)
+    await _resume(bot, dispatcher, worker_index)
+    set_state("ready")
+
+
+# -------------------------
+# остановка
+# -------------------------
+
+def _write(prefix: str, payload) -> Path:
+    d = Path(settings.spool_dir)
+    d.mkdir(parents=True, exist_ok=True)
+    path = d / f"{prefix}-{time.time_ns()}-{os.getpid()}.json"
+    tmp = path.with_suffix(".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(payload, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return path
+
+
+def _save(updates: list[dict], postprocess: list[int]) -> None:
+    path = _write("unfinished", {"updates": updates, "postprocess": postprocess})
+    log.warning("lifecycle: %s updates, %s postprocess jobs left for the next start -> %s",
+                len(updates), len(postprocess), path)
+
+
+def _fsm_records(dispatcher: Dispatcher | None) -> list[dict]:
+    storage = getattr(dispatcher, "storage", None)
+    if not isinstance(storage, MemoryStorage):
+        return []
+    records = []
+    for key, record in list(storage.storage.items()):
+        if record.state is None and not record.data:
+            continue
+        r = {"key": dataclasses.asdict(key), "state": record.state, "data": record.data}
+        try:
+            json.dumps(r)
+        except (TypeError, ValueError):
+            log.warning("lifecycle: FSM data of chat %s is not JSON, not saved", key.chat_id)
+            continue
+        records.append(r)
+    return records
+
+
+async def drain(dispatcher: Dispatcher | None = None) -> None:
+    """shutdown-хук, первый: дожидаемся начатого, остальное — на диск."""
+    global _deadline
+    set_state("draining")
+    t0 = time.monotonic()
+    _deadline = t0 + settings.drain_timeout_s
+    try:
+        await asyncio.wait_for(_idle.wait(), remaining())
+    except asyncio.TimeoutError:
+        pass
+    if _inflight:
+        # не повторяем: хендлер мог уже закоммитить часть работы
+        stats["abandoned_updates"] += len(_inflight)
+        log.warning("lifecycle: %s updates still in handlers after DRAIN_TIMEOUT_S, not saved: %s",
+                    len(_inflight), sorted(_inflight))
+    postprocess = await media_post.drain(remaining())
+    updates = list(queued.values())
+    queued.clear()
+    # состояния — после ожидания хендлеров; что поменяет еще не доделанный, не сохранится
+    fsm = _fsm_records(dispatcher)
+    stats["drain_ms"] = int((time.monotonic() - t0) * 1000)
+    if updates or postprocess:
+        stats["saved_updates"] += len(updates)
+        stats["saved_postprocess"] += len(postprocess)
+        await asyncio.to_thread(_save, updates, postprocess)
+    if fsm:
+        stats["saved_fsm"] += len(fsm)
+        await asyncio.to_thread(_write, "fsm", fsm)
+        log.info("lifecycle: %s FSM states saved for the next start", len(fsm))
+
+
+async def stopped() -> None:
+    """shutdown-хук, последний."""
+    set_state("stopped")
+
+
+# -------------------------
+# health
+# -------------------------
+
+async def _healthz(request: web.Request) -> web.Response:
+    return web.json_response({"state": state})
+
+
+async def _readyz(request: web.Request) -> web.Response:
+    return web.json_response({"state": state}, status=200 if state == "ready" else 503)
+
+
+async def start_health() -> None:
+    global _runner
+    if not settings.health_port or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/healthz", _healthz)
+    app.router.add_get("/readyz", _readyz)
+    for path, handler in routes:
+        app.router.add_get(path, handler)  # type: ignore[arg-type]
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, settings.health_host, settings.health_port).start()
+    log.info("health on %s:%s", settings.health_host, settings.health_port)
+
+
+async def stop_health() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
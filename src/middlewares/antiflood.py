@@ -0,0 +1,184 @@
+"""
+Антифлуд: лимит сообщений на пользователя, отдельно для каждого роутера.
+
+Каждое сообщение — это insert в ticket_messages, возможно скачивание, copy_message
+собеседнику и перезапись FSM. Один клиент, который шлет сотни сообщений в секунду,
+иначе займет весь пул соединений с базой.
+
+FLOOD_LIMITS="public=1/5,proxy=2/10" — роутер=сообщений в секунду/пачка (off — выключить).
+Алгоритм — token bucket в виде GCRA: на пользователя хранится одно число
+(момент, когда ведро снова будет полным).
+- В пределах пачки сообщение проходит сразу.
+- Сверх нее — ждет своей очереди (порядок сообщений сохраняется), но не
+  дольше FLOOD_MAX_DELAY_S.
+- Дальше — выбрасывается; пользователь один раз получает texts.FLOOD_WARNING.
+- Альбом (media_group_id) считается одним сообщением: его части идут следом за первой.
+Пользователи с полным ведром забываются раз в FLOOD_IDLE_S.
+
+Лимит — outer-middleware роутера: считаются только сообщения, которые этот роутер
+возьмет (есть подходящий хендлер), а хендлер выбирается уже после ожидания — по
+состоянию FSM на этот момент (raw_state перечитываем). Кнопки того же пользователя
+в этом роутере ждут, пока его отложенные сообщения обработаются: иначе "✅ Готово"
+обгоняет фото, которые отправлены раньше, закрывает анкету, и фото не попадают
+в заявку.
+Счетчики — stats[роутер].
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import BaseMiddleware, Router
+from aiogram.dispatcher.event.telegram import TelegramEventObserver
+from aiogram.types import CallbackQuery, Message
+
+from src import texts
+from src.config import settings
+
+log = logging.getLogger(__name__)
+
+HANDLER_GRACE_S = 30  # сколько кнопка сверх FLOOD_MAX_DELAY_S ждет отложенные сообщения
+
+stats: dict[str, dict[str, int]] = {}
+
+
+def _parse_limits(spec: str) -> dict[str, tuple[float, int]]:
+    limits = {}
+    for part in spec.split(","):
+        name, _, limit = part.strip().partition("=")
+        rate, _, burst = limit.partition("/")
+        if name and rate:
+            limits[name] = (float(rate), int(burst or 1))
+    return limits
+
+
+class AntiFlood(BaseMiddleware):
+    def __init__(self, name: str, rate: float, burst: int, observer: TelegramEventObserver | None = None):
+        self.name = name
+        self.observer = observer
+        self.interval = 1 / rate
+        self.tolerance = (burst - 1) * self.interval
+        self._tat: dict[int, float] = {}
+        # последний альбом пользователя: media_group_id -> когда пропускаем его части
+        self._albums: dict[int, tuple[str, float]] = {}
+        self._warned: set[int] = set()
+        # пропущенные, но еще не обработанные сообщения пользователя
+        self._pending: dict[int, int] = {}
+        self._settled: dict[int, asyncio.Event] = {}
+        self._swept = time.monotonic()
+        self.stats = stats.setdefault(name, {"passed": 0, "delayed": 0, "dropped": 0, "coalesced": 0, "users": 0})
+
+    def _sweep(self, now: float) -> None:
+        self._swept = now
+        self._tat = {uid: tat for uid, tat in self._tat.items() if tat > now}
+        self._albums = {uid: a for uid, a in self._albums.items() if uid in self._tat}
+        self._warned &= self._tat.keys()
+        self.stats["users"] = len(self._tat)
+
+    def _slot(self, uid: int, album: str | None) -> float | None:
+        """Через сколько секунд пропустить сообщение; None — выбросить."""
+        now = time.monotonic()
+        if now - self._swept > settings.flood_idle_s:
+            self._sweep(now)
+
+        if album is not None:
+            last = self._albums.get(uid)
+            if last is not None and last[0] == album:
+                self.stats["coalesced"] += 1
+                return max(last[1] - now, 0.0)
+
+        tat = max(self._tat.get(uid, now), now)
+        delay = tat - self.tolerance - now
+        if delay > settings.flood_max_delay_s:
+            self.stats["dropped"] += 1
+            return None
+        self._tat[uid] = tat + self.interval
+        if album is not None:
+            self._albums[uid] = (album, now + max(delay, 0.0))
+        self._warned.discard(uid)
+        return max(delay, 0.0)
+
+    async def _handles(self, event: Message, data: dict) -> bool:
+        """Есть ли в роутере хендлер для сообщения (чужие сообщения не считаем)."""
+        if self.observer is None:
+            return True
+        for h in self.observer.handlers:
+            ok, _ = await h.check(event, **data)
+            if ok:
+                return True
+        return False
+
+    def _enter(self, uid: int) -> None:
+        self._pending[uid] = self._pending.get(uid, 0) + 1
+        self._settled.setdefault(uid, asyncio.Event()).clear()
+
+    def _leave(self, uid: int) -> None:
+        left = self._pending[uid] - 1
+        if left:
+            self._pending[uid] = left
+        else:
+            del self._pending[uid]
+            self._settled.pop(uid).set()
+
+    async def settled(self, uid: int) -> None:
+        """Дождаться, пока пропущенные сообщения пользователя обработаются."""
+        ev = self._settled.get(uid)
+        if ev is None:
+            return
+        try:
+            await asyncio.wait_for(ev.wait(), settings.flood_max_delay_s + HANDLER_GRACE_S)
+        except asyncio.TimeoutError:
+            log.warning("flood: %s still has pending messages in %s, not waiting", uid, self.name)
+
+    async def __call__(self, handler, event: Message, data):
+        user = event.from_user
+        if user is None or not await self._handles(event, data):
+            return await handler(event, data)
+
+        delay = self._slot(user.id, event.media_group_id)
+        if delay is None:
+            if user.id not in self._warned:
+                self._warned.add(user.id)
+                log.warning("flood from %s in %s: dropping messages", user.id, self.name)
+                try:
+                    await event.answer(texts.FLOOD_WARNING)
+                except Exception:
+                    pass
+            return None
+        self._enter(user.id)
+        try:
+            if delay > 0:
+                self.stats["delayed"] += 1
+                await asyncio.sleep(delay)
+                # пока ждали, состояние могло смениться — хендлер выбираем по текущему
+                state = data.get("state")
+                if state is not None:
+                    raw_state = await state.get_state()
+                    if raw_state != data.get("raw_state"):
+                        log.info("flood: state of %s changed while message %s waited: %s -> %s",
+                                 user.id, event.message_id, data.get("raw_state"), raw_state)
+                        data["raw_state"] = raw_state
+            self.stats["passed"] += 1
+            return await handler(event, data)
+        finally:
+            self._leave(user.id)
+
+
+class _Barrier(BaseMiddleware):
+    """Кнопки пользователя ждут его отложенных сообщений (порядок действий сохраняется)."""
+
+    def __init__(self, limiter: AntiFlood):
+        self.limiter = limiter
+
+    async def __call__(self, handler, event: CallbackQuery, data):
+        await self.limiter.settled(event.from_user.id)
+        return await handler(event, data)
+
+
+def protect(router: Router, name: str) -> None:
+    """Повесить лимит FLOOD_LIMITS[name] на сообщения роутера (если он задан)."""
+    limit = _parse_limits(settings.flood_limits).get(name)
+    if limit is None:
+        return
+    limiter = AntiFlood(name, *limit, observer=router.message)
+    router.message.outer_middleware(limiter)
+    router.callback_query.outer_middleware(_Barrier(limiter))
@@ -0,0 +1,43 @@
+"""
+Повторно доставленные апдейты (вебхук переотправил, после рестарта getUpdates
+отдал то, что мы уже начали обрабатывать) отбрасываем до хендлеров — до базы и сети.
+
+RecentUpdates — outer-middleware диспетчера: помнит DEDUP_UPDATES последних
+update_id. Переживает только дубли в пределах процесса; после рестарта от
+повторной записи реплики защищает уникальный ключ ticket_messages
+(src/db/messages.py).
+"""
+import logging
+from collections import deque
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from src.config import settings
+
+log = logging.getLogger(__name__)
+
+stats = {"duplicates": 0}
+
+
+class RecentUpdates(BaseMiddleware):
+    def __init__(self, size: int | None = None):
+        self.size = size or settings.dedup_updates
+        self._seen: set[int] = set()
+        self._order: deque[int] = deque()
+
+    def clear(self) -> None:
+        self._seen.clear()
+        self._order.clear()
+
+    async def __call__(self, handler, event: Update, data):
+        uid = event.update_id
+        if uid in self._seen:
+            stats["duplicates"] += 1
+            log.info("duplicate update %s dropped", uid)
+            return None
+        self._seen.add(uid)
+        self._order.append(uid)
+        if len(self._order) > self.size:
+            self._seen.discard(self._order.popleft())
+        return await handler(event, data)
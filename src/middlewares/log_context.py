@@ -0,0 +1,49 @@
+"""
+Контекст логов для каждого апдейта (см. src/utils/logging.py).
+
+UpdateContext — outer-middleware диспетчера: update_id, chat_id, ticket_id из
+callback-данных вида "claim:123"; апдейт дольше LOG_SLOW_UPDATE_MS — warning.
+HandlerContext — inner-middleware роутеров: имя сработавшего хендлера.
+"""
+import logging
+import re
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from src.config import settings
+from src.utils.logging import bind, bound
+
+log = logging.getLogger(__name__)
+
+_TICKET_DATA = re.compile(r"^\w+:(\d+)$")
+
+
+class UpdateContext(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data):
+        fields = {"update_id": event.update_id}
+        chat = data.get("event_chat")
+        if chat is not None:
+            fields["chat_id"] = chat.id
+        cq = event.callback_query
+        if cq is not None and cq.data:
+            m = _TICKET_DATA.match(cq.data)
+            if m:
+                fields["ticket_id"] = int(m.group(1))
+
+        with bound(**fields):
+            t0 = time.perf_counter()
+            try:
+                return await handler(event, data)
+            finally:
+                took = (time.perf_counter() - t0) * 1000
+                if settings.log_slow_update_ms and took >= settings.log_slow_update_ms:
+                    log.warning("slow update %.0fms (%s)", took, event.event_type)
+
+
+class HandlerContext(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        h = data.get("handler")
+        bind(handler=getattr(getattr(h, "callback", None), "__name__", None))
+        return await handler(event, data)
@@ -0,0 +1,211 @@
+"""
+Запись входящих апдейтов для воспроизведения (python -m bench.replay).
+
+Включается RECORD_UPDATES=путь.jsonl.gz. Recorder — outer-middleware диспетчера
+(внутри UpdateContext): после обработки кладет в буфер строку
+    {"t": время прихода, "tid": ticket_id из контекста логов, "h": хендлер,
+     "ms": сколько обрабатывали, "u": апдейт}
+раз в секунду буфер дописывается в gzip в отдельном потоке. Файл только
+растет; после рестарта — новый gzip-member в тот же файл с заголовком
+{"v": 1, "operators_chat_id": ...}. Gzip сбрасывается на каждой записи, так что
+при падении теряется не больше последней секунды. Больше RECORD_MAX_MB — запись
+останавливается.
+
+Персональные данные не пишутся. Пишутся только поля из _KEEP — то, что нужно
+роутерам при воспроизведении; остальное (пересылки, venue, подписи, новые поля
+Bot API) в запись не попадает вовсе. Из того, что пишется:
+  - id пользователей (положительные) — хэш с RECORD_SALT, связи между апдейтами
+    сохраняются; id групп (операторский чат) как есть;
+  - имена, username, название чата, телефоны, vcard — хэш; имя файла — хэш с
+    прежним расширением;
+  - text / caption — хэш той же длины, команда в начале (/start, /phone) остается;
+  - координаты — обнуляются.
+RECORD_SALT пустой — случайная соль на процесс (файлы разных процессов не связать).
+С WORKERS>1 каждый воркер пишет свой файл: {worker} в пути или суффикс .N.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from src.config import settings
+from src.utils.logging import context
+
+log = logging.getLogger(__name__)
+
+FLUSH_S = 1.0
+
+# что пишем как есть (вложенное — тоже через scrub); у каждого объекта здесь
+# все обязательные поля, иначе aiogram не разберет апдейт при воспроизведении
+_KEEP = {
+    "update_id", "message", "edited_message", "callback_query",
+    "id", "message_id", "date", "edit_date", "chat", "from", "type", "is_bot", "language_code",
+    "data", "chat_instance", "inline_message_id", "media_group_id", "message_thread_id",
+    "is_topic_message", "reply_to_message",
+    "photo", "document", "video", "voice", "audio", "video_note", "animation", "sticker",
+    "contact", "location", "thumbnail",
+    "file_id", "file_unique_id", "file_size", "width", "height", "duration", "length", "mime_type",
+    "is_animated", "is_video",
+}
+_HASHED = {"first_name", "last_name", "username", "title", "phone_number", "vcard"}
+_MASKED = {"text", "caption"}
+_IDS = {"user_id"}
+_ID_HOLDERS = {"from", "chat"}
+_COORDS = {"latitude", "longitude"}
+
+stats = {
+    "recorded": 0,
+    "bytes": 0,
+    "dropped": 0,
+}
+
+_salt = b""
+_buf: list[str] = []
+_file: gzip.GzipFile | None = None
+_path = ""
+_flusher: asyncio.Task | None = None
+_lock = asyncio.Lock()  # сброс из цикла и из stop() не пишут в gzip одновременно
+
+
+def _digest(value: str) -> str:
+    return hashlib.blake2b(value.encode(), key=_salt, digest_size=16).hexdigest()
+
+
+def hash_id(value: int) -> int:
+    """Стабильный (в пределах соли) псевдо-id пользователя: положительный, влезает в bigint."""
+    if value <= 0:
+        return value
+    return 10**12 + int(_digest(str(value)), 16) % 10**12
+
+
+def _mask(text: str) -> str:
+    keep = ""
+    if text.startswith("/"):
+        keep, sep, rest = text.partition(" ")
+        keep += sep
+        text = rest
+    if not text:
+        return keep
+    d = _digest(text)
+    return keep + (d * (len(text) // len(d) + 1))[:len(text)]
+
+
+def scrub(obj, key: str | None = None):
+    """Копия апдейта без персональных данных (см. docstring модуля)."""
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if k in _HASHED and isinstance(v, str):
+                out[k] = _digest(v)[:len(v) or 1]
+            elif k == "file_name" and isinstance(v, str):
+                stem, dot, ext = v.rpartition(".")
+                out[k] = _digest(stem or v)[:12] + (dot + ext if stem else "")
+            elif k in _MASKED and isinstance(v, str):
+                out[k] = _mask(v)
+            elif k in _COORDS:
+                out[k] = 0.0
+            elif k == "id" and key in _ID_HOLDERS and isinstance(v, int):
+                out[k] = hash_id(v)
+            elif k in _IDS and isinstance(v, int):
+                out[k] = hash_id(v)
+            elif k in ("entities", "caption_entities"):
+                # смещения сущностей после маски не совпадут — оставляем только команду
+                out[k] = [e for e in v if e.get("type") == "bot_command" and e.get("offset") == 0]
+            elif k in _KEEP:
+                out[k] = scrub(v, k)
+        return out
+    if isinstance(obj, list):
+        return [scrub(v, key) for v in obj]
+    return obj
+
+
+class Recorder(BaseMiddleware):
+    async def __call__(self, handler, event: Update, data):
+        t = time.time()
+        t0 = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            if _file is not None:
+                ctx = context()
+                raw = event.model_dump(mode="json", by_alias=True, exclude_none=True)
+                _buf.append(json.dumps({
+                    "t": round(t, 3),
+                    "tid": ctx.get("ticket_id"),
+                    "h": ctx.get("handler"),
+                    "ms": round((time.perf_counter() - t0) * 1000, 2),
+                    "u": scrub(raw),
+                }, ensure_ascii=False, separators=(",", ":")))
+
+
+def _write(lines: list[str]) -> None:
+    assert _file is not None
+    _file.write(("\n".join(lines) + "\n").encode())
+    _file.flush()
+    stats["bytes"] = os.path.getsize(_path)
+
+
+async def _flush() -> None:
+    global _file
+    async with _lock:
+        if not _buf or _file is None:
+            return
+        lines = _buf[:]
+        _buf.clear()
+        await asyncio.to_thread(_write, lines)
+        stats["recorded"] += len(lines)
+        if stats["bytes"] > settings.record_max_mb * 1024 * 1024:
+            log.warning("recorder: %s is over RECORD_MAX_MB, recording stopped", _path)
+            await asyncio.to_thread(_file.close)
+            _file = None
+
+
+async def _flush_loop() -> None:
+    while True:
+        await asyncio.sleep(FLUSH_S)
+        try:
+            await _flush()
+        except Exception:
+            stats["dropped"] += 1
+            log.exception("recorder: write failed")
+
+
+def _path_for(worker_index: int) -> str:
+    path = settings.record_updates
+    if "{worker}" in path:
+        return path.format(worker=worker_index)
+    return f"{path}.{worker_index}" if worker_index else path
+
+
+async def start(bot=None, worker_index: int = 0) -> None:
+    """startup-хук: открываем файл (дописываем новым gzip-member)."""
+    global _file, _path, _salt, _flusher
+    if not settings.record_updates:
+        return
+    # ключ blake2b — не длиннее 64 байт
+    _salt = hashlib.blake2b(settings.record_salt.encode()).digest()[:32] if settings.record_salt else os.urandom(16)
+    _path = _path_for(worker_index)
+    os.makedirs(os.path.dirname(_path) or ".", exist_ok=True)
+    _file = gzip.open(_path, "ab", compresslevel=6)
+    header = {"v": 1, "operators_chat_id": settings.operators_chat_id, "started": round(time.time(), 3)}
+    _buf.insert(0, json.dumps(header))
+    _flusher = asyncio.create_task(_flush_loop())
+    log.info("recording updates to %s", _path)
+
+
+async def stop() -> None:
+    global _file, _flusher
+    if _flusher is not None:
+        _flusher.cancel()
+        _flusher = None
+    await _flush()
+    async with _lock:
+        if _file is not None:
+            await asyncio.to_thread(_file.close)
+            _file = None
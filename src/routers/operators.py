@@ -1,24 +1,40 @@
-from datetime import datetime, timezone
+import asyncio
+import html
 
 from aiogram import Router, F
-from aiogram.types import CallbackQuery
+from aiogram.filters import Command, CommandObject
+from aiogram.types import CallbackQuery, FSInputFile, Message
 
-from sqlalchemy import select
+from sqlalchemy import select, update, func
 
-from src.db.base import SessionLocal
-from src.db.models import Ticket, TicketStatus, User, TicketMessage
+from src.config import settings
+from src.db.base import SessionLocal, read_session
+from src.db.models import Ticket, TicketStatus, User
+from src.db import queries, cache
 from src.keyboards.operator import finish_kb, operator_controls_kb
 from src.keyboards.main import ok_kb
 from src.texts import OP_CONNECTED, OP_DISCONNECTED
-from src.db.users import upsert_user_from_tg
+from src.db.users import find_user_by_phone
+from src.db.sla import record_claim, record_close, summary
+from src.utils.transcript import render_user_history
+from src.utils.media_post import find_reused_photos
+from src.tasks import cards
 
 router = Router()
 
-def _fmt(dt: datetime | None) -> str:
-    if not dt:
-        return "—"
-    return dt.strftime("%Y-%m-%d %H:%M")
 
+def _from_operator(m: Message) -> bool:
+    """Оператор — по флагу в users или любой участник операторского чата."""
+    if m.chat.id == settings.operators_chat_id:
+        return True
+    with read_session() as s:
+        return bool(s.scalar(select(User.is_operator).where(User.tg_id == m.from_user.id)))  # type: ignore
+
+
+# сообщения здесь — только команды операторов; /phone или /stats от клиента идут
+# дальше, в proxy (клиент в диалоге может написать и такое). Сначала дешевая проверка
+# на "/" — обычные реплики мимо этого роутера не должны ходить в базу
+router.message.filter(F.text.startswith("/"), _from_operator)
 
 def _ctype_emoji(ct: str) -> str:
     return {
@@ -39,8 +55,10 @@ def _get_operator_nickname(s, operator_tg_id: int | None) -> str:
     """
     if not operator_tg_id:
         return '👮 Оператор'
-    
-    op = s.scalar(select(User).where(User.tg_id == operator_tg_id))
+    return cache.users.get_or_load(operator_tg_id, lambda: _load_operator_nickname(s, operator_tg_id))
+
+def _load_operator_nickname(s, operator_tg_id: int) -> str:
+    op = s.execute(select(User.username, User.first_name).where(User.tg_id == operator_tg_id)).first()
     if op:
         if op.username:
             return f"👮 Оператор @{op.username}"
@@ -67,33 +85,39 @@ async def claim_ticket(c: CallbackQuery):
     ticket_id = int(c.data.split(':')[1])  # type: ignore
     operator_id = c.from_user.id
 
-    with SessionLocal() as s:
-        upsert_user_from_tg(s, c.from_user, mark_operator=True)
-        s.commit()
+    card = {}
+    if c.message and c.message.chat.id == settings.operators_chat_id:
+        # нажали на саму карточку: ее id знаем, даже если outbox еще не успел записать
+        card = dict(card_chat_id=func.coalesce(Ticket.card_chat_id, c.message.chat.id),
+                    card_message_id=func.coalesce(Ticket.card_message_id, c.message.message_id))
 
-        t = s.get(Ticket, ticket_id)
-        if not t or t.status != TicketStatus.waiting:
+    with SessionLocal() as s:
+        # условный UPDATE: при нескольких процессах два оператора
+        # могут нажать одновременно, тикет достанется только одному.
+        # Сначала он, потом upsert оператора: опоздавший клик — один запрос
+        claimed = s.execute(
+            update(Ticket)
+            .where(Ticket.id == ticket_id, Ticket.status == TicketStatus.waiting)
+            .values(status=TicketStatus.assigned, operator_tg_id=operator_id, claimed_at=func.now(), **card)
+            .returning(Ticket.operator_tg_id, Ticket.kind, Ticket.created_at,
+                       Ticket.notified_at, Ticket.claimed_at)
+        ).first()
+        if not claimed:
+            s.rollback()
             await c.answer('Уже занято или неактуально', show_alert=True)
             return
-
-        t.status = TicketStatus.assigned
-        t.operator_tg_id = operator_id
+        record_claim(s, claimed)
+        queries.touch_user(s, c.from_user, mark_operator=True)
+        u = queries.ticket_user(s, ticket_id)
+        cache.publish(s, cache.dialogs, operator_id, u.tg_id)
         s.commit()
-
-        u = s.get(User, t.user_id)
+        cards.touch(ticket_id)
 
         # все сообщения пользователя по тикету, по порядку
-        user_msgs = s.scalars(
-            select(TicketMessage)
-            .where(
-                TicketMessage.ticket_id == ticket_id,
-                TicketMessage.sender_type == "user",
-            )
-            .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc())
-        ).all()
+        user_msgs = queries.user_messages(s, ticket_id)
 
-    username = f"@{u.username}" if getattr(u, "username", None) else "—"
-    first = u.first_name or "—"
+    username = f"@{html.escape(u.username)}" if u.username else "—"
+    first = html.escape(u.first_name or "—")
     msg = (
         f"Вы взяли тикет #{ticket_id} (пользователь {first}, {username}).\n"
         f"Пишите ответы тут — бот всё перекинет пользователю."
@@ -121,6 +145,14 @@ async def claim_ticket(c: CallbackQuery):
             except Exception:
                 pass
 
+    # то же фото дефекта уже приходило от другого клиента — стоит присмотреться
+    reused = await asyncio.to_thread(find_reused_photos, ticket_id)
+    if reused:
+        others = ", ".join(f"#{tid}" for tid in sorted({tid for _, tid in reused}))
+        await c.bot.send_message(  # type: ignore
+            operator_id,
+            f"⚠️ Фото из этой заявки уже встречались в обращениях других пользователей: {others}",
+        )
 
     # пользователю: оператор подключился
     await c.bot.send_message(u.tg_id, OP_CONNECTED)  # type: ignore
@@ -147,77 +179,24 @@ async def show_user_history(c: CallbackQuery):
         if curr.operator_tg_id != operator_id:
             await c.bot.send_message(operator_id, "Это не ваш диалог")  # type: ignore
             return
+        user_id = curr.user_id
 
-        user = s.get(User, curr.user_id)
-        if not user:
-            await c.bot.send_message(operator_id, "Пользователь не найден")  # type: ignore
-            return
-
-        other_tickets = s.scalars(
-            select(Ticket)
-            .where(Ticket.user_id == curr.user_id, Ticket.id != curr.id)
-            .order_by(Ticket.created_at.asc(), Ticket.id.asc())
-        ).all()
-
-    if not other_tickets:
+    # вся история одним html-документом вместо сотен copy_message;
+    # рендер синхронно ходит в БД (реплику, если есть) и на диск, поэтому в отдельном потоке
+    path = await asyncio.to_thread(render_user_history, ticket_id, user_id, _get_operator_nickname)
+    if path is None:
         await c.bot.send_message(operator_id, "Других обращений не найдено")  # type: ignore
         return
 
-    # один тикет → отдельный блок
-    for t in other_tickets:
-        with SessionLocal() as s:
-            operator_label = _get_operator_nickname(s, t.operator_tg_id)
-
-            header = (
-                f"История: тикет #{t.id} | статус {t.status.value} | "
-                f"{_fmt(t.created_at)} → {_fmt(t.closed_at) or '—'} | {operator_label}"
-            )
-            await c.bot.send_message(operator_id, header)  # type: ignore
-
-            msgs = s.scalars(
-                select(TicketMessage)
-                .where(TicketMessage.ticket_id == t.id)
-                .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc())
-            ).all()
-
-            last_sender: str | None = None # "user" / "operator"
-
-            for tm in msgs:
-                if tm.sender_type == "user":
-                    from_chat = user.tg_id
-                    label = _label_for_sender("user", tm.content_type)
-                    sender_key = 'user'
-                else:
-                    if not t.operator_tg_id:
-                        continue
-                    from_chat = t.operator_tg_id
-                    label = _label_for_sender(
-                        "operator",
-                        tm.content_type,
-                        operator_label=operator_label,
-                    )
-                    sender_key = 'operator'
-
-                try:
-                    if sender_key != last_sender:
-                        await c.bot.send_message(operator_id, label)
-                        last_sender = sender_key
-
-                    await c.bot.copy_message(
-                        chat_id=operator_id,
-                        from_chat_id=from_chat,
-                        message_id=tm.tg_message_id,
-                    )
-                except Exception:
-                    pass
-
-            await c.bot.send_message(operator_id, f"— Конец истории по тикету #{t.id}")  # type: ignore
-
-    await c.bot.send_message(
-        operator_id,
-        "ВЫШЕ ПРИВЕДЕНА ИСТОРИЯ ОБРАЩЕНИЙ ПОЛЬЗОВАТЕЛЯ",
-        reply_markup=finish_kb(ticket_id)  # type: ignore
-    )
+    try:
+        await c.bot.send_document(  # type: ignore
+            operator_id,
+            FSInputFile(path, filename=f"history_ticket_{ticket_id}.html"),
+            caption="История обращений пользователя",
+            reply_markup=finish_kb(ticket_id),
+        )
+    finally:
+        path.unlink(missing_ok=True)
 
 
 
@@ -227,17 +206,28 @@ async def finish_ticket(c: CallbackQuery):
     operator_id = c.from_user.id
 
     with SessionLocal() as s:
-        upsert_user_from_tg(s, c.from_user, mark_operator=True)
-        s.commit()
-
-        t = s.get(Ticket, ticket_id)
-        if not t or t.operator_tg_id != operator_id:
-            await c.answer('Это не ваш диалог', show_alert=True)
+        # условный UPDATE: повторное нажатие не закроет тикет второй раз и не посчитается в статистике
+        closed = s.execute(
+            update(Ticket)
+            .where(Ticket.id == ticket_id, Ticket.operator_tg_id == operator_id,
+                   Ticket.status != TicketStatus.closed)
+            .values(status=TicketStatus.closed, closed_at=func.now())
+            .returning(Ticket.user_id, Ticket.operator_tg_id, Ticket.kind, Ticket.created_at,
+                       Ticket.claimed_at, Ticket.closed_at)
+        ).first()
+        if not closed:
+            s.rollback()
+            if queries.ticket_operator(s, ticket_id) == operator_id:
+                await c.answer('Диалог уже закрыт', show_alert=True)
+            else:
+                await c.answer('Это не ваш диалог', show_alert=True)
             return
-        t.status = TicketStatus.closed
-        t.closed_at = datetime.now(timezone.utc)
+        queries.touch_user(s, c.from_user, mark_operator=True)
+        record_close(s, closed)
+        user_tg = queries.user_tg_id(s, closed.user_id)
+        cache.publish(s, cache.dialogs, operator_id, user_tg)
         s.commit()
-        user_tg = t.user.tg_id
+        cards.touch(ticket_id)
 
     await c.bot.send_message(user_tg, OP_DISCONNECTED, reply_markup=ok_kb())  # type: ignore
     if c.message:
@@ -245,3 +235,108 @@ async def finish_ticket(c: CallbackQuery):
     await c.answer()
 
 
+@router.message(Command("phone"))
+async def find_by_phone(m: Message, command: CommandObject):
+    """
+    /phone +79991234567 — найти клиента по номеру из присланного контакта.
+    Только для операторов (фильтр роутера).
+    """
+    with read_session() as s:
+        if not command.args:
+            await m.answer("Формат: /phone +79991234567")
+            return
+
+        u = find_user_by_phone(s, command.args.strip())
+        if not u:
+            await m.answer("Клиент с таким номером не найден")
+            return
+
+        tickets = s.execute(
+            select(Ticket.id, Ticket.status, Ticket.created_at)
+            .where(Ticket.user_id == u.id)
+            .order_by(Ticket.id.desc())
+            .limit(10)
+        ).all()
+
+    username = f"@{html.escape(u.username)}" if u.username else "—"
+    lines = [
+        f"Клиент: {html.escape(u.first_name or '—')} {username}",
+        f"TG ID: {u.tg_id}",
+        f"Телефон: {u.phone_e164}",
+    ]
+    if tickets:
+        lines.append("")
+        lines.append("Последние обращения:")
+        lines += [f"#{tid} | {st.value} | {dt:%Y-%m-%d %H:%M}" for tid, st, dt in tickets]
+    await m.answer("\n".join(lines))
+
+
+_KIND_LABELS = {"warranty": "гарантия", "other": "другой вопрос", "": "без типа"}
+
+
+def _fmt_dur(sec: float) -> str:
+    sec = int(sec)
+    if sec < 60:
+        return f"{sec}с"
+    if sec < 3600:
+        return f"{sec // 60}м {sec % 60:02d}с"
+    return f"{sec // 3600}ч {sec % 3600 // 60:02d}м"
+
+
+def _avg(total: int, n: int) -> str:
+    return _fmt_dur(total / n) if n else "—"
+
+
+@router.message(Command("stats"))
+async def sla_stats(m: Message, command: CommandObject):
+    """
+    /stats [часов] — скорость взятия и закрытия тикетов, по умолчанию за 24 часа.
+    Читает только почасовые агрегаты (src/db/sla.py). Только для операторов (фильтр роутера).
+    """
+    with read_session() as s:
+        arg = (command.args or "").strip()
+        if arg and not arg.isdigit():
+            await m.answer("Формат: /stats или /stats 168 (за сколько часов)")
+            return
+        hours = max(1, min(int(arg or 24), 24 * 90))
+
+        rows = summary(s, hours)
+        names = {op: _get_operator_nickname(s, op) for op in {r.operator_tg_id for r in rows} if op}
+
+    if not rows:
+        await m.answer(f"За последние {hours} ч. тикетов не было")
+        return
+
+    def total(rs, c):
+        return sum(getattr(r, c) or 0 for r in rs)
+
+    claimed, closed = total(rows, "claimed"), total(rows, "closed")
+    lines = [
+        f"📊 За последние {hours} ч.",
+        f"Взято в работу: {claimed}, ожидание в среднем {_avg(total(rows, 'claim_wait_s'), claimed)}, "
+        f"максимум {_fmt_dur(max(r.claim_wait_max_s or 0 for r in rows))}",
+        f"Закрыто: {closed} (из них автоматически: {total(rows, 'auto_closed')})",
+        f"Работа оператора в среднем {_avg(total(rows, 'handle_s'), closed)}, "
+        f"от обращения до закрытия {_avg(total(rows, 'resolve_s'), closed)}",
+    ]
+
+    by_kind: dict[str, list] = {}
+    by_op: dict[int, list] = {}
+    for r in rows:
+        by_kind.setdefault(r.kind, []).append(r)
+        if r.operator_tg_id:
+            by_op.setdefault(r.operator_tg_id, []).append(r)
+
+    lines += ["", "По типам:"]
+    for kind, rs in sorted(by_kind.items()):
+        n = total(rs, "claimed")
+        lines.append(f"• {_KIND_LABELS.get(kind, kind)}: взято {n} (ожидание {_avg(total(rs, 'claim_wait_s'), n)}), "
+                     f"закрыто {total(rs, 'closed')}")
+
+    lines += ["", "По операторам:"]
+    for op, rs in sorted(by_op.items(), key=lambda kv: -total(kv[1], "closed")):
+        n = total(rs, "closed")
+        lines.append(f"• {html.escape(str(names.get(op, op)))}: взято {total(rs, 'claimed')}, закрыто {n}, "
+                     f"в среднем {_avg(total(rs, 'handle_s'), n)} на диалог")
+
+    await m.answer("\n".join(lines))
@@ -1,10 +1,20 @@
+import logging
+
 from aiogram import Router, types, F
-from src.db.base import SessionLocal
-from src.db.models import Ticket, TicketStatus, TicketMessage, User, MessageAttachment
+from sqlalchemy.exc import OperationalError
+from src.db.base import SessionLocal, db_available
+from src.db import spool
+from src.db.models import MessageAttachment
+from src.db import queries, cache
+from src.db.messages import insert_ticket_message
 from src.utils.files import download_by_file_id, build_rel_path
-from sqlalchemy import select
+from src.utils.media_post import schedule_postprocess
+from src.tasks import outbox
 from src.config import settings
-from src.db.users import upsert_user_from_tg
+from src.db.users import capture_contact
+from src.utils.logging import bind
+
+log = logging.getLogger(__name__)
 
 router = Router()
 
@@ -22,7 +32,8 @@ async def _attach_photo(bot, s, ticket_id: int, tm_id: int, m: types.Message):
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "photo", ph.file_unique_id, None)
-        att.local_path = await download_by_file_id(bot, ph.file_id, rel)
+        att.local_path = await download_by_file_id(bot, ph.file_id, rel, ticket_id=ticket_id, mime="image/jpeg",
+                                                   unique_id=ph.file_unique_id)
     s.add(att)
 
 async def _attach_document(bot, s, ticket_id: int, tm_id: int, m: types.Message):
@@ -39,7 +50,8 @@ async def _attach_document(bot, s, ticket_id: int, tm_id: int, m: types.Message)
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "document", d.file_unique_id, getattr(d, "mime_type", None))
-        att.local_path = await download_by_file_id(bot, d.file_id, rel)
+        att.local_path = await download_by_file_id(bot, d.file_id, rel, ticket_id=ticket_id, mime=getattr(d, "mime_type", None),
+                                                   unique_id=d.file_unique_id)
     s.add(att)
 
 async def _attach_video(bot, s, ticket_id: int, tm_id: int, m: types.Message):
@@ -58,7 +70,8 @@ async def _attach_video(bot, s, ticket_id: int, tm_id: int, m: types.Message):
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "video", v.file_unique_id, getattr(v, "mime_type", None))
-        att.local_path = await download_by_file_id(bot, v.file_id, rel)
+        att.local_path = await download_by_file_id(bot, v.file_id, rel, ticket_id=ticket_id, mime=getattr(v, "mime_type", None),
+                                                   unique_id=v.file_unique_id)
     s.add(att)
 
 async def _attach_voice(bot, s, ticket_id: int, tm_id: int, m: types.Message):
@@ -75,38 +88,71 @@ async def _attach_voice(bot, s, ticket_id: int, tm_id: int, m: types.Message):
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "voice", v.file_unique_id, getattr(v, "mime_type", None))
-        att.local_path = await download_by_file_id(bot, v.file_id, rel)
+        att.local_path = await download_by_file_id(bot, v.file_id, rel, ticket_id=ticket_id, mime=getattr(v, "mime_type", None),
+                                                   unique_id=v.file_unique_id)
     s.add(att)
 
-async def _log_message(bot, s, ticket_id: int, m: types.Message, sender_type: str):
+async def _log_message(bot, s, ticket_id: int, m: types.Message, sender_type: str, relay_to: int):
+    """
+    Логируем реплику и в той же транзакции ставим ее копию собеседнику в outbox.
+    Коммитим сразу — доставка не ждет скачивания медиа, вложения дописываем следом.
+    """
     content_type = m.content_type
-    tm = TicketMessage(
-        ticket_id=ticket_id,
-        sender_tg_id=m.from_user.id,      # type: ignore
-        sender_type=sender_type,
-        tg_message_id=m.message_id,
-        content_type=content_type,
-        message_text=m.text if content_type == "text" else None,
-        caption=getattr(m, "caption", None),
-    )
-    s.add(tm)
-    s.flush()  # получим tm.id
+    tm_id = insert_ticket_message(s, ticket_id, m, sender_type)
+    if tm_id is None:
+        # эту реплику уже переслали (апдейт пришел повторно)
+        s.rollback()
+        log.info("duplicate message %s from %s, skipping", m.message_id, sender_type)
+        return
+
+    outbox.enqueue(s, relay_to, "copy_message", ticket_id=ticket_id,
+                   from_chat_id=m.chat.id, message_id=m.message_id)
+    log.info("relay %s from %s to %s", content_type, sender_type, relay_to)
+
+    if content_type == "contact" and sender_type == "user":
+        capture_contact(s, m)
+    s.commit()
+    # дальше реплика уже в базе и в outbox: потеря связи — только без вложения
 
     try:
         if content_type == "photo" and m.photo:
-            await _attach_photo(bot, s, ticket_id, tm.id, m)
+            await _attach_photo(bot, s, ticket_id, tm_id, m)
         elif content_type == "document" and m.document:
-            await _attach_document(bot, s, ticket_id, tm.id, m)
+            await _attach_document(bot, s, ticket_id, tm_id, m)
         elif content_type == "video" and m.video:
-            await _attach_video(bot, s, ticket_id, tm.id, m)
+            await _attach_video(bot, s, ticket_id, tm_id, m)
         elif content_type == "voice" and m.voice:
-            await _attach_voice(bot, s, ticket_id, tm.id, m)
+            await _attach_voice(bot, s, ticket_id, tm_id, m)
         # при необходимости добавь audio / animation / video_note / sticker
     except Exception:
         # не роняем поток, если скачивание сломалось
         pass
 
-    s.commit()
+    try:
+        s.commit()
+    except OperationalError as e:
+        log.warning("attachment of ticket message %s not saved: %s", tm_id, e)
+        return
+    schedule_postprocess(tm_id)
+
+
+async def _relay_degraded(m: types.Message) -> None:
+    """
+    Базы нет: пересылаем по закэшированной таблице маршрутов напрямую,
+    реплику пишем в журнал — src/tasks/replayer.py зальет ее в базу позже.
+    """
+    route = spool.route_for(m.from_user.id)  # type: ignore
+    if not route:
+        return
+    ticket_id, peer_tg_id, sender_type = route
+    bind(ticket_id=ticket_id)
+    try:
+        await m.bot.copy_message(chat_id=peer_tg_id, from_chat_id=m.chat.id, message_id=m.message_id)  # type: ignore
+    except Exception as e:
+        log.warning("degraded relay of %s to %s failed: %s", m.message_id, peer_tg_id, e)
+    spool.append_message(ticket_id, m, sender_type)
+    spool.stats["degraded_relays"] += 1
+
 
 @router.message(F.chat.type == "private")
 async def proxy_private(m: types.Message):
@@ -114,56 +160,44 @@ async def proxy_private(m: types.Message):
     if m.from_user.is_bot:  # type: ignore
         return
 
+    if not db_available():
+        return await _relay_degraded(m)
+    try:
+        await _proxy(m)
+    except OperationalError as e:
+        # связь с базой пропала до commit — реплики в базе нет, в outbox тоже
+        log.warning("database error in proxy, relaying from spool: %s", e)
+        await _relay_degraded(m)
+
+
+def _dialog(s, tg_id: int) -> tuple[str, int, int] | None:
+    """(кто пишет: operator / user, ticket_id, tg_id собеседника) или None."""
+    # 1) Оператор → Пользователь
+    d = queries.operator_dialog(s, tg_id)
+    if d:
+        return "operator", d.ticket_id, d.user_tg_id
+    # 2) Пользователь → Оператор
+    d = queries.user_dialog(s, tg_id)
+    if d:
+        return "user", d.ticket_id, d.operator_tg_id
+    return None
+
+
+async def _proxy(m: types.Message):
+    # запросы из src/db/queries.py: кортежи вместо Ticket / User, upsert пользователя
+    # уходит в одной транзакции с репликой (commit в _log_message).
+    # Диалог — из кэша: сбрасывают claim / закрытие (src/db/cache.py)
+    tg_id = m.from_user.id  # type: ignore
     with SessionLocal() as s:
-        upsert_user_from_tg(s, m.from_user, mark_operator=False)
-        s.commit()
-
-        #
-        # 1) Оператор → Пользователь
-        #
-        t = s.scalar(
-            select(Ticket).where(
-                Ticket.operator_tg_id == m.from_user.id,    # type: ignore
-                Ticket.status == TicketStatus.assigned,
-            )
-        )
-        if t:
-            upsert_user_from_tg(s, m.from_user, mark_operator=True)
+        route = cache.dialogs.get_or_load(tg_id, lambda: _dialog(s, tg_id))
+        queries.touch_user(s, m.from_user, mark_operator=route is not None and route[0] == "operator")  # type: ignore
+        if route is None:
             s.commit()
-            
-            # дублим пользователю
-            await m.bot.copy_message(
-                chat_id=t.user.tg_id,
-                from_chat_id=m.chat.id,
-                message_id=m.message_id
-            )  # type: ignore
-
-            # логируем как operator
-            await _log_message(m.bot, s, t.id, m, sender_type="operator")  # type: ignore
-            return
-
-        #
-        # 2) Пользователь → Оператор
-        #
-        user = s.scalar(select(User).where(User.tg_id == m.from_user.id))  # type: ignore
-        if not user:
+            spool.forget_route(tg_id)
             return
+        sender_type, ticket_id, peer_tg_id = route
+        bind(ticket_id=ticket_id)
+        spool.remember_route(tg_id, ticket_id, peer_tg_id, sender_type)
 
-        t = s.scalar(
-            select(Ticket).where(
-                Ticket.user_id == user.id,
-                Ticket.status == TicketStatus.assigned,
-            )
-        )
-        if not t:
-            return
-
-        # дублим оператору
-        await m.bot.copy_message(
-            chat_id=t.operator_tg_id,
-            from_chat_id=m.chat.id,
-            message_id=m.message_id
-        )  # type: ignore
-
-        # логируем как user
-        await _log_message(m.bot, s, t.id, m, sender_type="user")  # type: ignore
+        # логируем и дублим собеседнику (через outbox)
+        await _log_message(m.bot, s, ticket_id, m, sender_type=sender_type, relay_to=peer_tg_id)
@@ -1,3 +1,4 @@
+import logging
 from typing import cast
 
 from aiogram import Router, F, types
@@ -6,7 +7,8 @@ from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import CommandStart
 
-from sqlalchemy import select
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import OperationalError
 
 from src import texts
 from src.keyboards.main import (
@@ -17,20 +19,26 @@ from src.keyboards.main import (
     warranty_media_done_kb,
 )
 from src.keyboards.operator import claim_kb
-from src.db.base import SessionLocal
+from src.db.base import SessionLocal, db_available
+from src.db import spool
 from src.config import settings
-from src.db.users import upsert_user_from_tg
+from src.db.users import upsert_user_from_tg, capture_contact
+from src.db.messages import insert_ticket_message
 from src.db.models import (
     User,
     Ticket,
     TicketStatus,
-    TicketMessage,
     MessageAttachment,
 )
 from src.utils.files import (
     download_by_file_id,
     build_rel_path,
 )
+from src.utils.media_post import schedule_postprocess
+from src.tasks import outbox, cards
+from src.utils.logging import bind
+
+log = logging.getLogger(__name__)
 
 router = Router()
 
@@ -52,7 +60,7 @@ class OtherForm(StatesGroup):
 # УТИЛИТЫ
 # -------------------------
 
-def _upsert_user_and_create_ticket(m: types.Message) -> tuple[int, User]:
+def _upsert_user_and_create_ticket(m: types.Message, kind: str) -> tuple[int, User]:
     with SessionLocal() as s:
         user = upsert_user_from_tg(s, m.from_user, mark_operator=False)
         s.flush()
@@ -61,6 +69,7 @@ def _upsert_user_and_create_ticket(m: types.Message) -> tuple[int, User]:
             user_id=user.id,
             status=TicketStatus.waiting,
             operator_tg_id=None,
+            kind=kind,
         )
         s.add(ticket)
         s.commit()
@@ -83,7 +92,8 @@ async def _attach_photo(bot, s, ticket_id: int, tm_id: int, m: types.Message):
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "photo", ph.file_unique_id, None)
-        att.local_path = await download_by_file_id(bot, ph.file_id, rel)
+        att.local_path = await download_by_file_id(bot, ph.file_id, rel, ticket_id=ticket_id, mime="image/jpeg",
+                                                   unique_id=ph.file_unique_id)
     s.add(att)
 
 
@@ -101,7 +111,8 @@ async def _attach_document(bot, s, ticket_id: int, tm_id: int, m: types.Message)
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "document", d.file_unique_id, getattr(d, "mime_type", None))
-        att.local_path = await download_by_file_id(bot, d.file_id, rel)
+        att.local_path = await download_by_file_id(bot, d.file_id, rel, ticket_id=ticket_id, mime=getattr(d, "mime_type", None),
+                                                   unique_id=d.file_unique_id)
     s.add(att)
 
 
@@ -121,7 +132,8 @@ async def _attach_video(bot, s, ticket_id: int, tm_id: int, m: types.Message):
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "video", v.file_unique_id, getattr(v, "mime_type", None))
-        att.local_path = await download_by_file_id(bot, v.file_id, rel)
+        att.local_path = await download_by_file_id(bot, v.file_id, rel, ticket_id=ticket_id, mime=getattr(v, "mime_type", None),
+                                                   unique_id=v.file_unique_id)
     s.add(att)
 
 
@@ -139,10 +151,26 @@ async def _attach_voice(bot, s, ticket_id: int, tm_id: int, m: types.Message):
     )
     if settings.store_media_local:
         rel = build_rel_path(ticket_id, tm_id, "voice", v.file_unique_id, getattr(v, "mime_type", None))
-        att.local_path = await download_by_file_id(bot, v.file_id, rel)
+        att.local_path = await download_by_file_id(bot, v.file_id, rel, ticket_id=ticket_id, mime=getattr(v, "mime_type", None),
+                                                   unique_id=v.file_unique_id)
     s.add(att)
 
 
+def _intake_closed(s, ticket_id: int) -> bool:
+    """
+    Тикет заявки больше не ждет вложений: reaper закрыл брошенную заявку, а FSM
+    клиента (в памяти своего воркера) остался. Базы нет — не знаем, копим дальше.
+    """
+    if not db_available():
+        return False
+    try:
+        status = s.scalar(select(Ticket.status).where(Ticket.id == ticket_id))
+    except OperationalError:
+        s.rollback()
+        return False
+    return status != TicketStatus.waiting
+
+
 async def _save_ticket_message(
     bot,
     s,
@@ -155,77 +183,103 @@ async def _save_ticket_message(
     - создаём TicketMessage
     - если это медиа, создаём и MessageAttachment с ticket_id
     - при необходимости скачиваем файл в media/
+    Базы нет — пишем сообщение в журнал src/db/spool.py, в базу оно попадет позже.
     """
+    bind(ticket_id=ticket_id)
+    if not db_available():
+        spool.append_message(ticket_id, m, sender_type)
+        return
+    try:
+        tm_id = await _save_ticket_message_db(bot, s, ticket_id, m, sender_type)
+    except OperationalError as e:
+        log.warning("database error while saving intake message, spooling: %s", e)
+        spool.append_message(ticket_id, m, sender_type)
+        return
+
+    # превью / хэши / метаданные считаются в фоне, в пуле процессов
+    if tm_id is not None:
+        schedule_postprocess(tm_id)
 
+
+async def _save_ticket_message_db(bot, s, ticket_id: int, m: types.Message, sender_type: str) -> int | None:
     content_type = m.content_type
 
-    tm = TicketMessage(
-        ticket_id=ticket_id,
-        sender_tg_id=m.from_user.id,      # type: ignore
-        sender_type=sender_type,
-        tg_message_id=m.message_id,
-        content_type=content_type,
-        message_text=m.text if content_type == "text" else None,
-        caption=getattr(m, "caption", None),
-    )
-    s.add(tm)
-    s.flush()  # теперь у нас есть tm.id
+    tm_id = insert_ticket_message(s, ticket_id, m, sender_type)
+    if tm_id is None:
+        # сообщение уже сохранено (апдейт пришел повторно) — вложение тоже
+        s.rollback()
+        return None
+
+    if content_type == "contact" and sender_type == "user":
+        capture_contact(s, m)
+    # коммитим до скачивания: соединение не держим, пока файл едет из телеги,
+    # и сообщение уже в базе, что бы ни случилось со вложением
+    s.commit()
 
     try:
         if content_type == "photo" and getattr(m, "photo", None):
-            await _attach_photo(bot, s, ticket_id, tm.id, m)
+            await _attach_photo(bot, s, ticket_id, tm_id, m)
 
         elif content_type == "document" and getattr(m, "document", None):
-            await _attach_document(bot, s, ticket_id, tm.id, m)
+            await _attach_document(bot, s, ticket_id, tm_id, m)
 
         elif content_type == "video" and getattr(m, "video", None):
-            await _attach_video(bot, s, ticket_id, tm.id, m)
+            await _attach_video(bot, s, ticket_id, tm_id, m)
 
         elif content_type == "voice" and getattr(m, "voice", None):
-            await _attach_voice(bot, s, ticket_id, tm.id, m)
+            await _attach_voice(bot, s, ticket_id, tm_id, m)
 
         # сюда можно добавить audio / animation / video_note / sticker и т.д.
     except Exception:
         # не даём боту умереть от проблем скачивания
         pass
 
-    s.commit()
+    try:
+        s.commit()
+    except OperationalError as e:
+        log.warning("attachment of ticket message %s not saved: %s", tm_id, e)
+    return tm_id
 
 
-async def _notify_operators_about_ticket(
+def _notify_operators_about_ticket(
     m: types.Message,
     ticket_id: int,
     user: User,
-    intro_text: str,
+    kind: str,
     extra_message_ids: list[int],
-):
+) -> bool:
     """
-    Кидаем в операторский чат карточку с claim-кнопкой
-    + форвардим ВСЕ сообщения клиента по тикету.
+    Ставим в outbox карточку с claim-кнопкой для операторского чата
+    + копии ВСЕХ сообщений клиента по тикету.
+    Все в одной транзакции с notified_at: даже если бот упадет сразу после,
+    src/tasks/outbox.py доставит карточку после рестарта.
+    False — карточка по этому тикету уже была (повторное нажатие).
     """
-    username = f"@{user.username}" if user.username else "—"
-    summary = (
-        f"{intro_text} #{ticket_id}\n"
-        f"Пользователь: {user.first_name or '—'} {username}\n"
-        f"TG ID: {user.tg_id}\n"
-        f"Статус: WAITING\n\n"
-        f"Ниже — детали обращения."
-    )
+    bind(ticket_id=ticket_id)
+    summary = cards.card_text(ticket_id, kind, user, TicketStatus.waiting)
 
-    # карточка с кнопкой "Взять в работу"
-    await m.bot.send_message(
-        chat_id=settings.operators_chat_id,
-        text=summary,
-        reply_markup=claim_kb(ticket_id),
-    )
-
-    # пересылаем ВСЕ собранные сообщения юзера
-    for mid in extra_message_ids:
-        await m.bot.copy_message(
-            chat_id=settings.operators_chat_id,
-            from_chat_id=m.chat.id,
-            message_id=mid,
-        )
+    with SessionLocal() as s:
+        # карточка уходит — тикет больше не считается брошенным intake
+        fresh = s.execute(
+            update(Ticket)
+            .where(Ticket.id == ticket_id, Ticket.status == TicketStatus.waiting,
+                   Ticket.notified_at.is_(None))
+            .values(notified_at=func.now())
+        ).rowcount
+        if not fresh:
+            return False
+
+        # карточка с кнопкой "Взять в работу"
+        # card=True: outbox запомнит ее id, чтобы потом обновлять статус
+        outbox.enqueue(s, settings.operators_chat_id, "send_message", ticket_id=ticket_id, card=True,
+                       text=summary, reply_markup=claim_kb(ticket_id))
+
+        # пересылаем ВСЕ собранные сообщения юзера
+        for mid in extra_message_ids:
+            outbox.enqueue(s, settings.operators_chat_id, "copy_message", ticket_id=ticket_id,
+                           from_chat_id=m.chat.id, message_id=mid)
+        s.commit()
+    return True
 
 
 def _message_has_media(m: types.Message) -> bool:
@@ -302,7 +356,7 @@ async def warranty_details_step(m: types.Message, state: FSMContext):
         return await warranty_collect_media(m, state)
 
     # создаём тикет WAITING
-    ticket_id, user = _upsert_user_and_create_ticket(m)
+    ticket_id, user = _upsert_user_and_create_ticket(m, "warranty")
 
     # логируем первое сообщение целиком
     with SessionLocal() as s:
@@ -345,6 +399,11 @@ async def warranty_collect_media(m: types.Message, state: FSMContext):
 
     # логируем это сообщение (и текст, и медиавложения)
     with SessionLocal() as s:
+        if _intake_closed(s, ticket_id):
+            # в закрытый тикет не пишем: сбрасываем анкету, как reaper и предупредил
+            await state.clear()
+            await m.answer(texts.REAPED_INTAKE, reply_markup=ok_kb())
+            return
         await _save_ticket_message(
             bot=m.bot,
             s=s,
@@ -355,8 +414,9 @@ async def warranty_collect_media(m: types.Message, state: FSMContext):
 
     # запоминаем message_id для последующей отправки оператору
     collected = data.get("collected_msg_ids", [])
-    collected.append(m.message_id)
-    await state.update_data(collected_msg_ids=collected)
+    if m.message_id not in collected:  # повторный апдейт не дублирует копию оператору
+        collected.append(m.message_id)
+        await state.update_data(collected_msg_ids=collected)
 
     # ничего не отвечаем здесь пользователю, он уже видит инструкцию
 
@@ -381,13 +441,20 @@ async def warranty_done(c: CallbackQuery, state: FSMContext):
     # берём юзера из БД, чтобы красиво подписать карточку
     with SessionLocal() as s:
         user = s.scalar(select(User).where(User.tg_id == user_tg_id))  # type: ignore
+        t_status = s.scalar(select(Ticket.status).where(Ticket.id == ticket_id))
+
+    if t_status != TicketStatus.waiting:
+        # тикет уже закрыт (например, reaper закрыл брошенную заявку)
+        await c.answer(texts.STALE_INTAKE, show_alert=True)
+        await state.clear()
+        return
 
     if user:
-        await _notify_operators_about_ticket(
+        _notify_operators_about_ticket(
             m=c.message,
             ticket_id=ticket_id,
             user=user,
-            intro_text="Новое обращение по гарантии",
+            kind="warranty",
             extra_message_ids=collected_ids,
         )
 
@@ -470,7 +537,7 @@ async def other_question_text(m: types.Message, state: FSMContext):
         return await other_collect_media(m, state)
 
     # создаём тикет
-    ticket_id, user = _upsert_user_and_create_ticket(m)
+    ticket_id, user = _upsert_user_and_create_ticket(m, "other")
 
     # логируем первое сообщение целиком (текст/медиа)
     with SessionLocal() as s:
@@ -512,6 +579,11 @@ async def other_collect_media(m: types.Message, state: FSMContext):
 
     # логируем сообщение (и его вложения)
     with SessionLocal() as s:
+        if _intake_closed(s, ticket_id):
+            # в закрытый тикет не пишем: сбрасываем анкету, как reaper и предупредил
+            await state.clear()
+            await m.answer(texts.REAPED_INTAKE, reply_markup=ok_kb())
+            return
         await _save_ticket_message(
             bot=m.bot,
             s=s,
@@ -522,8 +594,9 @@ async def other_collect_media(m: types.Message, state: FSMContext):
 
     # дописываем id сообщения в список collected_msg_ids
     collected = data.get("collected_msg_ids", [])
-    collected.append(m.message_id)
-    await state.update_data(collected_msg_ids=collected)
+    if m.message_id not in collected:  # повторный апдейт не дублирует копию оператору
+        collected.append(m.message_id)
+        await state.update_data(collected_msg_ids=collected)
 
     # не отвечаем заново, чтобы не спамить
 
@@ -547,13 +620,20 @@ async def other_done(c: CallbackQuery, state: FSMContext):
     # достаём объект юзера, чтобы красиво подписать карточку
     with SessionLocal() as s:
         user = s.scalar(select(User).where(User.tg_id == user_tg_id))  # type: ignore
+        t_status = s.scalar(select(Ticket.status).where(Ticket.id == ticket_id))
+
+    if t_status != TicketStatus.waiting:
+        # тикет уже закрыт (например, reaper закрыл брошенную заявку)
+        await c.answer(texts.STALE_INTAKE, show_alert=True)
+        await state.clear()
+        return
 
     if user:
-        await _notify_operators_about_ticket(
+        _notify_operators_about_ticket(
             m=c.message,
             ticket_id=ticket_id,
             user=user,
-            intro_text="Новый вопрос от клиента",
+            kind="other",
             extra_message_ids=collected_ids,
         )
 
@@ -0,0 +1,167 @@
+"""
+Карточки тикетов в операторском чате.
+
+Карточку отправляет outbox (card=True); ее chat_id / message_id он записывает
+в tickets.card_chat_id / card_message_id. Дальше карточка живая: после claim
+и закрытия touch(ticket_id) перерисовывает ее — статус, оператор, кнопка
+"Взять в работу" пропадает. Лишние нажатия на занятый тикет больше не ходят в базу.
+
+Правки копятся CARD_EDIT_DEBOUNCE_MS: несколько переходов подряд (claim и сразу
+закрытие) — одна правка с последним состоянием, все тикеты пачки читаются
+одним запросом. Очередь правок в памяти: упал процесс — карточка останется
+старой, лишний claim по ней получит "Уже занято", как раньше.
+"""
+import asyncio
+import html
+import logging
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from sqlalchemy import select
+from sqlalchemy.orm import aliased
+
+from src.config import settings
+from src.db.base import SessionLocal
+from src.db.models import Ticket, TicketStatus, User
+from src.keyboards.operator import claim_kb
+
+log = logging.getLogger(__name__)
+
+INTRO = {
+    "warranty": "Новое обращение по гарантии",
+    "other": "Новый вопрос от клиента",
+}
+
+stats = {
+    "touched": 0,
+    "coalesced": 0,
+    "edits": 0,
+    "failed": 0,
+}
+
+_bot: Bot | None = None
+_pending: set[int] = set()
+_timer: asyncio.TimerHandle | None = None
+_flushing: asyncio.Task | None = None
+
+
+def card_text(ticket_id: int, kind: str | None, user: User, status: TicketStatus,
+              operator: User | None = None) -> str:
+    # parse_mode HTML: имя с "<" или "&" — и Telegram отклонит карточку целиком
+    username = f"@{html.escape(user.username)}" if user.username else "—"
+    state = status.value
+    if operator is not None:
+        state += f" — 👮 {html.escape(_operator_label(operator))}"
+    text = (
+        f"{INTRO.get(kind or '', 'Обращение')} #{ticket_id}\n"
+        f"Пользователь: {html.escape(user.first_name or '—')} {username}\n"
+        f"TG ID: {user.tg_id}\n"
+        f"Статус: {state}"
+    )
+    if status == TicketStatus.waiting:
+        text += "\n\nНиже — детали обращения."
+    return text
+
+
+def _operator_label(op: User) -> str:
+    if op.username:
+        return f"@{op.username}"
+    return op.first_name or str(op.tg_id)
+
+
+# -------------------------
+# правки
+# -------------------------
+
+def touch(ticket_id: int) -> None:
+    """Тикет поменял состояние — перерисовать его карточку (с задержкой, пачкой)."""
+    global _timer
+    if _bot is None:
+        return
+    stats["touched"] += 1
+    if ticket_id in _pending:
+        stats["coalesced"] += 1
+        return
+    _pending.add(ticket_id)
+    if _timer is None:
+        _timer = asyncio.get_running_loop().call_later(settings.card_edit_debounce_ms / 1000, _flush_soon)
+
+
+def _flush_soon() -> None:
+    global _timer, _flushing
+    _timer = None
+    if _flushing is None or _flushing.done():
+        _flushing = asyncio.create_task(_flush())
+    else:
+        # предыдущая пачка еще правится — эта пойдет следом
+        _timer = asyncio.get_running_loop().call_later(settings.card_edit_debounce_ms / 1000, _flush_soon)
+
+
+def _load(ticket_ids: list[int]) -> list[tuple[int, int, int, str, object]]:
+    """(ticket_id, chat_id, message_id, текст, клавиатура) для тикетов с известной карточкой."""
+    Op = aliased(User)
+    with SessionLocal() as s:
+        rows = s.execute(
+            select(Ticket, User, Op)
+            .join(User, User.id == Ticket.user_id)
+            .outerjoin(Op, Op.tg_id == Ticket.operator_tg_id)
+            .where(Ticket.id.in_(ticket_ids), Ticket.card_message_id.is_not(None))
+        ).all()
+        return [
+            (
+                t.id,
+                t.card_chat_id,
+                t.card_message_id,
+                card_text(t.id, t.kind, u, t.status, op),
+                claim_kb(t.id) if t.status == TicketStatus.waiting else None,
+            )
+            for t, u, op in rows
+        ]
+
+
+async def _flush() -> None:
+    global _timer
+    ticket_ids = list(_pending)
+    _pending.clear()
+    try:
+        cards = await asyncio.to_thread(_load, ticket_ids)
+    except Exception:
+        log.exception("loading ticket cards failed")
+        return
+    for ticket_id, chat_id, message_id, text, markup in cards:
+        try:
+            await _bot.edit_message_text(  # type: ignore[union-attr]
+                chat_id=chat_id, message_id=message_id, text=text, reply_markup=markup,
+            )
+            stats["edits"] += 1
+        except TelegramRetryAfter as e:
+            _pending.add(ticket_id)
+            await asyncio.sleep(e.retry_after)
+        except TelegramBadRequest as e:
+            # "message is not modified" — уже в этом виде; удалена — править нечего
+            if "not modified" not in str(e):
+                stats["failed"] += 1
+                log.warning("card %s/%s not edited: %s", chat_id, message_id, e)
+        except Exception as e:
+            stats["failed"] += 1
+            log.warning("card %s/%s not edited: %s", chat_id, message_id, e)
+    if _pending and _timer is None and _bot is not None:
+        _timer = asyncio.get_running_loop().call_later(settings.card_edit_debounce_ms / 1000, _flush_soon)
+
+
+async def start(bot: Bot, worker_index: int = 0) -> None:
+    """startup-хук: в каждом воркере — правим карточки тикетов, которые сменили состояние здесь."""
+    global _bot
+    _bot = bot
+
+
+async def stop() -> None:
+    global _bot, _timer
+    if _timer is not None:
+        _timer.cancel()
+        _timer = None
+    if _flushing is not None and not _flushing.done():
+        await _flushing
+    if _pending and _bot is not None:
+        await _flush()
+    _bot = None
@@ -0,0 +1,235 @@
+"""
+Учет и ограничение хранилища медиа (media_root или бакет s3, см. src/utils/storage.py).
+
+- Держим в памяти, сколько байт занимает каждый тикет (старт — из
+  MessageAttachment.size, дальше — по факту каждого скачивания).
+- Если общий объем больше MEDIA_QUOTA_MB, удаляем файлы самых давно
+  закрытых тикетов, пока не опустимся ниже LOW_WATERMARK квоты.
+  В строке стираем local_path (и превью), file_id остается, и выбрасываем
+  закэшированные фрагменты html-истории этих тикетов — в истории вложение
+  дальше показывается именем и file_id. Сам файл на чтение истории заново
+  не качаем (иначе квота бессмысленна); ensure_local() — для тех, кому нужен
+  именно файл (src/tasks/replayer.py).
+- Удаление идет небольшими пачками, файлы удаляются в отдельном потоке,
+  между пачками отдаем управление event loop.
+
+Метрики — в stats.
+"""
+import asyncio
+import logging
+from collections import defaultdict
+
+from aiogram import Bot
+from sqlalchemy import select, update, func
+
+from src.config import settings
+from src.db.base import SessionLocal
+from src.db.models import MessageAttachment, Ticket, TicketStatus
+from src.utils.files import download_by_file_id, build_rel_path, on_saved
+from src.utils.storage import for_uri
+from src.utils.transcript import forget_fragments
+
+log = logging.getLogger(__name__)
+
+LOW_WATERMARK = 0.9
+EVICT_BATCH = 100
+
+ticket_bytes: dict[int, int] = defaultdict(int)
+
+stats = {
+    "store_bytes": 0,
+    "quota_bytes": 0,
+    "evicted_files": 0,
+    "evicted_bytes": 0,
+    "eviction_runs": 0,
+    "refetched": 0,
+}
+
+_task: asyncio.Task | None = None
+_wakeup: asyncio.Event | None = None
+
+
+def _quota() -> int:
+    return settings.media_quota_mb * 1024 * 1024
+
+
+def note_saved(ticket_id: int, size: int) -> None:
+    """Вызывается после каждого скачанного файла."""
+    ticket_bytes[ticket_id] += size
+    stats["store_bytes"] += size
+    if _wakeup is not None and _quota() and stats["store_bytes"] > _quota():
+        _wakeup.set()
+
+
+on_saved(note_saved)
+
+
+def _load_usage() -> dict[int, int]:
+    with SessionLocal() as s:
+        return {
+            tid: int(total or 0) for tid, total in s.execute(
+                select(MessageAttachment.ticket_id, func.sum(MessageAttachment.size))
+                .where(MessageAttachment.local_path.is_not(None))
+                .group_by(MessageAttachment.ticket_id)
+            ).all()
+            if tid is not None
+        }
+
+
+def _reload() -> None:
+    usage = _load_usage()
+    ticket_bytes.clear()
+    ticket_bytes.update(usage)
+    stats["store_bytes"] = sum(usage.values())
+
+
+def _pick_victims(limit: int) -> list[tuple[int, int, str, str | None, int | None]]:
+    """Самые старые закрытые тикеты первыми."""
+    with SessionLocal() as s:
+        return [tuple(r) for r in s.execute(
+            select(
+                MessageAttachment.id,
+                MessageAttachment.ticket_id,
+                MessageAttachment.local_path,
+                MessageAttachment.thumb_path,
+                MessageAttachment.size,
+            )
+            .join(Ticket, Ticket.id == MessageAttachment.ticket_id)
+            .where(
+                Ticket.status == TicketStatus.closed,
+                MessageAttachment.local_path.is_not(None),
+            )
+            .order_by(Ticket.closed_at.asc().nulls_first(), MessageAttachment.id.asc())
+            .limit(limit)
+        ).all()]
+
+
+def _remove_files(paths: list[str]) -> dict[str, int]:
+    """Удаляем файлы, возвращаем сколько байт освободил каждый."""
+    freed: dict[str, int] = {}
+    for p in paths:
+        try:
+            size = for_uri(p).delete(p)
+            if size:
+                freed[p] = size
+        except Exception:
+            log.warning("media store: can't remove %s", p)
+    return freed
+
+
+def _forget(att_ids: list[int]) -> None:
+    with SessionLocal() as s:
+        s.execute(
+            update(MessageAttachment)
+            .where(MessageAttachment.id.in_(att_ids))
+            .values(local_path=None, thumb_path=None)
+        )
+        s.commit()
+
+
+async def evict_to_quota() -> int:
+    """Удаляем файлы, пока не влезем в LOW_WATERMARK квоты. Возвращаем число файлов."""
+    quota = _quota()
+    if not quota or stats["store_bytes"] <= quota:
+        return 0
+
+    target = int(quota * LOW_WATERMARK)
+    evicted = 0
+    while stats["store_bytes"] > target:
+        rows = await asyncio.to_thread(_pick_victims, EVICT_BATCH)
+        if not rows:
+            log.warning("media store: over quota, but no closed-ticket files left to evict")
+            break
+        # берем из пачки ровно столько, сколько нужно, чтобы опуститься до target
+        need, cut = stats["store_bytes"] - target, 0
+        for cut, row in enumerate(rows, 1):
+            need -= row[4] or 0
+            if need <= 0:
+                break
+        rows = rows[:cut]
+
+        paths = [p for _, _, local, thumb, _ in rows for p in (local, thumb) if p]
+        freed = await asyncio.to_thread(_remove_files, paths)
+        await asyncio.to_thread(_forget, [r[0] for r in rows])
+        await asyncio.to_thread(forget_fragments, {r[1] for r in rows})
+
+        for _, ticket_id, local, _, size in rows:
+            # считали по факту скачивания; если файла уже не было — по size из базы
+            n = freed.get(local, size or 0)
+            ticket_bytes[ticket_id] -= n
+            if ticket_bytes[ticket_id] <= 0:
+                ticket_bytes.pop(ticket_id, None)
+            stats["store_bytes"] -= n
+        stats["evicted_files"] += len(rows)
+        stats["evicted_bytes"] += sum(freed.values())
+        evicted += len(rows)
+
+        # не держим loop: между пачками даем поработать хендлерам
+        await asyncio.sleep(0.05)
+
+    stats["eviction_runs"] += 1
+    log.info("media store: evicted %s files, store now %.1f MB", evicted, stats["store_bytes"] / 2**20)
+    return evicted
+
+
+async def ensure_local(bot: Bot, att_id: int) -> str | None:
+    """
+    Путь (URI) файла вложения; если его вытеснили — скачиваем заново по file_id.
+    """
+    with SessionLocal() as s:
+        att = s.get(MessageAttachment, att_id)
+        if not att:
+            return None
+        if att.local_path and await asyncio.to_thread(for_uri(att.local_path).exists, att.local_path):
+            return att.local_path
+        rel = build_rel_path(att.ticket_id or 0, att.ticket_message_id, att.media_type,
+                             att.file_unique_id, att.mime_type)
+        att.local_path = await download_by_file_id(bot, att.file_id, rel, ticket_id=att.ticket_id,
+                                                   mime=att.mime_type, unique_id=att.file_unique_id)
+        s.commit()
+        stats["refetched"] += 1
+        return att.local_path
+
+
+async def _loop() -> None:
+    assert _wakeup is not None
+    while True:
+        try:
+            if settings.workers > 1:
+                # скачивают все воркеры, а считаем мы одни — сверяемся с базой
+                await asyncio.to_thread(_reload)
+            await evict_to_quota()
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("media store: eviction failed")
+        _wakeup.clear()
+        try:
+            await asyncio.wait_for(_wakeup.wait(), settings.media_gc_interval_s)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start(worker_index: int = 0) -> None:
+    """startup-хук: загружаем текущий объем, вытеснение — только в нулевом воркере."""
+    global _task, _wakeup
+    if not settings.store_media_local:
+        return
+    await asyncio.to_thread(_reload)
+    stats["quota_bytes"] = _quota()
+    log.info("media store: %.1f MB in %s tickets", stats["store_bytes"] / 2**20, len(ticket_bytes))
+    if not _quota() or worker_index != 0:
+        return
+    _wakeup = asyncio.Event()
+    _task = asyncio.create_task(_loop())
+
+
+async def stop() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
@@ -0,0 +1,349 @@
+"""
+Надежная доставка сообщений бота через таблицу outbox.
+
+Хендлер кладет сообщение в outbox в той же транзакции, что и тикет/реплику
+(enqueue), и сразу возвращается. NOTIFY после commit будит доставку:
+- сообщения одного чата уходят строго по порядку, разные чаты — параллельно
+  (не больше OUTBOX_CONCURRENCY одновременно);
+- ошибка сети / 5xx — повтор с нарастающей паузой, более поздние сообщения
+  этого чата ждут; RetryAfter — ждем столько, сколько сказала телега;
+- чат заблокирован, сообщение удалено — строку помечаем failed и идем дальше.
+
+Перед отправкой голову очереди чата (до BATCH строк) берем в аренду:
+locked_by / locked_until на OUTBOX_LEASE_S, под FOR UPDATE в короткой транзакции.
+Пока аренда у другого экземпляра (второй бот, старый процесс при раскатке), чат
+не трогаем — иначе одна строка ушла бы дважды, а порядок в чате сломался бы
+(поэтому не SKIP LOCKED: пропустить голову и взять хвост нельзя). Аренду
+продлеваем, перечитывая очередь на половине срока; отправку, которая в нее
+не влезает (долгий RetryAfter), откладываем. При остановке аренду снимаем; упал
+процесс — чат ждет конца аренды. Повторно сообщение уйдет, только если упасть
+между отправкой и отметкой sent_at.
+
+Уведомления могли потеряться (переподключение, рестарт) — раз в OUTBOX_SWEEP_S
+и после каждого переподключения слушателя досматриваем таблицу.
+Доставка работает только в нулевом воркере, enqueue — из любого.
+"""
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from datetime import timedelta
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.orm import Session
+
+from src.config import settings
+from src import lifecycle
+from src.db import notify
+from src.db.base import SessionLocal
+from src.db.models import Outbox, Ticket
+from src.utils.logging import bind
+
+log = logging.getLogger(__name__)
+
+CHANNEL = "outbox"
+METHODS = {"send_message", "copy_message"}
+BATCH = 50
+LEASE_MARGIN_S = 5  # аренду считаем по своим часам с запасом на round-trip до базы
+
+stats = {
+    "sent": 0,
+    "failed": 0,
+    "retries": 0,
+    "last_lag_ms": 0,
+}
+
+_bot: Bot | None = None
+_sem: asyncio.Semaphore | None = None
+_active: dict[int, asyncio.Task] = {}
+_again: set[int] = set()
+_sweep_now: asyncio.Event | None = None
+_sweeper: asyncio.Task | None = None
+_owner = ""
+
+
+def enqueue(s: Session, chat_id: int, method: str, ticket_id: int | None = None, card: bool = False,
+            **kwargs) -> None:
+    """
+    Поставить вызов bot.<method>(chat_id=..., **kwargs) в очередь.
+    Уйдет только после commit сессии s.
+    card — это карточка тикета: после отправки ее id запишем в tickets (src/tasks/cards.py).
+    """
+    assert method in METHODS, method
+    markup = kwargs.get("reply_markup")
+    if markup is not None:
+        kwargs["reply_markup"] = markup.model_dump(exclude_none=True)
+    if card:
+        kwargs["_card"] = True
+    s.add(Outbox(chat_id=chat_id, method=method, payload=kwargs, ticket_id=ticket_id))
+    notify.notify(s, CHANNEL, str(chat_id))
+
+
+# -------------------------
+# доставка
+# -------------------------
+
+def _claim(chat_id: int) -> list[tuple[Outbox, bool]]:
+    """
+    Голова очереди чата по порядку, взятая в аренду: (строка, пора ли ее отправлять).
+    Чат в аренде у другого экземпляра — пусто.
+    """
+    with SessionLocal() as s:
+        rows = s.execute(
+            select(Outbox, Outbox.next_attempt_at <= func.now(), Outbox.locked_until > func.now())
+            .where(Outbox.chat_id == chat_id, Outbox.sent_at.is_(None), Outbox.failed_at.is_(None))
+            .order_by(Outbox.id.asc())
+            .limit(BATCH)
+            .with_for_update(of=Outbox)
+        ).all()
+        if any(leased and row.locked_by != _owner for row, _, leased in rows):
+            s.rollback()
+            return []
+        if rows:
+            s.execute(
+                update(Outbox)
+                .where(Outbox.id.in_([row.id for row, _, _ in rows]))
+                .values(locked_by=_owner, locked_until=func.now() + timedelta(seconds=settings.outbox_lease_s))
+            )
+        s.commit()
+    return [(row, due) for row, due, _ in rows]
+
+
+def _release() -> None:
+    """Снимаем свою аренду (остановка): очередь сразу подхватит другой экземпляр."""
+    with SessionLocal() as s:
+        s.execute(
+            update(Outbox)
+            .where(Outbox.locked_by == _owner, Outbox.sent_at.is_(None))
+            .values(locked_by=None, locked_until=None)
+        )
+        s.commit()
+
+
+def _mark_sent(row: Outbox, message_id: int | None) -> float | None:
+    """Возвращаем задержку доставки в секундах."""
+    with SessionLocal() as s:
+        lag = s.scalar(
+            update(Outbox)
+            .where(Outbox.id == row.id, Outbox.sent_at.is_(None))
+            .values(sent_at=func.now(), sent_message_id=message_id)
+            .returning(func.extract("epoch", func.now() - Outbox.created_at))
+        )
+        if row.payload.get("_card") and row.ticket_id and message_id:
+            s.execute(
+                update(Ticket)
+                .where(Ticket.id == row.ticket_id)
+                .values(card_chat_id=row.chat_id, card_message_id=message_id)
+            )
+        s.commit()
+    return lag
+
+
+def _postpone(row_id: int, seconds: float) -> None:
+    """RetryAfter длиннее аренды: попробуем позже, попыткой это не считаем."""
+    with SessionLocal() as s:
+        s.execute(
+            update(Outbox)
+            .where(Outbox.id == row_id)
+            .values(next_attempt_at=func.now() + timedelta(seconds=seconds))
+        )
+        s.commit()
+
+
+def _mark_failed(row_id: int, err: str, permanent: bool) -> None:
+    with SessionLocal() as s:
+        row = s.get(Outbox, row_id)
+        if not row:
+            return
+        row.attempts += 1
+        row.last_error = err[:1000]
+        if permanent or row.attempts >= settings.outbox_max_attempts:
+            row.failed_at = func.now()
+        else:
+            row.next_attempt_at = func.now() + timedelta(seconds=min(300, 2 ** row.attempts))
+        s.commit()
+
+
+async def _call(row: Outbox):
+    # служебные ключи (_card) — не аргументы метода
+    kwargs = {k: v for k, v in row.payload.items() if not k.startswith("_")}
+    if "reply_markup" in kwargs:
+        kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate(kwargs["reply_markup"])
+    return await getattr(_bot, row.method)(chat_id=row.chat_id, **kwargs)
+
+
+async def _deliver(row: Outbox, deadline: float) -> bool:
+    """
+    Отправляем одну строку. False — чат надо отложить до следующей попытки.
+    deadline (time.monotonic) — конец нашей аренды: позже отправлять нельзя.
+    """
+    while True:
+        try:
+            res = await _call(row)
+            break
+        except TelegramRetryAfter as e:
+            stats["retries"] += 1
+            if time.monotonic() + e.retry_after > deadline:
+                await asyncio.to_thread(_postpone, row.id, e.retry_after)
+                return False
+            await asyncio.sleep(e.retry_after)
+        except (TelegramForbiddenError, TelegramBadRequest) as e:
+            # бот заблокирован, сообщение для копии удалено и т.п. — повтор не поможет
+            stats["failed"] += 1
+            log.warning("outbox %s to %s dropped: %s", row.id, row.chat_id, e)
+            await asyncio.to_thread(_mark_failed, row.id, repr(e), True)
+            return True
+        except Exception as e:
+            stats["retries"] += 1
+            log.warning("outbox %s to %s failed, will retry: %s", row.id, row.chat_id, e)
+            await asyncio.to_thread(_mark_failed, row.id, repr(e), False)
+            return False
+
+    lag = await asyncio.to_thread(_mark_sent, row, getattr(res, "message_id", None))
+    stats["sent"] += 1
+    if lag is not None:
+        stats["last_lag_ms"] = int(float(lag) * 1000)
+    return True
+
+
+async def _drain(chat_id: int) -> None:
+    assert _sem is not None
+    bind(chat_id=chat_id)  # своя задача — свой контекст логов
+    try:
+        async with _sem:
+            while True:
+                _again.discard(chat_id)
+                rows = await asyncio.to_thread(_claim, chat_id)
+                renew_at = time.monotonic() + settings.outbox_lease_s / 2
+                deadline = time.monotonic() + settings.outbox_lease_s - LEASE_MARGIN_S
+                stalled = renew = False
+                for row, due in rows:
+                    if _sem is None:
+                        # останавливаемся: новые не начинаем
+                        stalled = True
+                        break
+                    if not due:
+                        # голова очереди ждет повтора — остальные сообщения чата тоже ждут
+                        stalled = True
+                        break
+                    if time.monotonic() > renew_at:
+                        # половина аренды прошла — перечитываем очередь, это ее и продлит
+                        renew = True
+                        break
+                    if not await _deliver(row, deadline):
+                        stalled = True
+                        break
+                if stalled:
+                    break
+                if renew:
+                    continue
+                if len(rows) < BATCH and chat_id not in _again:
+                    break
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        log.exception("outbox delivery for chat %s failed", chat_id)
+    finally:
+        _active.pop(chat_id, None)
+        if chat_id in _again and _sem is not None:
+            # пнули, пока задача уже выходила — запускаемся заново
+            _kick(chat_id)
+
+
+def _kick(chat_id: int) -> None:
+    if _sem is None:
+        return
+    if chat_id in _active:
+        # уже доставляем — пусть после текущей пачки перечитает очередь
+        _again.add(chat_id)
+        return
+    _active[chat_id] = asyncio.create_task(_drain(chat_id))
+
+
+def _on_notify(payload: str) -> None:
+    try:
+        _kick(int(payload))
+    except ValueError:
+        pass
+
+
+def _due_chats() -> list[int]:
+    with SessionLocal() as s:
+        chats = list(s.scalars(
+            select(Outbox.chat_id)
+            .where(Outbox.sent_at.is_(None), Outbox.failed_at.is_(None),
+                   Outbox.next_attempt_at <= func.now())
+            .distinct()
+        ))
+        # отправленное держим OUTBOX_KEEP_DAYS для разборов, дальше чистим
+        s.execute(delete(Outbox).where(
+            Outbox.id.in_(
+                select(Outbox.id)
+                .where(Outbox.sent_at < func.now() - timedelta(days=settings.outbox_keep_days))
+                .limit(5000)
+                .scalar_subquery()
+            )
+        ))
+        s.commit()
+    return chats
+
+
+async def _sweep_loop() -> None:
+    assert _sweep_now is not None
+    while True:
+        try:
+            for chat_id in await asyncio.to_thread(_due_chats):
+                _kick(chat_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("outbox sweep failed")
+        _sweep_now.clear()
+        try:
+            await asyncio.wait_for(_sweep_now.wait(), settings.outbox_sweep_s)
+        except asyncio.TimeoutError:
+            pass
+
+
+async def start(bot: Bot, worker_index: int = 0) -> None:
+    """startup-хук: доставка только в нулевом воркере."""
+    global _bot, _sem, _sweep_now, _sweeper, _owner
+    if worker_index != 0:
+        return
+    _owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"[-64:]
+    _bot = bot
+    _sem = asyncio.Semaphore(settings.outbox_concurrency)
+    _sweep_now = asyncio.Event()
+    notify.subscribe(CHANNEL, _on_notify, on_connect=_sweep_now.set)
+    notify.start()
+    _sweeper = asyncio.create_task(_sweep_loop())
+
+
+async def stop() -> None:
+    global _sweeper, _sem
+    _sem = None
+    if _sweeper:
+        _sweeper.cancel()
+        try:
+            await _sweeper
+        except asyncio.CancelledError:
+            pass
+        _sweeper = None
+    # начатые отправки доводим, пока есть время (lifecycle.remaining): оборванная
+    # посреди вызова может уйти дважды. Что не успели — доставим после рестарта, строки в базе
+    if _active:
+        await asyncio.wait(list(_active.values()), timeout=lifecycle.remaining())
+    for t in list(_active.values()):
+        t.cancel()
+    await asyncio.gather(*_active.values(), return_exceptions=True)
+    _active.clear()
+    if _owner:
+        try:
+            await asyncio.to_thread(_release)
+        except Exception:
+            log.warning("outbox: can't release leases, they expire in %ss", settings.outbox_lease_s)
@@ -0,0 +1,166 @@
+"""
+Фоновый "уборщик" зависших тикетов.
+
+1) Брошенный intake: тикет WAITING создан на первом сообщении, но пользователь
+   так и не нажал "Отправить оператору" (notified_at пустой) дольше INTAKE_TTL.
+   FSM клиента живет в памяти своего воркера, отсюда его не сбросить: анкету
+   сбрасывают сами хендлеры сбора вложений, увидев закрытый тикет (routers/public.py).
+2) Заглохший диалог: ASSIGNED, но ни сообщений, ни claim дольше IDLE_TTL
+   (оператор пропал или забыл нажать "Завершить диалог").
+
+Такие тикеты закрываются пачками (UPDATE ... WHERE id IN (SELECT ... FOR UPDATE
+SKIP LOCKED) RETURNING), стороны получают уведомление.
+Счетчики — в stats.
+"""
+import asyncio
+import logging
+from datetime import timedelta
+
+from aiogram import Bot
+from sqlalchemy import select, update, func
+
+from src import texts
+from src.config import settings
+from src.db import cache
+from src.db.base import SessionLocal
+from src.db.models import Ticket, TicketStatus, TicketMessage, User
+from src.db.sla import record_close
+from src.keyboards.main import ok_kb
+from src.tasks import cards
+
+log = logging.getLogger(__name__)
+
+stats = {
+    "runs": 0,
+    "abandoned_closed": 0,
+    "idle_closed": 0,
+    "notify_failed": 0,
+}
+
+_task: asyncio.Task | None = None
+
+
+def _close_batch(where, batch: int, count_sla: bool = False) -> list[tuple[int, int, int | None]]:
+    """
+    Закрываем не больше batch тикетов по условию where.
+    Возвращаем (ticket_id, user_tg_id, operator_tg_id) закрытых.
+    count_sla — учесть закрытие в SLA-статистике (для диалогов, которые видел оператор).
+    """
+    victims = (
+        select(Ticket.id)
+        .where(*where)
+        .order_by(Ticket.id.asc())
+        .limit(batch)
+        .with_for_update(skip_locked=True)
+    )
+    with SessionLocal() as s:
+        closed = s.execute(
+            update(Ticket)
+            .where(Ticket.id.in_(victims.scalar_subquery()))
+            .values(status=TicketStatus.closed, closed_at=func.now())
+            .returning(Ticket.id, Ticket.user_id, Ticket.operator_tg_id, Ticket.kind,
+                       Ticket.created_at, Ticket.claimed_at, Ticket.closed_at)
+        ).all()
+        if not closed:
+            s.commit()
+            return []
+        if count_sla:
+            for r in closed:
+                record_close(s, r, auto=True)
+        tg_by_user = dict(s.execute(
+            select(User.id, User.tg_id).where(User.id.in_({r.user_id for r in closed}))
+        ).all())
+        cache.publish(s, cache.dialogs, *{r.operator_tg_id for r in closed}, *tg_by_user.values())
+        s.commit()
+    return [(r.id, tg_by_user.get(r.user_id), r.operator_tg_id) for r in closed]
+
+
+async def _notify(bot: Bot, chat_id: int | None, text: str, **kw) -> None:
+    if not chat_id:
+        return
+    try:
+        await bot.send_message(chat_id, text, **kw)
+    except Exception:
+        stats["notify_failed"] += 1
+
+
+async def reap_once(bot: Bot) -> tuple[int, int]:
+    """Один проход. Возвращаем (брошенных intake, заглохших диалогов)."""
+    batch = settings.reaper_batch
+    abandoned = idle = 0
+
+    if settings.reaper_intake_ttl_h > 0:
+        cutoff = func.now() - timedelta(hours=settings.reaper_intake_ttl_h)
+        while True:
+            rows = await asyncio.to_thread(_close_batch, (
+                Ticket.status == TicketStatus.waiting,
+                Ticket.notified_at.is_(None),
+                Ticket.created_at < cutoff,
+            ), batch)
+            for ticket_id, user_tg, _ in rows:
+                await _notify(bot, user_tg, texts.REAPED_INTAKE, reply_markup=ok_kb())
+            abandoned += len(rows)
+            if len(rows) < batch:
+                break
+
+    if settings.reaper_idle_ttl_h > 0:
+        cutoff = func.now() - timedelta(hours=settings.reaper_idle_ttl_h)
+        # greatest в Postgres пропускает NULL: нет сообщений / старый тикет без claimed_at
+        last_activity = func.greatest(
+            select(func.max(TicketMessage.created_at))
+            .where(TicketMessage.ticket_id == Ticket.id)
+            .correlate(Ticket)
+            .scalar_subquery(),
+            Ticket.claimed_at,
+            Ticket.created_at,
+        )
+        while True:
+            rows = await asyncio.to_thread(_close_batch, (
+                Ticket.status == TicketStatus.assigned,
+                last_activity < cutoff,
+            ), batch, True)
+            for ticket_id, user_tg, op_tg in rows:
+                cards.touch(ticket_id)
+                await _notify(bot, user_tg, texts.OP_DISCONNECTED, reply_markup=ok_kb())
+                await _notify(bot, op_tg, f"Диалог по тикету #{ticket_id} закрыт автоматически: "
+                                          f"нет сообщений больше {settings.reaper_idle_ttl_h} ч.")
+            idle += len(rows)
+            if len(rows) < batch:
+                break
+
+    stats["runs"] += 1
+    stats["abandoned_closed"] += abandoned
+    stats["idle_closed"] += idle
+    if abandoned or idle:
+        log.info("reaper: closed %s abandoned intakes, %s idle dialogs", abandoned, idle)
+    return abandoned, idle
+
+
+async def _loop(bot: Bot) -> None:
+    while True:
+        try:
+            await reap_once(bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("reaper run failed")
+        await asyncio.sleep(settings.reaper_interval_s)
+
+
+async def start(bot: Bot, worker_index: int = 0) -> None:
+    """startup-хук диспетчера. В режиме нескольких воркеров работает только в нулевом."""
+    global _task
+    if settings.reaper_interval_s <= 0 or worker_index != 0:
+        return
+    _task = asyncio.create_task(_loop(bot))
+
+
+async def stop() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
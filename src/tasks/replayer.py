@@ -0,0 +1,99 @@
+"""
+Фоновая заливка журнала деградированного режима (src/db/spool.py) в базу.
+
+Раз в SPOOL_REPLAY_S, если база доступна:
+- обновляем таблицу маршрутов прокси (не чаще ROUTES_REFRESH_S);
+- закрываем свой текущий файл журнала и заливаем все файлы, которые никто
+  не пишет (свои, соседних воркеров, оставшиеся от прошлого запуска).
+Для залитых вложений докачиваем файлы (если включено хранение медиа)
+и ставим постобработку — как будто сообщение пришло при живой базе.
+Работает в каждом воркере: журнал у каждого процесса свой, flock не дает
+залить один файл дважды.
+"""
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+
+from src.config import settings
+from src.db import spool
+from src.db.base import SessionLocal, db_available, breaker
+from src.tasks import media_store
+from src.utils.media_post import schedule_postprocess
+
+log = logging.getLogger(__name__)
+
+ROUTES_REFRESH_S = 30
+
+stats = {
+    "files_replayed": 0,
+    "routes": 0,
+}
+
+_task: asyncio.Task | None = None
+
+
+def _load_routes() -> int:
+    with SessionLocal() as s:
+        return spool.load_routes(s)
+
+
+async def replay_once(bot: Bot) -> int:
+    """Один проход по журналу. Возвращаем, сколько реплик попало в базу."""
+    spool.seal()  # свой файл тоже заливаем; писать дальше будем в новый
+    files = await asyncio.to_thread(spool.pending_files)
+
+    n = 0
+    for path in files:
+        done = await asyncio.to_thread(spool.replay_file, path, SessionLocal)
+        if done is None:
+            continue
+        stats["files_replayed"] += 1
+        n += len(done)
+        for tm_id, att_id in done:
+            if att_id and settings.store_media_local:
+                try:
+                    await media_store.ensure_local(bot, att_id)
+                except Exception as e:
+                    log.warning("spooled attachment %s not downloaded: %s", att_id, e)
+            schedule_postprocess(tm_id)
+    return n
+
+
+async def _loop(bot: Bot) -> None:
+    routes_at = 0.0
+    while True:
+        await asyncio.sleep(settings.spool_replay_s)
+        # база лежит — не мешаем предохранителю, он сам пропустит пробу
+        if breaker.is_open and not db_available():
+            continue
+        try:
+            if time.monotonic() - routes_at >= ROUTES_REFRESH_S:
+                stats["routes"] = await asyncio.to_thread(_load_routes)
+                routes_at = time.monotonic()
+            await replay_once(bot)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("spool replay failed: %s", e)
+
+
+async def start(bot: Bot, worker_index: int = 0) -> None:
+    """startup-хук: маршруты грузим сразу, журнал прошлого запуска заливаем в цикле."""
+    global _task
+    stats["routes"] = await asyncio.to_thread(_load_routes)
+    _task = asyncio.create_task(_loop(bot))
+
+
+async def stop() -> None:
+    global _task
+    if _task:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+    # дописанное уходит на диск; зальем после рестарта
+    spool.seal()
@@ -82,3 +82,18 @@ OTHER_AFTER_SEND = (
 # Сообщения для user's UI после завершения живого диалога оператором
 OP_CONNECTED = "Оператор подключился и ожидает Вас!"
 OP_DISCONNECTED = "Оператор отключился."
+
+# Reaper: пользователь начал обращение, но так и не отправил его оператору
+REAPED_INTAKE = (
+    "Ваше обращение не было отправлено оператору и закрыто.\n"
+    "Если вопрос остался — начните, пожалуйста, заново 👇"
+)
+
+# Кнопка "Отправить" в заявке, которую уже закрыли (alert на callback)
+STALE_INTAKE = "Заявка устарела. Начните, пожалуйста, заново."
+
+# База недоступна (деградированный режим): действие не выполнено, можно повторить
+DB_UNAVAILABLE = "У нас временные технические неполадки. Попробуйте, пожалуйста, еще раз через пару минут."
+
+# Антифлуд: пользователь шлет сообщения быстрее лимита, лишние выброшены
+FLOOD_WARNING = "Вы отправляете сообщения слишком часто — часть из них не дошла. Подождите немного и повторите."
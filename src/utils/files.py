@@ -1,7 +1,15 @@
+import asyncio
 import mimetypes
+import os
+import time
 from pathlib import Path
+from typing import Callable
 from aiogram import Bot, types
 from src.config import settings
+from src.utils.storage import get_storage
+
+DOWNLOAD_TIMEOUT = 300
+CHUNK_SIZE = 256 * 1024
 
 
 def _guess_ext(mime: str | None, fallback: str = ".bin") -> str:
@@ -139,20 +147,98 @@ async def save_all_attachments_from_message(bot: Bot, m: types.Message, ticket_i
 # ===== Ниже два хелпера для логики живого чата proxy.py =====
 # Они нужны, чтобы живой чат тоже продолжал складывать файлы.
 
-async def download_by_file_id(bot: Bot, file_id: str, rel_path: str) -> str:
+# подписчики на "файл сохранен": (ticket_id, размер в байтах).
+# Так учет места (src/tasks/media_store.py) узнает о каждом скачивании.
+_saved_hooks: list[Callable[[int, int], None]] = []
+
+
+def on_saved(cb: Callable[[int, int], None]) -> None:
+    _saved_hooks.append(cb)
+
+
+# результаты getFile: file_unique_id -> (file_path, когда протухнет по monotonic).
+# Один и тот же файл качаем повторно (докачка после вытеснения, заливка журнала,
+# одно фото в нескольких тикетах) — лишний запрос к Bot API не нужен.
+_file_paths: dict[str, tuple[str, float]] = {}
+FILE_PATHS_MAX = 10_000
+
+file_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "stale": 0,
+}
+
+
+async def _file_path(bot: Bot, file_id: str, unique_id: str | None) -> tuple[str, bool]:
+    """(file_path, взят ли из кэша)."""
+    key = unique_id or file_id
+    now = time.monotonic()
+    hit = _file_paths.get(key)
+    if hit and hit[1] > now:
+        file_cache_stats["hits"] += 1
+        return hit[0], True
+    file_cache_stats["misses"] += 1
+    tg_file = await bot.get_file(file_id)
+    if len(_file_paths) >= FILE_PATHS_MAX:
+        for k in [k for k, (_, exp) in _file_paths.items() if exp <= now] or [next(iter(_file_paths))]:
+            del _file_paths[k]
+    _file_paths[key] = (tg_file.file_path, now + settings.get_file_cache_ttl_s)
+    return tg_file.file_path, False
+
+
+async def download_by_file_id(
+    bot: Bot,
+    file_id: str,
+    rel_path: str,
+    ticket_id: int | None = None,
+    mime: str | None = None,
+    unique_id: str | None = None,
+) -> str:
     """
     "Старый" интерфейс, которым пользуется proxy.py.
-    Скачивает один файл по file_id в media_root/rel_path.
-    Возвращает абсолютный путь как строку.
+    Скачивает один файл по file_id в хранилище (src/utils/storage.py) под ключом rel_path.
+    unique_id (file_unique_id) — ключ кэша getFile.
+    Возвращает то, что кладем в MessageAttachment.local_path:
+    абсолютный путь для local, s3://bucket/key для s3.
     """
-    base_dir = Path(settings.media_root)
-    abs_path = base_dir / rel_path
-    abs_path.parent.mkdir(parents=True, exist_ok=True)
-
-    tg_file = await bot.get_file(file_id)
-    await bot.download(tg_file, destination=abs_path)
-
-    return str(abs_path)
+    file_path, cached = await _file_path(bot, file_id, unique_id)
+    try:
+        uri, size = await _fetch(bot, file_path, rel_path, mime)
+    except Exception:
+        if not cached:
+            raise
+        # ссылка из кэша протухла раньше срока — спрашиваем телегу заново
+        file_cache_stats["stale"] += 1
+        _file_paths.pop(unique_id or file_id, None)
+        file_path, _ = await _file_path(bot, file_id, unique_id)
+        uri, size = await _fetch(bot, file_path, rel_path, mime)
+
+    if ticket_id is not None:
+        for cb in _saved_hooks:
+            cb(ticket_id, size)
+
+    return uri
+
+
+async def _fetch(bot: Bot, file_path: str, rel_path: str, mime: str | None) -> tuple[str, int]:
+    api = bot.session.api
+    if api.is_local:
+        # локальный telegram-bot-api уже скачал файл к себе на диск (без лимита 20 МБ):
+        # забираем его в хранилище ссылкой/переносом, по HTTP ничего не гоним
+        src = str(api.wrap_local_file.to_local(file_path))
+        size = await asyncio.to_thread(os.path.getsize, src)
+        uri = await asyncio.to_thread(get_storage().ingest, src, rel_path, mime,
+                                      settings.tg_api_ingest == "move")
+        return uri, size
+
+    # качаем потоком и сразу отдаем в хранилище, целиком в памяти файл не лежит
+    stream = bot.session.stream_content(
+        url=bot.session.api.file_url(bot.token, file_path),
+        timeout=DOWNLOAD_TIMEOUT,
+        chunk_size=CHUNK_SIZE,
+        raise_for_status=True,
+    )
+    return await get_storage().save(stream, rel_path, mime)
 
 
 def build_rel_path(
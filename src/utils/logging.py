@@ -1,7 +1,217 @@
+"""
+Логи: неблокирующий вывод, JSON, контекст апдейта.
+
+- Хендлер на корневом логгере только кладет запись в очередь; в stdout пишет
+  QueueListener в своем потоке — медленный stdout / лог-драйвер докера
+  не тормозит event loop.
+- LOG_FORMAT=json (по умолчанию) — одна JSON-строка на запись, text — как раньше.
+- К каждой записи приклеивается контекст текущего апдейта (contextvars):
+  update_id, chat_id, ticket_id, handler — их выставляет
+  src/middlewares/log_context.py, ticket_id — хендлеры через bind().
+  По update_id видно, какие SQL (LOG_SLOW_QUERY_MS) и запросы к телеге
+  относятся к медленному апдейту.
+- LOG_SAMPLE="логгер=доля,..." — для шумных логгеров оставляем только часть
+  записей уровня ниже WARNING. Решение принимается по update_id: апдейт
+  либо виден целиком, либо не виден совсем.
+"""
+import atexit
+import copy
+import json
 import logging
+import queue
+import sys
+import time
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from src.config import settings
+
+CONTEXT_FIELDS = ("update_id", "chat_id", "ticket_id", "handler")
+
+_context: ContextVar[dict] = ContextVar("log_context", default={})
+_listener: QueueListener | None = None
+
+
+def bind(**fields) -> None:
+    """Дописать поля в контекст текущего апдейта (и задач, созданных из него)."""
+    _context.set({**_context.get(), **fields})
+
+
+@contextmanager
+def bound(**fields):
+    """Контекст на время блока (один апдейт), потом — как было."""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def context() -> dict:
+    return _context.get()
+
+
+def _parse_sample(spec: str) -> dict[str, float]:
+    rates = {}
+    for part in spec.split(","):
+        name, _, rate = part.strip().partition("=")
+        if name and rate:
+            rates[name] = float(rate)
+    return rates
+
+
+class ContextFilter(logging.Filter):
+    """Переносит контекст апдейта в запись; работает в потоке, который логирует."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for k, v in _context.get().items():
+            setattr(record, k, v)
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    def __init__(self, rates: dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        self._cache: dict[str, float | None] = {}
+
+    def _rate(self, name: str) -> float | None:
+        if name not in self._cache:
+            rate, n = None, name
+            # самое длинное совпадение по префиксу: aiogram.event -> aiogram
+            while n:
+                if n in self.rates:
+                    rate = self.rates[n]
+                    break
+                n = n.rpartition(".")[0]
+            self._cache[name] = rate
+        return self._cache[name]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self._rate(record.name)
+        if rate is None or rate >= 1:
+            return True
+        key = _context.get().get("update_id")
+        if key is None:
+            key = record.getMessage()
+        return zlib.crc32(str(key).encode()) % 10_000 < rate * 10_000
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, static: dict | None = None):
+        super().__init__()
+        self.static = static or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+            **self.static,
+        }
+        for k in CONTEXT_FIELDS:
+            v = getattr(record, k, None)
+            if v is not None:
+                out[k] = v
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self, static: dict | None = None):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.static = static or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = {**self.static, **{k: getattr(record, k, None) for k in CONTEXT_FIELDS}}
+        ctx = " ".join(f"{k}={v}" for k, v in fields.items() if v is not None)
+        return f"{line} [{ctx}]" if ctx else line
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # как в QueueHandler, но трейсбек отдельно от текста — JSON положит его в поле exc
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(**static) -> None:
+    """
+    static — поля, одинаковые для всего процесса (например worker=2).
+    Повторный вызов перенастраивает вывод.
+    """
+    global _listener
+    stop_logging()
+
+    fmt_cls = TextFormatter if settings.log_format == "text" else JsonFormatter
+    out = logging.StreamHandler(sys.stdout)
+    out.setFormatter(fmt_cls(static))
+
+    q: queue.SimpleQueue = queue.SimpleQueue()
+    h = _QueueHandler(q)
+    h.addFilter(ContextFilter())
+    rates = _parse_sample(settings.log_sample)
+    if rates:
+        h.addFilter(SamplingFilter(rates))
+
+    root = logging.getLogger()
+    root.handlers[:] = [h]
+    root.setLevel(settings.log_level.upper())
+
+    _listener = QueueListener(q, out, respect_handler_level=True)
+    _listener.start()
+
+
+@atexit.register
+def stop_logging() -> None:
+    """Дописать очередь и остановить поток вывода."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# -------------------------
+# медленные SQL-запросы
+# -------------------------
+
+_sql_log = logging.getLogger("src.db.slow")
+
+
+def _start(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context._log_started = time.perf_counter()
+
+
+def _end(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_log_started", None)
+    if started is None:
+        return
+    took = (time.perf_counter() - started) * 1000
+    if took >= settings.log_slow_query_ms:
+        _sql_log.warning("slow query %.0fms: %s", took, " ".join(statement.split())[:500])
+
+
+def log_slow_queries(engine) -> None:
+    """Запросы дольше LOG_SLOW_QUERY_MS — в лог, с контекстом апдейта, который их выполнил."""
+    from sqlalchemy import event
 
-def setup_logging():
-    logging.basicConfig(
-        level=logging.INFO,
-        format="%(asctime)s %(levelname)s %(name)s: %(message)s"
-    )
+    if settings.log_slow_query_ms <= 0 or event.contains(engine, "after_cursor_execute", _end):
+        return
+    event.listen(engine, "before_cursor_execute", _start)
+    event.listen(engine, "after_cursor_execute", _end)
@@ -0,0 +1,334 @@
+"""
+Постобработка скачанных вложений в пуле процессов.
+
+Для каждого MessageAttachment с local_path:
+- превью (jpg до 320px) рядом с файлом — для фото/картинок через Pillow,
+  для видео кадр через ffmpeg, если он есть в системе;
+- перцептивный хэш (dHash, 64 бита) — чтобы находить одно и то же фото
+  дефекта в разных обращениях (пережатое или обрезанное отличается на
+  несколько бит, поэтому сравниваем по расстоянию Хэмминга);
+- ширина/высота/длительность, если телега их не прислала.
+
+Вся тяжелая работа идет в ProcessPoolExecutor, event loop бота не блокируется.
+Файлы из s3 обрабатываются во временной локальной копии, превью заливается
+в бакет рядом с оригиналом.
+
+Досчитать старые вложения:
+    python -m src.utils.media_post --backfill --workers 4
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+
+from sqlalchemy import Text, and_, cast, func, literal, select
+from sqlalchemy.dialects.postgresql import BIT
+from sqlalchemy.orm import aliased
+
+from src.config import settings
+from src.db.base import SessionLocal
+from src.db.models import MessageAttachment, Ticket
+from src.utils.storage import for_uri, is_remote
+
+log = logging.getLogger(__name__)
+
+THUMB_SIZE = (320, 320)
+VIDEO_TYPES = {"video", "animation", "video_note"}
+PHASH_MAX_DISTANCE = 6  # бит из 64: дальше — уже другое фото
+ZERO_HASH = "0" * 16
+
+_pool: ProcessPoolExecutor | None = None
+_tasks: dict[asyncio.Task, int] = {}   # задача -> ticket_message_id
+
+
+# -------------------------
+# то, что выполняется в процессах пула
+# -------------------------
+
+def _dhash(img, size: int = 8) -> str:
+    """Difference hash: устойчив к пережатию и ресайзу, 16 hex-символов."""
+    from PIL import Image
+
+    small = img.convert("L").resize((size + 1, size), Image.LANCZOS)
+    px = small.load()
+    bits = 0
+    for y in range(size):
+        for x in range(size):
+            bits = (bits << 1) | (px[x, y] > px[x + 1, y])
+    return f"{bits:0{size * size // 4}x}"
+
+
+def _image_info(src: str, thumb: str) -> dict:
+    from PIL import Image
+
+    with Image.open(src) as img:
+        out = {"width": img.width, "height": img.height, "phash": _dhash(img)}
+        img.thumbnail(THUMB_SIZE)
+        img.convert("RGB").save(thumb, "JPEG", quality=80)
+    out["thumb_path"] = thumb
+    return out
+
+
+def _video_info(src: str, thumb: str) -> dict:
+    out: dict = {}
+    if shutil.which("ffprobe"):
+        r = subprocess.run(
+            ["ffprobe", "-v", "error", "-select_streams", "v:0",
+             "-show_entries", "stream=width,height:format=duration", "-of", "json", src],
+            capture_output=True, text=True, timeout=60,
+        )
+        if r.returncode == 0:
+            meta = json.loads(r.stdout or "{}")
+            stream = (meta.get("streams") or [{}])[0]
+            out["width"] = stream.get("width")
+            out["height"] = stream.get("height")
+            dur = (meta.get("format") or {}).get("duration")
+            if dur:
+                out["duration"] = int(float(dur))
+    if shutil.which("ffmpeg"):
+        r = subprocess.run(
+            ["ffmpeg", "-v", "error", "-y", "-ss", "1", "-i", src, "-frames:v", "1",
+             "-vf", f"scale={THUMB_SIZE[0]}:-2", thumb],
+            capture_output=True, timeout=120,
+        )
+        if r.returncode == 0 and os.path.exists(thumb):
+            out["thumb_path"] = thumb
+            try:
+                from PIL import Image
+                with Image.open(thumb) as img:
+                    out["phash"] = _dhash(img)
+            except ImportError:
+                pass
+    return out
+
+
+def process_file(path: str, media_type: str, mime: str | None) -> dict:
+    """
+    Обработка одного файла. Выполняется в дочернем процессе,
+    поэтому только простые аргументы и простой результат.
+    """
+    if not path or not os.path.isfile(path):
+        return {}
+    thumb = str(Path(path).with_suffix(".thumb.jpg"))
+    is_image = media_type == "photo" or (media_type == "document" and (mime or "").startswith("image/"))
+    is_video = media_type in VIDEO_TYPES or (media_type == "document" and (mime or "").startswith("video/"))
+    try:
+        if is_image:
+            return _image_info(path, thumb)
+        if is_video:
+            return _video_info(path, thumb)
+    except ImportError:
+        # Pillow не установлен — просто ничего не считаем
+        return {}
+    except Exception as e:
+        return {"error": repr(e)}
+    return {}
+
+
+# -------------------------
+# сторона бота
+# -------------------------
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max(1, settings.media_workers))
+    return _pool
+
+
+def _store_result(att_id: int, res: dict) -> None:
+    """Пишем результат в строку, не затирая то, что уже пришло от телеги."""
+    with SessionLocal() as s:
+        att = s.get(MessageAttachment, att_id)
+        if not att:
+            return
+        att.thumb_path = res.get("thumb_path")
+        att.phash = res.get("phash")
+        for k in ("width", "height", "duration"):
+            if getattr(att, k) is None and res.get(k) is not None:
+                setattr(att, k, res[k])
+        att.processed_at = datetime.now(timezone.utc)
+        s.commit()
+
+
+def _process_uri(pool: ProcessPoolExecutor, uri: str, media_type: str, mime: str | None) -> dict:
+    """
+    Обработка одного файла из хранилища (вызывается из потока).
+    Для s3 — через временную копию, готовое превью заливаем рядом с оригиналом.
+    """
+    st = for_uri(uri)
+    try:
+        with st.local_copy(uri) as path:
+            res = pool.submit(process_file, path, media_type, mime).result()
+            thumb = res.get("thumb_path")
+            if thumb and is_remote(uri):
+                key = str(Path(st.key_of(uri)).with_suffix(".thumb.jpg"))
+                res["thumb_path"] = st.put_file(thumb, key, "image/jpeg")
+    except Exception as e:
+        # например, объект уже удален из бакета
+        return {"error": repr(e)}
+    return res
+
+
+def _unprocessed(ticket_message_id: int) -> list:
+    with SessionLocal() as s:
+        return s.execute(
+            select(MessageAttachment.id, MessageAttachment.local_path,
+                   MessageAttachment.media_type, MessageAttachment.mime_type)
+            .where(
+                MessageAttachment.ticket_message_id == ticket_message_id,
+                MessageAttachment.local_path.is_not(None),
+                MessageAttachment.processed_at.is_(None),
+            )
+        ).all()
+
+
+async def postprocess_message(ticket_message_id: int) -> None:
+    rows = await asyncio.to_thread(_unprocessed, ticket_message_id)
+    for att_id, uri, media_type, mime in rows:
+        try:
+            res = await asyncio.to_thread(_process_uri, _get_pool(), uri, media_type, mime)
+            if res.get("error"):
+                log.warning("media postprocess failed for attachment %s: %s", att_id, res["error"])
+            await asyncio.to_thread(_store_result, att_id, res)
+        except Exception:
+            log.exception("media postprocess failed for attachment %s", att_id)
+
+
+def schedule_postprocess(ticket_message_id: int) -> None:
+    """
+    Ставим фоновую обработку вложений сообщения.
+    Вызывать после commit, когда local_path уже в базе.
+    """
+    if not (settings.store_media_local and settings.media_workers > 0):
+        return
+    task = asyncio.create_task(postprocess_message(ticket_message_id))
+    _tasks[task] = ticket_message_id
+    task.add_done_callback(lambda t: _tasks.pop(t, None))
+
+
+async def drain(timeout: float) -> list[int]:
+    """
+    Ждем начатую постобработку не дольше timeout; что не успело — отменяем
+    (ее повторит следующий старт) и возвращаем id этих сообщений.
+    """
+    if _tasks:
+        await asyncio.wait(list(_tasks), timeout=timeout)
+    left = [(t, tm_id) for t, tm_id in _tasks.items() if not t.done()]
+    for t, _ in left:
+        t.cancel()
+    return [tm_id for _, tm_id in left]
+
+
+def shutdown() -> None:
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def _bits(phash):
+    """hex dHash -> bit(64) в Postgres."""
+    return cast(literal("x") + phash, BIT(64))
+
+
+def find_reused_photos(ticket_id: int) -> list[tuple[int, int]]:
+    """
+    Ищем в тикетах других пользователей вложения, похожие на фото этого тикета:
+    phash отличается не больше чем на PHASH_MAX_DISTANCE бит (пережатое, уменьшенное
+    или чуть обрезанное фото). Возвращаем пары (attachment_id, другой ticket_id).
+    Индекс по расстоянию не работает — это проход по всем хэшам, вызывать из потока.
+    """
+    own = aliased(MessageAttachment)
+    distance = func.length(func.replace(
+        cast(_bits(own.phash).op("#")(_bits(MessageAttachment.phash)), Text), "0", ""
+    ))
+    with SessionLocal() as s:
+        me = select(Ticket.user_id).where(Ticket.id == ticket_id).scalar_subquery()
+        return [
+            (a_id, t_id) for a_id, t_id in s.execute(
+                select(MessageAttachment.id, MessageAttachment.ticket_id)
+                .join(Ticket, Ticket.id == MessageAttachment.ticket_id)
+                .join(own, and_(
+                    own.ticket_id == ticket_id,
+                    own.phash.is_not(None),
+                    # однотонные картинки (черный экран и т.п.) дают нулевой хэш — это не совпадение
+                    own.phash != ZERO_HASH,
+                    distance <= PHASH_MAX_DISTANCE,
+                ))
+                .where(
+                    MessageAttachment.phash.is_not(None),
+                    MessageAttachment.phash != ZERO_HASH,
+                    MessageAttachment.ticket_id != ticket_id,
+                    Ticket.user_id != me,
+                )
+                .distinct()
+                .order_by(MessageAttachment.ticket_id.asc())
+                .limit(20)
+            ).all()
+        ]
+
+
+# -------------------------
+# backfill
+# -------------------------
+
+def backfill(workers: int, batch: int) -> None:
+    done = 0
+    failed = 0
+    last_id = 0
+    t0 = time.perf_counter()
+    # потоки только ждут: скачивание копии из s3 и результат из пула процессов
+    with ProcessPoolExecutor(max_workers=workers) as pool, ThreadPoolExecutor(max_workers=workers * 2) as io:
+        while True:
+            with SessionLocal() as s:
+                rows = s.execute(
+                    select(MessageAttachment.id, MessageAttachment.local_path,
+                           MessageAttachment.media_type, MessageAttachment.mime_type)
+                    .where(
+                        MessageAttachment.id > last_id,
+                        MessageAttachment.local_path.is_not(None),
+                        MessageAttachment.processed_at.is_(None),
+                    )
+                    .order_by(MessageAttachment.id.asc())
+                    .limit(batch)
+                ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            results = io.map(lambda r: _process_uri(pool, *r[1:]), rows)
+            for (att_id, *_), res in zip(rows, results):
+                if res.get("error"):
+                    failed += 1
+                _store_result(att_id, res)
+                done += 1
+
+            dt = time.perf_counter() - t0
+            print(f"processed {done} (errors {failed}) — {done / dt:.1f} files/s, "
+                  f"{done / dt / workers:.1f} files/s/core")
+
+    dt = time.perf_counter() - t0
+    if done:
+        print(f"total {done} files in {dt:.1f}s: {done / dt:.1f} files/s, "
+              f"{done / dt / workers:.1f} files/s/core ({workers} workers)")
+    else:
+        print("nothing to backfill")
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(prog="python -m src.utils.media_post")
+    p.add_argument("--backfill", action="store_true", help="обработать все еще не обработанные вложения")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    p.add_argument("--batch", type=int, default=200)
+    args = p.parse_args()
+    if not args.backfill:
+        p.error("укажите --backfill")
+    backfill(args.workers, args.batch)
@@ -0,0 +1,79 @@
+"""
+Нормализация телефонов в E.164.
+
+phonenumbers тянет тяжелые метаданные, поэтому импортируется лениво —
+при первом реальном номере, а не при старте бота.
+Результаты кэшируются: один и тот же номер парсится один раз.
+
+Досчитать phone_e164 для уже сохраненных номеров:
+    python -m src.utils.phone --backfill
+"""
+import argparse
+from functools import lru_cache
+from typing import Iterable
+
+from src.config import settings
+
+
+@lru_cache(maxsize=1)
+def _pn():
+    import phonenumbers
+    return phonenumbers
+
+
+@lru_cache(maxsize=4096)
+def normalize_phone(raw: str, region: str | None = None) -> str | None:
+    """'+7 (999) 123-45-67' / '89991234567' -> '+79991234567', мусор -> None."""
+    if not raw:
+        return None
+    pn = _pn()
+    try:
+        num = pn.parse(raw, region or settings.default_region)
+        if pn.is_valid_number(num):
+            return pn.format_number(num, pn.PhoneNumberFormat.E164)
+        return None
+    except Exception:
+        return None
+
+
+def normalize_many(raws: Iterable[str | None], region: str | None = None) -> list[str | None]:
+    """Пачкой, для бэкфилла. Повторы внутри пачки берутся из кэша."""
+    return [normalize_phone(r, region) if r else None for r in raws]
+
+
+def backfill(batch: int = 1000) -> int:
+    from sqlalchemy import select, update
+    from src.db.base import SessionLocal
+    from src.db.models import User
+
+    total = 0
+    last_id = 0
+    while True:
+        with SessionLocal() as s:
+            rows = s.execute(
+                select(User.id, User.phone)
+                .where(User.id > last_id, User.phone.is_not(None), User.phone_e164.is_(None))
+                .order_by(User.id.asc())
+                .limit(batch)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1][0]
+            normalized = normalize_many(r[1] for r in rows)
+            params = [{"id": r[0], "phone_e164": e} for r, e in zip(rows, normalized) if e]
+            if params:
+                # ORM bulk update по первичному ключу — один executemany на пачку
+                s.execute(update(User), params)
+                s.commit()
+            total += len(params)
+    return total
+
+
+if __name__ == "__main__":
+    p = argparse.ArgumentParser(prog="python -m src.utils.phone")
+    p.add_argument("--backfill", action="store_true", help="заполнить users.phone_e164 из users.phone")
+    p.add_argument("--batch", type=int, default=1000)
+    args = p.parse_args()
+    if not args.backfill:
+        p.error("укажите --backfill")
+    print(f"normalized: {backfill(args.batch)}")
@@ -0,0 +1,323 @@
+"""
+Где лежат файлы вложений.
+
+- local (по умолчанию): файлы в media_root, в базе (MessageAttachment.local_path)
+  абсолютный путь — как было всегда.
+- s3: любое S3-совместимое хранилище (AWS, MinIO, Yandex Object Storage...),
+  в базе URI вида s3://bucket/key. Нужен boto3 (pip install boto3).
+
+Файл из телеги идет потоком прямо в хранилище: для s3 это multipart upload,
+в памяти одновременно не больше двух частей по PART_SIZE, на диск ничего не пишем.
+
+Старые строки с обычными путями продолжают работать и после переключения
+на s3: бэкенд выбирается по самому URI (for_uri).
+"""
+import asyncio
+import os
+import shutil
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Iterator
+
+import aiofiles
+
+from src.config import settings
+
+S3_SCHEME = "s3://"
+PART_SIZE = 8 * 1024 * 1024  # у S3 минимум 5 МБ на часть (кроме последней)
+LINK_TTL = 7 * 24 * 3600     # сколько живут ссылки на файлы в html-истории
+
+
+class LocalStorage:
+    def __init__(self, root: str):
+        self.root = Path(root)
+
+    async def save(self, chunks: AsyncIterator[bytes], key: str, mime: str | None = None) -> tuple[str, int]:
+        """Пишем поток в root/key, возвращаем (uri, размер)."""
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".part")
+        size = 0
+        try:
+            async with aiofiles.open(tmp, "wb") as f:
+                async for chunk in chunks:
+                    await f.write(chunk)
+                    size += len(chunk)
+            os.replace(tmp, path)
+        except BaseException:
+            tmp.unlink(missing_ok=True)
+            raise
+        return str(path), size
+
+    def put_file(self, src: str, key: str, mime: str | None = None) -> str:
+        path = self.root / key
+        if Path(src).resolve() != path.resolve():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(src, path)
+        return str(path)
+
+    def ingest(self, src: str, key: str, mime: str | None = None, move: bool = False) -> str:
+        """
+        Забрать готовый файл с диска (его скачал локальный telegram-bot-api) без чтения содержимого:
+        жесткая ссылка или перенос; на другом диске — копия средствами ядра (copyfile/sendfile).
+        """
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.tmp")
+        try:
+            if move:
+                os.replace(src, tmp)
+            else:
+                os.link(src, tmp)
+        except FileExistsError:
+            os.unlink(tmp)
+            return self.ingest(src, key, mime, move)
+        except OSError:
+            # EXDEV и т.п.: папка сервера на другом разделе
+            shutil.copyfile(src, tmp)
+            if move:
+                os.unlink(src)
+        os.replace(tmp, path)
+        return str(path)
+
+    def exists(self, uri: str) -> bool:
+        return os.path.isfile(uri)
+
+    def size(self, uri: str) -> int | None:
+        try:
+            return os.path.getsize(uri)
+        except OSError:
+            return None
+
+    def read(self, uri: str, limit: int | None = None) -> bytes | None:
+        """Содержимое файла; None, если его нет или он больше limit."""
+        size = self.size(uri)
+        if size is None or (limit is not None and size > limit):
+            return None
+        with open(uri, "rb") as f:
+            return f.read()
+
+    def delete(self, uri: str) -> int:
+        """Удаляем, возвращаем сколько байт освободили (0 — файла уже не было)."""
+        size = self.size(uri)
+        if size is None:
+            return 0
+        try:
+            os.remove(uri)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    @contextmanager
+    def local_copy(self, uri: str) -> Iterator[str]:
+        yield uri
+
+    def link(self, uri: str) -> str | None:
+        # путь на сервере бота оператор не откроет (file:///app/media/...) — ссылки нет
+        return None
+
+    def key_of(self, uri: str) -> str:
+        try:
+            return Path(uri).relative_to(self.root).as_posix()
+        except ValueError:
+            return Path(uri).name
+
+
+class S3Storage:
+    def __init__(self, bucket: str, prefix: str = ""):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/") + "/" if prefix.strip("/") else ""
+        self._c = None
+
+    @property
+    def client(self):
+        if self._c is None:
+            try:
+                import boto3
+                from botocore.config import Config
+            except ImportError:
+                raise RuntimeError("для MEDIA_BACKEND=s3 нужен boto3 (pip install boto3)")
+            self._c = boto3.client(
+                "s3",
+                endpoint_url=settings.s3_endpoint_url,
+                region_name=settings.s3_region,
+                aws_access_key_id=settings.s3_access_key,
+                aws_secret_access_key=settings.s3_secret_key,
+                config=Config(max_pool_connections=32, retries={"max_attempts": 5, "mode": "standard"}),
+            )
+        return self._c
+
+    def _split(self, uri: str) -> tuple[str, str]:
+        bucket, _, key = uri[len(S3_SCHEME):].partition("/")
+        return bucket, key
+
+    def _uri(self, key: str) -> str:
+        return f"{S3_SCHEME}{self.bucket}/{key}"
+
+    async def _upload_part(self, key: str, upload_id: str, num: int, data: bytes, parts: list) -> None:
+        r = await asyncio.to_thread(
+            self.client.upload_part,
+            Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=num, Body=data,
+        )
+        parts.append({"PartNumber": num, "ETag": r["ETag"]})
+
+    async def save(self, chunks: AsyncIterator[bytes], key: str, mime: str | None = None) -> tuple[str, int]:
+        """
+        Поток -> объект. Маленькие файлы одним put_object, большие — multipart:
+        следующая часть качается из телеги, пока предыдущая грузится в S3.
+        """
+        key = self.prefix + key
+        extra = {"ContentType": mime} if mime else {}
+        buf = bytearray()
+        size = 0
+        num = 0
+        upload_id: str | None = None
+        parts: list[dict] = []
+        inflight: asyncio.Task | None = None
+        try:
+            async for chunk in chunks:
+                buf += chunk
+                size += len(chunk)
+                if len(buf) < PART_SIZE:
+                    continue
+                if upload_id is None:
+                    upload_id = (await asyncio.to_thread(
+                        self.client.create_multipart_upload, Bucket=self.bucket, Key=key, **extra,
+                    ))["UploadId"]
+                if inflight:
+                    await inflight
+                num += 1
+                inflight = asyncio.create_task(self._upload_part(key, upload_id, num, bytes(buf), parts))
+                buf.clear()
+
+            if upload_id is None:
+                await asyncio.to_thread(
+                    self.client.put_object, Bucket=self.bucket, Key=key, Body=bytes(buf), **extra,
+                )
+                return self._uri(key), size
+
+            await inflight
+            inflight = None
+            if buf:
+                num += 1
+                await self._upload_part(key, upload_id, num, bytes(buf), parts)
+            await asyncio.to_thread(
+                self.client.complete_multipart_upload,
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={"Parts": sorted(parts, key=lambda p: p["PartNumber"])},
+            )
+            return self._uri(key), size
+        except BaseException:
+            if inflight and not inflight.done():
+                inflight.cancel()
+            if upload_id:
+                # иначе недогруженные части так и лежат в бакете и тарифицируются
+                await asyncio.shield(asyncio.to_thread(
+                    self.client.abort_multipart_upload, Bucket=self.bucket, Key=key, UploadId=upload_id,
+                ))
+            raise
+
+    def put_file(self, src: str, key: str, mime: str | None = None) -> str:
+        key = self.prefix + key
+        self.client.upload_file(src, self.bucket, key, ExtraArgs={"ContentType": mime} if mime else None)
+        return self._uri(key)
+
+    def ingest(self, src: str, key: str, mime: str | None = None, move: bool = False) -> str:
+        """Файл с диска локального telegram-bot-api: заливаем в бакет, при move — удаляем исходник."""
+        uri = self.put_file(src, key, mime)
+        if move:
+            os.unlink(src)
+        return uri
+
+    def _head(self, uri: str) -> dict | None:
+        from botocore.exceptions import ClientError
+
+        bucket, key = self._split(uri)
+        try:
+            return self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+
+    def exists(self, uri: str) -> bool:
+        return self._head(uri) is not None
+
+    def size(self, uri: str) -> int | None:
+        head = self._head(uri)
+        return head["ContentLength"] if head else None
+
+    def read(self, uri: str, limit: int | None = None) -> bytes | None:
+        size = self.size(uri)
+        if size is None or (limit is not None and size > limit):
+            return None
+        bucket, key = self._split(uri)
+        return self.client.get_object(Bucket=bucket, Key=key)["Body"].read()
+
+    def delete(self, uri: str) -> int:
+        size = self.size(uri)
+        if size is None:
+            return 0
+        bucket, key = self._split(uri)
+        self.client.delete_object(Bucket=bucket, Key=key)
+        return size
+
+    @contextmanager
+    def local_copy(self, uri: str) -> Iterator[str]:
+        """
+        Временная локальная копия (для Pillow/ffmpeg). Все, что создано
+        рядом с ней (превью), удаляется вместе с папкой на выходе.
+        """
+        bucket, key = self._split(uri)
+        d = tempfile.mkdtemp(prefix="media_")
+        try:
+            path = os.path.join(d, Path(key).name)
+            self.client.download_file(bucket, key, path)
+            yield path
+        finally:
+            shutil.rmtree(d, ignore_errors=True)
+
+    def link(self, uri: str) -> str | None:
+        bucket, key = self._split(uri)
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": bucket, "Key": key}, ExpiresIn=LINK_TTL,
+        )
+
+    def key_of(self, uri: str) -> str:
+        key = self._split(uri)[1]
+        return key[len(self.prefix):] if self.prefix and key.startswith(self.prefix) else key
+
+
+_local: LocalStorage | None = None
+_s3: S3Storage | None = None
+
+
+def _local_storage() -> LocalStorage:
+    global _local
+    if _local is None:
+        _local = LocalStorage(settings.media_root)
+    return _local
+
+
+def _s3_storage() -> S3Storage:
+    global _s3
+    if _s3 is None:
+        if not settings.s3_bucket:
+            raise RuntimeError("MEDIA_BACKEND=s3, но не задан S3_BUCKET")
+        _s3 = S3Storage(settings.s3_bucket, settings.s3_prefix)
+    return _s3
+
+
+def get_storage() -> LocalStorage | S3Storage:
+    """Куда сохранять новые файлы."""
+    return _s3_storage() if settings.media_backend == "s3" else _local_storage()
+
+
+def for_uri(uri: str) -> LocalStorage | S3Storage:
+    """Кто умеет работать с уже сохраненным файлом."""
+    return _s3_storage() if uri.startswith(S3_SCHEME) else _local_storage()
+
+
+def is_remote(uri: str) -> bool:
+    return uri.startswith(S3_SCHEME)
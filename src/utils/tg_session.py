@@ -0,0 +1,109 @@
+"""
+HTTP-сессия бота к Bot API.
+
+Одна на процесс (build_bot), поверх aiogram AiohttpSession:
+- пул соединений TG_CONN_LIMIT, keep-alive TG_KEEPALIVE_S — запросы идут
+  по уже открытым TLS-соединениям, без нового рукопожатия на каждый;
+- DNS кэшируется на TG_DNS_TTL_S;
+- таймаут на установку соединения отдельно от общего: недоступный
+  api.telegram.org отваливается за TG_CONNECT_TIMEOUT_S, а не за минуту;
+- свой сервер telegram-bot-api (TG_API_BASE, TG_API_LOCAL) — см. download_by_file_id;
+- задержки по методам Bot API — в stats (calls / errors / total_ms / max_ms),
+  скачивание файлов считается как "download".
+"""
+import time
+from pathlib import Path
+from typing import Any, AsyncGenerator
+
+from aiohttp import ClientTimeout
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer, BareFilesPathWrapper, SimpleFilesPathWrapper
+from aiogram.methods import TelegramMethod
+
+from src.config import settings
+
+stats: dict[str, dict[str, float]] = {}
+
+
+def _observe(name: str, took: float, failed: bool) -> None:
+    st = stats.get(name)
+    if st is None:
+        st = stats[name] = {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0}
+    ms = took * 1000
+    st["calls"] += 1
+    st["errors"] += failed
+    st["total_ms"] += ms
+    st["max_ms"] = max(st["max_ms"], ms)
+
+
+def latency_summary() -> dict[str, dict[str, float]]:
+    """{метод: {calls, errors, avg_ms, max_ms}} — для отчетов и бенчей."""
+    return {
+        name: {
+            "calls": int(st["calls"]),
+            "errors": int(st["errors"]),
+            "avg_ms": round(st["total_ms"] / st["calls"], 2) if st["calls"] else 0.0,
+            "max_ms": round(st["max_ms"], 2),
+        }
+        for name, st in sorted(stats.items())
+    }
+
+
+def _files_wrapper():
+    # сервер и бот видят рабочую папку сервера по разным путям (разные контейнеры)
+    if settings.tg_api_files_dir:
+        return SimpleFilesPathWrapper(Path(settings.tg_api_server_dir), Path(settings.tg_api_files_dir))
+    return BareFilesPathWrapper()
+
+
+class TunedSession(AiohttpSession):
+    """
+    api_base — другой Bot API сервер; local — он запущен с --local
+    (getFile отдает путь к файлу на диске, лимит на скачивание 20 МБ не действует).
+    """
+
+    def __init__(self, api_base: str | None = None, local: bool = False, **kwargs: Any):
+        if api_base:
+            kwargs["api"] = TelegramAPIServer.from_base(api_base, is_local=local, wrap_local_file=_files_wrapper())
+        super().__init__(limit=settings.tg_conn_limit, timeout=settings.tg_request_timeout_s, **kwargs)
+        self._connector_init.update(
+            ttl_dns_cache=settings.tg_dns_ttl_s,
+            keepalive_timeout=settings.tg_keepalive_s,
+        )
+
+    def _timeout(self, total: float) -> ClientTimeout:
+        return ClientTimeout(total=total, sock_connect=settings.tg_connect_timeout_s)
+
+    async def make_request(self, bot: Bot, method: TelegramMethod, timeout: int | None = None):
+        # aiogram отдает число (его же складывает с таймаутом long polling),
+        # aiohttp принимает и ClientTimeout — добавляем к общему таймауту таймаут соединения
+        total = self.timeout if timeout is None else timeout
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            res = await super().make_request(bot, method, timeout=self._timeout(total))  # type: ignore[arg-type]
+            failed = False
+            return res
+        finally:
+            _observe(method.__api_method__, time.perf_counter() - t0, failed)
+
+    async def stream_content(
+        self,
+        url: str,
+        headers: dict[str, Any] | None = None,
+        timeout: int = 30,
+        chunk_size: int = 65536,
+        raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        t0 = time.perf_counter()
+        failed = True
+        try:
+            async for chunk in super().stream_content(
+                url, headers=headers, timeout=self._timeout(timeout),  # type: ignore[arg-type]
+                chunk_size=chunk_size, raise_for_status=raise_for_status,
+            ):
+                yield chunk
+            failed = False
+        finally:
+            _observe("download", time.perf_counter() - t0, failed)
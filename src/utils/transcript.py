@@ -0,0 +1,343 @@
+import base64
+import html
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from src.config import settings
+from src.db.base import read_session
+from src.db.models import Ticket, TicketStatus, TicketMessage, MessageAttachment, User
+from src.utils.storage import for_uri
+
+# фото больше этого не встраиваем в html, только ссылкой
+INLINE_IMAGE_LIMIT = 512 * 1024
+# файлы без ссылки (локальное хранилище) встраиваем целиком, если не больше этого
+INLINE_FILE_LIMIT = 512 * 1024
+# вся история уходит одним send_document (до 50 МБ): встроенного (base64) — не больше
+# этого на документ, дальше вложения только ссылкой или именем и file_id
+INLINE_DOCUMENT_LIMIT = 40 * 1024 * 1024
+# кэш фрагментов обрезаем не чаще раза в столько секунд, до 90% TRANSCRIPT_CACHE_MB
+CACHE_TRIM_S = 60
+CACHE_LOW_WATERMARK = 0.9
+
+_CSS = """
+body{font-family:-apple-system,Segoe UI,Roboto,sans-serif;max-width:820px;margin:16px auto;padding:0 12px;color:#222}
+h2{border-bottom:1px solid #ddd;padding-bottom:4px;margin-top:32px;font-size:18px}
+.meta{color:#777;font-size:13px}
+.m{margin:6px 0;padding:6px 10px;border-radius:8px;max-width:85%;white-space:pre-wrap;word-wrap:break-word}
+.user{background:#f1f1f1}
+.operator{background:#e3f0ff;margin-left:auto}
+.who{font-size:12px;color:#555}
+img{max-width:320px;max-height:320px;display:block;margin-top:4px;border-radius:4px}
+"""
+
+
+_cache_trimmed_at = 0.0
+
+
+class _Inline:
+    """Сколько байт data: URI еще можно встроить в документ истории."""
+
+    def __init__(self, left: int):
+        self.left = left
+        self.denied = False  # что-то не встроили: такой фрагмент не кэшируем
+
+    def uri(self, data: bytes, mime: str) -> str | None:
+        b64 = base64.b64encode(data).decode()
+        if len(b64) > self.left:
+            self.denied = True
+            return None
+        self.left -= len(b64)
+        return f"data:{html.escape(mime)};base64,{b64}"
+
+
+def _transcripts_dir() -> Path:
+    d = Path(settings.media_root) / "_transcripts"
+    d.mkdir(parents=True, exist_ok=True)
+    return d
+
+
+def _trim_cache(d: Path) -> None:
+    """
+    Фрагменты — это base64-копии медиа, квота media_store их не видит: держим
+    кэш в TRANSCRIPT_CACHE_MB, выбрасывая давно не использованные (mtime
+    обновляется при каждом использовании фрагмента).
+    """
+    global _cache_trimmed_at
+    limit = settings.transcript_cache_mb * 1024 * 1024
+    now = time.monotonic()
+    if not limit or now - _cache_trimmed_at < CACHE_TRIM_S:
+        return
+    _cache_trimmed_at = now
+    files = []
+    for e in os.scandir(d):
+        if e.name.startswith("ticket_") and e.name.endswith(".html"):
+            try:
+                st = e.stat()
+            except FileNotFoundError:
+                continue
+            files.append((st.st_mtime, st.st_size, e.path))
+    total = sum(size for _, size, _ in files)
+    if total <= limit:
+        return
+    files.sort()
+    target = int(limit * CACHE_LOW_WATERMARK)
+    for _, size, path in files:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+
+def forget_fragments(ticket_ids) -> None:
+    """
+    Выбрасываем закэшированные фрагменты тикетов: их файлы вытеснены
+    (src/tasks/media_store.py), следующая история перерисует их без ссылок.
+    """
+    d = Path(settings.media_root) / "_transcripts"
+    if not d.is_dir():
+        return
+    for tid in ticket_ids:
+        for p in d.glob(f"ticket_{tid}_*.html"):
+            p.unlink(missing_ok=True)
+
+
+def _fmt(dt) -> str:
+    return dt.strftime("%Y-%m-%d %H:%M") if dt else "—"
+
+
+def _fragment_name(t: Ticket, version: str | None) -> str:
+    """
+    Ключ кэша фрагмента.
+    Закрытый тикет уже не меняется — рендерим его один раз навсегда (вытеснение
+    файлов выбрасывает фрагмент само, forget_fragments).
+    Открытый — перерисовываем, когда поменялся статус или версия содержимого:
+    новое сообщение, новое вложение, файл докачался, готово превью (_versions).
+    """
+    if t.status == TicketStatus.closed:
+        if settings.media_backend == "s3":
+            # ссылки на s3 подписанные и живут неделю — раз в неделю перерисовываем
+            return f"ticket_{t.id}_CLOSED_{date.today().strftime('%G%V')}.html"
+        return f"ticket_{t.id}_CLOSED.html"
+    return f"ticket_{t.id}_{t.status.value}_{version or 0}.html"
+
+
+def _versions(s: Session, ticket_ids: list[int]) -> dict[int, str]:
+    """Версия содержимого открытых тикетов: последнее сообщение и состояние вложений."""
+    if not ticket_ids:
+        return {}
+    rows = s.execute(
+        select(
+            TicketMessage.ticket_id,
+            func.max(TicketMessage.id),
+            func.max(MessageAttachment.id),
+            func.count(MessageAttachment.local_path),
+            func.count(MessageAttachment.processed_at),
+        )
+        .outerjoin(MessageAttachment, MessageAttachment.ticket_message_id == TicketMessage.id)
+        .where(TicketMessage.ticket_id.in_(ticket_ids))
+        .group_by(TicketMessage.ticket_id)
+    ).all()
+    return {tid: f"{msg}_{att or 0}_{local}_{processed}" for tid, msg, att, local, processed in rows}
+
+
+def _attachment_html(att, inline: _Inline) -> str:
+    """html вложения; все встроенное (data: URI) — в счет inline."""
+    name = html.escape(att.file_name or f"{att.media_type}")
+    path = att.local_path
+    # ссылка, которую оператор откроет (s3); у локального хранилища ее нет
+    url = for_uri(path).link(path) if path else None
+    # готовое превью из media_post — встраиваем его и даем ссылку на оригинал
+    thumb = for_uri(att.thumb_path).read(att.thumb_path) if att.thumb_path else None
+    src = inline.uri(thumb, "image/jpeg") if thumb else None
+    if src:
+        img = f'<img src="{src}" alt="{name}">'
+        if url:
+            return f'<a href="{html.escape(url)}">{img}</a>'
+        return img
+    if att.media_type == "photo" and path and not thumb:
+        data = for_uri(path).read(path, limit=INLINE_IMAGE_LIMIT)
+        src = inline.uri(data, "image/jpeg") if data else None
+        if src:
+            return f'<img src="{src}" alt="{name}">'
+    size = f", {att.size // 1024} КБ" if att.size else ""
+    if url:
+        return f'<div>📎 <a href="{html.escape(url)}">{name}</a>{size}</div>'
+    if path and att.media_type != "photo":
+        data = for_uri(path).read(path, limit=INLINE_FILE_LIMIT)
+        href = inline.uri(data, att.mime_type or "application/octet-stream") if data is not None else None
+        if href:
+            return f'<div>📎 <a download="{name}" href="{href}">{name}</a>{size}</div>'
+    return f"<div>📎 {name}{size} <span class=\"meta\">file_id {html.escape(att.file_id)}</span></div>"
+
+
+def _render_ticket(s: Session, t: Ticket, operator_label: str, out: Path, inline: _Inline) -> None:
+    """
+    Пишем фрагмент одного тикета в файл, сообщения читаем потоком.
+    Пишем во временный файл и переименовываем, чтобы в кэше не было обрезков.
+    Встроенное медиа — в счет бюджета документа inline.
+    """
+    # только колонки, без ORM-объектов: identity map не растет на длинных тикетах
+    rows = s.execute(
+        select(
+            TicketMessage.id,
+            TicketMessage.sender_type,
+            TicketMessage.message_text,
+            TicketMessage.caption,
+            TicketMessage.created_at,
+            MessageAttachment.id.label("att_id"),
+            MessageAttachment.media_type,
+            MessageAttachment.file_id,
+            MessageAttachment.file_name,
+            MessageAttachment.mime_type,
+            MessageAttachment.size,
+            MessageAttachment.local_path,
+            MessageAttachment.thumb_path,
+        )
+        .outerjoin(MessageAttachment, MessageAttachment.ticket_message_id == TicketMessage.id)
+        .where(TicketMessage.ticket_id == t.id)
+        .order_by(TicketMessage.created_at.asc(), TicketMessage.id.asc(), MessageAttachment.id.asc())
+        .execution_options(yield_per=200)
+    )
+
+    fd, tmp = tempfile.mkstemp(dir=out.parent, suffix=".part")
+    with os.fdopen(fd, "w", encoding="utf-8") as f:
+        f.write(
+            f"<h2>Тикет #{t.id}</h2>"
+            f"<div class=\"meta\">статус {t.status.value} | {_fmt(t.created_at)} → {_fmt(t.closed_at)}"
+            f" | {html.escape(operator_label)}</div>\n"
+        )
+        last_tm_id = None
+        for r in rows:
+            if r.id != last_tm_id:
+                if last_tm_id is not None:
+                    f.write("</div>\n")
+                last_tm_id = r.id
+                who = "Пользователь" if r.sender_type == "user" else operator_label
+                f.write(
+                    f"<div class=\"m {html.escape(r.sender_type)}\">"
+                    f"<div class=\"who\">{html.escape(who)} · {_fmt(r.created_at)}</div>"
+                )
+                body = r.message_text or r.caption
+                if body:
+                    f.write(html.escape(body))
+            if r.att_id is not None:
+                f.write(_attachment_html(r, inline))
+        if last_tm_id is not None:
+            f.write("</div>\n")
+        else:
+            f.write("<div class=\"meta\">сообщений нет</div>\n")
+
+    os.replace(tmp, out)
+    if not out.name.startswith("ticket_"):
+        return  # урезанный по бюджету — только для этого документа, не кэш
+    # старые версии фрагмента этого тикета больше не нужны
+    for old in out.parent.glob(f"ticket_{t.id}_*.html"):
+        if old != out:
+            old.unlink(missing_ok=True)
+
+
+def _fragment(s: Session, t: Ticket, label: Callable[[], str], frag: Path, inline: _Inline) -> tuple[Path, bool]:
+    """
+    Фрагмент тикета для документа: (путь, временный ли он).
+    Из кэша — если влезает в бюджет целиком (считаем весь размер файла).
+    Не влез или при отрисовке что-то не встроилось — урезанная копия только для
+    этого документа; в кэш идут только полные фрагменты.
+    """
+    try:
+        size = frag.stat().st_size
+    except FileNotFoundError:
+        size = None
+    if size is not None and size <= inline.left:
+        inline.left -= size
+        os.utime(frag)  # для _trim_cache: фрагмент в ходу
+        return frag, False
+    fd, tmp = tempfile.mkstemp(dir=frag.parent, prefix=f"part_{t.id}_", suffix=".html")
+    os.close(fd)
+    part = Path(tmp)
+    inline.denied = False
+    if size is None:
+        _render_ticket(s, t, label(), frag, inline)
+        if not inline.denied:
+            part.unlink()
+            return frag, False
+        os.replace(frag, part)
+    else:
+        _render_ticket(s, t, label(), part, inline)
+    return part, True
+
+
+def render_user_history(
+    current_ticket_id: int,
+    user_id: int,
+    operator_label: Callable[[Session, int | None], str],
+) -> Path | None:
+    """
+    Собираем один html со всеми прошлыми обращениями пользователя
+    (кроме текущего тикета). Возвращаем путь к файлу или None,
+    если других обращений нет. Файл после отправки надо удалить.
+
+    Читаем с реплики, если она есть: текущий тикет мог до нее еще не доехать,
+    поэтому user_id передает вызывающий (он уже проверил тикет на primary).
+    """
+    cache = _transcripts_dir()
+    inline = _Inline(INLINE_DOCUMENT_LIMIT)
+    temporary: list[Path] = []
+
+    with read_session() as s:
+        user = s.get(User, user_id)
+
+        tickets = s.scalars(
+            select(Ticket)
+            .where(Ticket.user_id == user_id, Ticket.id != current_ticket_id)
+            .order_by(Ticket.created_at.asc(), Ticket.id.asc())
+        ).all()
+        if not tickets:
+            return None
+
+        versions = _versions(s, [t.id for t in tickets if t.status != TicketStatus.closed])
+
+        try:
+            # бюджет встроенного — сначала свежим обращениям, они оператору важнее
+            fragments: dict[int, Path] = {}
+            for t in reversed(tickets):
+                frag, temp = _fragment(
+                    s, t, lambda t=t: operator_label(s, t.operator_tg_id),
+                    cache / _fragment_name(t, versions.get(t.id)), inline,
+                )
+                fragments[t.id] = frag
+                if temp:
+                    temporary.append(frag)
+
+            who = html.escape(
+                " ".join(filter(None, [user.first_name if user else None,
+                                       f"@{user.username}" if user and user.username else None]))
+                or "—"
+            )
+            fd, path = tempfile.mkstemp(dir=cache, prefix=f"history_{current_ticket_id}_", suffix=".html")
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(
+                    "<!doctype html><html><head><meta charset=\"utf-8\">"
+                    f"<title>История обращений</title><style>{_CSS}</style></head><body>"
+                    f"<h1>История обращений: {who}</h1>"
+                    f"<div class=\"meta\">TG ID: {user.tg_id if user else '—'} | тикетов: {len(fragments)}</div>\n"
+                )
+                for t in tickets:
+                    with open(fragments[t.id], encoding="utf-8") as src:
+                        shutil.copyfileobj(src, f)
+                f.write("</body></html>\n")
+        finally:
+            for p in temporary:
+                p.unlink(missing_ok=True)
+    _trim_cache(cache)
+    return Path(path)